@@ -0,0 +1,246 @@
+(ns clnplugin-clj-bench
+  "Benchmarks of clnplugin-clj library.
+
+  Run them all with
+
+      clojure -M:bench
+
+  or only one of them, for instance `read-bench`, with:
+
+      clojure -X:bench clnplugin-clj-bench/read-bench"
+  (:require [clnplugin-clj :as plugin])
+  (:require [clojure.data.json :as json])
+  (:require [clojure.string :as str]))
+
+(defn- measure
+  "Return the mean time in microseconds of calling F.
+
+  F is called WARMUP times before being measured N times."
+  [f n warmup]
+  (dotimes [_ warmup] (f))
+  (let [start (System/nanoTime)]
+    (dotimes [_ n] (f))
+    (/ (- (System/nanoTime) start) n 1000.0)))
+
+(defn- report
+  "Print the line of a benchmark report."
+  [bench-name & kvs]
+  (println (str/join " " (cons (format "%-28s" bench-name)
+                               (map (fn [[k v]] (format "%s=%s" (name k) v))
+                                    (partition 2 kvs))))))
+
+;;; read-bench
+
+(defn- read-line-concat
+  "Read one request from IN the way `plugin/read` did before it used a request reader.
+
+  Used as baseline in `read-bench`."
+  [in]
+  (binding [*in* in]
+    (loop [req-acc "" line (read-line)]
+      (cond
+        (nil? line) nil
+        (empty? line) (json/read-str req-acc :key-fn keyword)
+        true (recur (str req-acc line) (read-line))))))
+
+(defn- request-str
+  "Return a pretty-printed \"htlc_accepted\" like request of about SIZE chars.
+
+  The request contains one line per 64 chars of payload."
+  [size]
+  (let [line (apply str (repeat 64 "a"))
+        payload (vec (repeat (max 1 (quot size 80)) line))]
+    (str (with-out-str
+           (json/pprint {:jsonrpc "2.0" :id "cln:htlc_accepted#42"
+                         :method "htlc_accepted"
+                         :params {:onion {:payload payload}}}
+                        :escape-slash false))
+         "\n\n")))
+
+(defn read-bench
+  "Measure the time to read requests of 1KB, 100KB and 10MB.
+
+  We compare `plugin/read` with `read-line-concat` which builds
+  the request string line by line before parsing it.  As the later
+  is quadratic in the number of lines, we don't run it on 10MB
+  requests."
+  [_]
+  (doseq [[label size n line-concat?] [["1KB" 1000 2000 true]
+                                       ["100KB" 100000 20 true]
+                                       ["10MB" 10000000 3 false]]]
+    (let [req-str (request-str size)
+          reqs-str (apply str (repeat n req-str))
+          read-all (fn [rdr read-fn]
+                     (fn []
+                       (let [r (rdr (java.io.StringReader. reqs-str))]
+                         (dotimes [_ n] (read-fn r)))))
+          streaming (read-all #(#'plugin/request-reader
+                                (clojure.lang.LineNumberingPushbackReader. %))
+                              #'plugin/read)
+          line-concat (read-all #(clojure.lang.LineNumberingPushbackReader. %)
+                                read-line-concat)]
+      (report (str "read " label)
+              :chars (count req-str)
+              :lines (count (str/split-lines req-str))
+              :streaming-us (format "%.1f" (/ (measure streaming 3 1) n))
+              :line-concat-us (if line-concat?
+                                (format "%.1f" (/ (measure line-concat 3 1) n))
+                                "skipped")))))
+
+;;; dispatch-bench
+
+(defn- lookup-merge
+  "Return the :fn of REQ's method the way `plugin/process` did before the dispatch table.
+
+  Used as baseline in `dispatch-bench`."
+  [req plugin]
+  (let [method (keyword (:method req))]
+    (if (:id req)
+      (get-in (merge (:rpcmethods @plugin) (:hooks @plugin)) [method :fn])
+      (when-let [subs (:subscriptions @plugin)]
+        (or (get-in subs [method :fn])
+            (get-in subs [:* :fn]))))))
+
+(defn dispatch-bench
+  "Measure the time to find the method of a request among a few hundred.
+
+  We compare `plugin/lookup-method` with `lookup-merge`."
+  [_]
+  (doseq [n [10 100 300]]
+    (let [f (fn [params req plugin] {})
+          methods (into {} (for [i (range n)] [(keyword (str "method-" i)) {:fn f}]))
+          plugin (atom {:rpcmethods methods
+                        :hooks {:htlc_accepted {:fn f} :peer_connected {:fn f}}
+                        :subscriptions (assoc methods :* {:fn f})
+                        :_dispatch-table (volatile! nil)})
+          reqs (vec (for [i (range n)]
+                      {:jsonrpc "2.0" :id i :method (str "method-" i) :params {}}))
+          notifs (vec (for [i (range n)]
+                        {:jsonrpc "2.0" :method (str "topic-" i) :params {}}))
+          lookup-all (fn [lookup reqs]
+                       (fn [] (doseq [req reqs] (lookup req plugin))))]
+      (report (str "dispatch " n " methods")
+              :table-req-ns (format "%.0f" (/ (* 1000 (measure (lookup-all #'plugin/lookup-method reqs) 2000 500)) n))
+              :merge-req-ns (format "%.0f" (/ (* 1000 (measure (lookup-all lookup-merge reqs) 2000 500)) n))
+              :table-notif-ns (format "%.0f" (/ (* 1000 (measure (lookup-all #'plugin/lookup-method notifs) 2000 500)) n))
+              :merge-notif-ns (format "%.0f" (/ (* 1000 (measure (lookup-all lookup-merge notifs) 2000 500)) n))))))
+
+;;; alloc-bench
+
+(defn- allocated-bytes
+  "Return the number of bytes allocated so far by the current thread."
+  []
+  (.getThreadAllocatedBytes
+   ^com.sun.management.ThreadMXBean (java.lang.management.ManagementFactory/getThreadMXBean)
+   (.getId (Thread/currentThread))))
+
+(defn- bytes-per-call
+  "Return the mean number of bytes allocated by calling F.
+
+  F is called WARMUP times before being measured N times."
+  [f n warmup]
+  (dotimes [_ warmup] (f))
+  (let [start (allocated-bytes)]
+    (dotimes [_ n] (f))
+    (/ (- (allocated-bytes) start) n)))
+
+(defn alloc-bench
+  "Measure the bytes allocated by `plugin/process` per request of 100B, 10KB and 1MB.
+
+  Requests that succeed must not be printed, so the bytes allocated
+  per request must not depend on their size.  Those that fail are
+  printed in errors truncated to :error-max-chars.  See
+  `process-allocation-test` in test/clnplugin_clj_test.clj."
+  [_]
+  (let [plugin (atom {:rpcmethods {:ok {:fn (fn [params req plugin] {})}
+                                   :fail {:fn (fn [params req plugin] (throw (Exception. "fail")))}}
+                      :_dispatch-table (volatile! nil)})]
+    (doseq [[label size n] [["100B" 100 100000] ["10KB" 10000 10000] ["1MB" 1000000 100]]]
+      (let [params {:onion (vec (repeat (max 1 (quot size 100)) (apply str (repeat 100 "a"))))}
+            ok {:jsonrpc "2.0" :id 1 :method "ok" :params params}
+            fail {:jsonrpc "2.0" :id 1 :method "fail" :params params}]
+        (report (str "alloc " label)
+                :ok-bytes (format "%.0f" (double (bytes-per-call #(#'plugin/process ok plugin) n n)))
+                :fail-bytes (format "%.0f" (double (bytes-per-call #(#'plugin/process fail plugin)
+                                                                   (quot n 10) (quot n 10)))))))))
+
+;;; metrics-bench
+
+(defn metrics-bench
+  "Measure the overhead of recording the processing of a request in the metrics registry.
+
+  We measure `plugin/record!` alone, from one thread and from 8
+  threads recording the same method at the same time.  Then we
+  measure the time and the bytes allocated per request of
+  `plugin/process` of a method returning {}, which is the minimum
+  work done per request, without the registry (off) and followed by
+  what `plugin/dispatch` and the writer record with the registry
+  (on).  See the Metrics section of docs/docs.org."
+  [_]
+  (let [n 100000
+        registry (#'plugin/metrics-registry)
+        plugin (atom {:rpcmethods {:foo {:fn (fn [params req plugin] {})}}
+                      :_dispatch-table (volatile! nil)})
+        req {:jsonrpc "2.0" :id 1 :method "foo" :params {}}
+        record (fn [] (dotimes [i n] (#'plugin/record! registry "foo" (* i 1000) :ok)))
+        record-8-threads (fn []
+                           (->> (range 8)
+                                (mapv (fn [_] (future (record))))
+                                (run! deref)))
+        process-off (fn [] (#'plugin/process req plugin))
+        process-on (fn []
+                     (#'plugin/process req plugin)
+                     (#'plugin/record! registry "foo" 1000 :ok)
+                     (#'plugin/record-bytes! registry "foo" 40))]
+    (report "metrics record!"
+            :record-ns (format "%.0f" (/ (* 1000 (measure record 20 5)) n))
+            :record-8-threads-ns (format "%.0f" (/ (* 1000 (measure record-8-threads 20 5)) n 8)))
+    (report "metrics per request"
+            :off-ns (format "%.0f" (/ (* 1000 (measure #(dotimes [_ n] (process-off)) 20 5)) n))
+            :on-ns (format "%.0f" (/ (* 1000 (measure #(dotimes [_ n] (process-on)) 20 5)) n))
+            :off-bytes (format "%.0f" (double (bytes-per-call process-off n n)))
+            :on-bytes (format "%.0f" (double (bytes-per-call process-on n n))))))
+
+;;; codec-bench
+
+(defn- listpeerchannels-like
+  "Return a \"listpeerchannels\" like result with N channels of about 40 fields each."
+  [n]
+  {:channels
+   (vec (for [i (range n)]
+          (into {:peer_id (format "%066d" i)
+                 :state "CHANNELD_NORMAL"
+                 :short_channel_id (format "%dx1x0" i)
+                 :to_us_msat (* i 1000)
+                 :total_msat 1000000000
+                 :htlcs []
+                 :features ["option_static_remotekey" "option_anchors"]}
+                (for [j (range 33)]
+                  [(keyword (str "field_" j)) (if (even? j) j (str "value-" j))]))))})
+
+(defn codec-bench
+  "Measure the time to read and write a wide payload with each codec.
+
+  The payload looks like a \"listpeerchannels\" result passed to a
+  hook, where the same field names come back for each channel."
+  [_]
+  (let [payload {:jsonrpc "2.0" :id 1 :method "htlc_accepted"
+                 :params (listpeerchannels-like 200)}
+        payload-str (json/write-str payload)
+        cs (.toCharArray ^String payload-str)]
+    (doseq [c [:data-json :jackson]]
+      (let [codec (#'plugin/codec c)
+            read-fn #((:read codec) cs 0 (alength cs))
+            write-fn #((:write codec) payload (java.io.StringWriter. (alength cs)))]
+        (report (str "codec " (name c))
+                :chars (alength cs)
+                :read-us (format "%.1f" (measure read-fn 500 200))
+                :write-us (format "%.1f" (measure write-fn 500 200)))))))
+
+(defn -main [& _]
+  (read-bench nil)
+  (dispatch-bench nil)
+  (metrics-bench nil)
+  (alloc-bench nil)
+  (codec-bench nil)
+  (shutdown-agents))
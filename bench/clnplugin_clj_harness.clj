@@ -0,0 +1,399 @@
+(ns clnplugin-clj-harness
+  "In-process lightningd stand-in and benchmarks of the plugin runtime.
+
+  The stand-in runs a plugin with `plugin/run` in the current JVM,
+  connected to it by in-memory pipes instead of stdin/stdout.  It does
+  the getmanifest and init rounds, then replays request mixes of RPC
+  methods, hooks and notifications with small or large payloads, as
+  fast as possible or at a fixed rate.  No lightningd is needed.
+
+  Run all the scenarios with
+
+      clojure -M:harness
+
+  or only some of them, for instance:
+
+      clojure -M:harness rpc-small notification-storm
+
+  For each scenario we report the throughput, the p50, p99 and p999
+  latencies of the requests with an id (notifications get no
+  response) and the allocation rate of the plugin's threads.  The
+  results are saved in target/bench/ as EDN and JSON files named
+  after the current commit, and two of them can be compared with:
+
+      clojure -M:harness compare target/bench/old.edn target/bench/new.edn"
+  (:require [clnplugin-clj :as plugin])
+  (:require [clojure.data.json :as json])
+  (:require [clojure.edn :as edn])
+  (:require [clojure.java.io :as io])
+  (:require [clojure.java.shell :as shell])
+  (:require [clojure.pprint :as pprint])
+  (:require [clojure.string :as str])
+  (:import [java.lang.management ManagementFactory])
+  (:import [java.nio.channels Channels Pipe])
+  (:import [java.util.concurrent CountDownLatch TimeUnit])
+  (:import [java.util.concurrent.locks LockSupport]))
+
+;;; lightningd stand-in
+
+(defn- pipe
+  "Return [reader writer] vector connected by an in-memory pipe.
+
+  We don't use java.io.PipedReader because it fails when the thread
+  that last wrote to it terminates."
+  []
+  (let [p (Pipe/open)]
+    [(Channels/newReader (.source p) "UTF-8")
+     (Channels/newWriter (.sink p) "UTF-8")]))
+
+(defn- send!
+  "Send REQ (a map) to the plugin run by LIGHTNINGD."
+  [lightningd req]
+  (let [^java.io.Writer w (:to-plugin lightningd)]
+    (json/write req w :escape-slash false)
+    (.write w "\n\n")
+    (.flush w)))
+
+(defn- receive!
+  "Return the response of the plugin run by LIGHTNINGD to the request whose id is ID.
+
+  Notifications received in between are skipped."
+  [lightningd id]
+  (loop [msg (#'plugin/read (:from-plugin lightningd))]
+    (cond
+      (nil? msg) (throw (ex-info (format "Plugin stopped before responding to '%s'" id) {}))
+      (= (:id msg) id) msg
+      true (recur (#'plugin/read (:from-plugin lightningd))))))
+
+(defn start!
+  "Run PLUGIN connected to a lightningd stand-in and return the stand-in.
+
+  The plugin is run by `plugin/run` in a daemon thread with `*in*`
+  and `*out*` bound to in-memory pipes.  We do the getmanifest and
+  init rounds, so once `start!` returns, the plugin is ready to
+  process requests sent with `send!`.
+
+  The stand-in is a map with the following keys:
+
+  - :plugin:      PLUGIN,
+  - :to-plugin:   the writer connected to the plugin's `*in*`,
+  - :from-plugin: a request reader (see `plugin/request-reader`) of
+                  the plugin's `*out*`,
+  - :plugin-out:  the writer bound to the plugin's `*out*`,
+  - :stopped:     a promise delivered when the plugin stops.
+
+  See `stop!`."
+  [plugin]
+  (let [[plugin-in to-plugin] (pipe)
+        [from-plugin plugin-out] (pipe)
+        stopped (promise)
+        lightningd {:plugin plugin
+                    :to-plugin to-plugin
+                    :from-plugin (#'plugin/request-reader from-plugin)
+                    :plugin-out plugin-out
+                    :stopped stopped}]
+    (doto (Thread. ^Runnable
+                   (fn []
+                     (binding [*in* plugin-in
+                               *out* plugin-out
+                               plugin/*exit* (fn [status] (deliver stopped status))]
+                       (plugin/run plugin)))
+                   "clnplugin-harness-plugin")
+      (.setDaemon true)
+      (.start))
+    (send! lightningd {:jsonrpc "2.0" :id "getmanifest" :method "getmanifest"
+                       :params {:allow-deprecated-apis false}})
+    (receive! lightningd "getmanifest")
+    (send! lightningd {:jsonrpc "2.0" :id "init" :method "init"
+                       :params {:options {}
+                                :configuration
+                                {:lightning-dir (System/getProperty "java.io.tmpdir")
+                                 :rpc-file "lightning-rpc"
+                                 :startup true
+                                 :network "regtest"
+                                 :feature_set {}}}})
+    (receive! lightningd "init")
+    lightningd))
+
+(defn stop!
+  "Close the connection to the plugin run by LIGHTNINGD and wait for it to stop.
+
+  As with lightningd, the plugin stops once it has read the end of
+  its `*in*` and written what remains to be written.  As `plugin/*exit*`
+  returns, `plugin/run` then stops the threads of the plugin and returns."
+  [lightningd]
+  (.close ^java.io.Writer (:to-plugin lightningd))
+  (deref (:stopped lightningd) 10000 nil)
+  (.close ^java.io.Writer (:plugin-out lightningd)))
+
+;;; scenarios
+
+(def scenarios
+  "Request mixes replayed by `run-scenario`.
+
+  - :mix:          relative weights of :rpc (an RPC method), :hook
+                   (\"htlc_accepted\") and :notification (\"forward_event\")
+                   requests,
+  - :payload-size: number of chars in the params of each request,
+  - :n:            number of requests measured, after :n / 5 requests
+                   to warm up the JVM,
+  - :rate:         requests per second, or nil to send them as fast as
+                   possible,
+  - :inline:       true to process the hooks on the thread reading the
+                   requests (see `plugin/process-inline!`) instead of
+                   queuing them,
+  - :tx-us:        microseconds spent by each call of the notification
+                   handler, one call at a time, like a transaction on a
+                   single database connection would,
+  - :batch:        the :batch of the subscription (see `plugin/batch!`).
+
+  \"hooks-queued\" and \"hooks-inline\" compare the latency of a
+  trivial \"htlc_accepted\" hook with and without :inline.
+  \"events-one-by-one\" and \"events-batched\" compare the cost per
+  notification (:ns-per-req) of a handler doing one transaction per
+  call, with and without :batch."
+  [{:name "rpc-small" :mix {:rpc 1} :payload-size 100 :n 100000}
+   {:name "rpc-large" :mix {:rpc 1} :payload-size 100000 :n 2000}
+   {:name "hooks-under-rpc-load" :mix {:rpc 8 :hook 2} :payload-size 1000 :n 50000}
+   {:name "notification-storm" :mix {:notification 95 :rpc 5} :payload-size 500 :n 100000}
+   {:name "mixed-fixed-rate" :mix {:rpc 5 :hook 3 :notification 2} :payload-size 1000
+    :n 50000 :rate 10000}
+   {:name "hooks-queued" :mix {:hook 1} :payload-size 100 :n 50000 :rate 5000}
+   {:name "hooks-inline" :mix {:hook 1} :payload-size 100 :n 50000 :rate 5000 :inline true}
+   {:name "events-one-by-one" :mix {:notification 1} :payload-size 200 :n 20000 :tx-us 50}
+   {:name "events-batched" :mix {:notification 1} :payload-size 200 :n 20000 :tx-us 50
+    :batch {:max-size 500 :max-wait-ms 50}}])
+
+(defn- bench-plugin
+  "Return the plugin run by `run-scenario` for SCENARIO.
+
+  Its methods do nothing, so what we measure is the plugin runtime,
+  except the notification handler which takes the :tx-us of SCENARIO
+  per call.  The notifications processed are counted in :bench-events
+  of the plugin."
+  [scenario]
+  (let [{:keys [inline tx-us batch]} scenario
+        events (java.util.concurrent.atomic.AtomicLong. 0)
+        ;; one transaction at a time, as on a single database connection
+        tx! (fn [] (when tx-us (locking events (LockSupport/parkNanos (* 1000 (long tx-us))))))]
+    (atom {:rpcmethods {:bench-rpc {:fn (fn [params req plugin]
+                                          {:size (count (:payload params))})}}
+           :hooks {:htlc_accepted {:inline (boolean inline)
+                                   :fn (fn [params req plugin]
+                                         {:result "continue"})}}
+           :subscriptions {:forward_event
+                           (if batch
+                             {:batch batch
+                              :fn (fn [notifs req plugin]
+                                    (tx!)
+                                    (.addAndGet events (count notifs))
+                                    nil)}
+                             {:fn (fn [params req plugin]
+                                    (tx!)
+                                    (.incrementAndGet events)
+                                    nil)})}
+           :bench-events events})))
+
+(defn- templates
+  "Return the strings of the requests of each kind with a payload of PAYLOAD-SIZE chars.
+
+  A request with an id is split in two strings around its id."
+  [payload-size]
+  (let [params (str "{\"payload\":\"" (apply str (repeat payload-size "a")) "\"}")]
+    {:rpc ["{\"jsonrpc\":\"2.0\",\"id\":"
+           (str ",\"method\":\"bench-rpc\",\"params\":" params "}\n\n")]
+     :hook ["{\"jsonrpc\":\"2.0\",\"id\":"
+            (str ",\"method\":\"htlc_accepted\",\"params\":" params "}\n\n")]
+     :notification [(str "{\"jsonrpc\":\"2.0\",\"method\":\"forward_event\",\"params\":"
+                         params "}\n\n")]}))
+
+(defn- kinds
+  "Return a vector of N kinds of requests drawn according to the weights of MIX.
+
+  The draw is seeded, so a scenario always replays the same requests."
+  [mix n]
+  (let [rnd (java.util.Random. 42)
+        ks (vec (sort (keys mix)))
+        total (double (reduce + (vals mix)))]
+    (vec (repeatedly n (fn []
+                         (let [x (* total (.nextDouble rnd))]
+                           (loop [[k & more] ks acc 0.0]
+                             (let [acc (+ acc (mix k))]
+                               (if (or (< x acc) (empty? more))
+                                 k
+                                 (recur more acc))))))))))
+
+(defn- allocated-bytes
+  "Return the bytes allocated so far by the live threads except those in EXCLUDED.
+
+  EXCLUDED is a set of thread ids."
+  [excluded]
+  (let [^com.sun.management.ThreadMXBean mx (ManagementFactory/getThreadMXBean)
+        ids (long-array (remove excluded (.getAllThreadIds mx)))]
+    (reduce + (filter pos? (.getThreadAllocatedBytes mx ids)))))
+
+(defn- notifs-processed
+  "Return the number of \"forward_event\" notifications processed by PLUGIN."
+  [plugin]
+  (.get ^java.util.concurrent.atomic.AtomicLong (:bench-events @plugin)))
+
+(defn- quantile
+  "Return the Q quantile of SORTED, a sorted array of longs."
+  [^longs sorted q]
+  (let [n (alength sorted)]
+    (when (pos? n)
+      (aget sorted (min (dec n) (long (Math/floor (* q n))))))))
+
+(defn- replay!
+  "Send N requests of SCENARIO to the plugin run by LIGHTNINGD and return their measures.
+
+  Requests are sent from the current thread and responses read from
+  another one.  We return once all the responses have been read and
+  all the notifications processed.
+
+  With a fixed :rate, the latency of a request is measured from the
+  time it should have been sent, not from the time it was sent, to
+  not hide the delays of the plugin when it can't keep up."
+  [lightningd scenario n]
+  (let [{:keys [mix payload-size rate]} scenario
+        ^java.io.Writer w (:to-plugin lightningd)
+        plugin (:plugin lightningd)
+        ks (kinds mix n)
+        tmpls (templates payload-size)
+        nb-reqs (count (remove #{:notification} ks))
+        notifs-target (+ (notifs-processed plugin) (- n nb-reqs))
+        interval (when rate (long (/ 1e9 rate)))
+        sent-at (long-array n)
+        latencies (long-array n)
+        done (CountDownLatch. 1)
+        receiver (doto (Thread.
+                        ^Runnable
+                        (fn []
+                          (loop [k 0]
+                            (if (< k nb-reqs)
+                              (let [msg (#'plugin/read (:from-plugin lightningd))
+                                    id (:id msg)]
+                                (if (number? id)
+                                  (do (aset latencies id (- (System/nanoTime) (aget sent-at id)))
+                                      (recur (inc k)))
+                                  (recur k)))
+                              (.countDown done))))
+                        "clnplugin-harness-receiver")
+                   (.setDaemon true))
+        excluded #{(.getId (Thread/currentThread)) (.getId receiver)}
+        alloc-start (allocated-bytes excluded)
+        _ (.start receiver)
+        start (System/nanoTime)]
+    (dotimes [i n]
+      (let [[prefix suffix] (tmpls (ks i))]
+        (when interval
+          (let [t (+ start (* i interval))]
+            (loop []
+              (let [wait (- t (System/nanoTime))]
+                (when (pos? wait)
+                  (LockSupport/parkNanos wait)
+                  (recur))))))
+        (aset sent-at i (if interval (+ start (* i interval)) (System/nanoTime)))
+        (.write w ^String prefix)
+        (when suffix
+          (.write w (str i))
+          (.write w ^String suffix))
+        (.flush w)))
+    (when-not (.await done 60 TimeUnit/SECONDS)
+      (throw (ex-info (format "Timeout waiting for the responses of '%s'" (:name scenario)) {})))
+    (loop []
+      (when (< (notifs-processed plugin) notifs-target)
+        (Thread/sleep 1)
+        (recur)))
+    (let [elapsed-ns (- (System/nanoTime) start)
+          allocated (- (allocated-bytes excluded) alloc-start)
+          lats (long-array (keep-indexed (fn [i k] (when-not (= k :notification) (aget latencies i)))
+                                         ks))]
+      (java.util.Arrays/sort lats)
+      {:requests n
+       :elapsed-ms (quot elapsed-ns 1000000)
+       :throughput-rps (long (/ (* n 1e9) elapsed-ns))
+       :ns-per-req (quot elapsed-ns n)
+       :p50-us (some-> (quantile lats 0.5) (quot 1000))
+       :p99-us (some-> (quantile lats 0.99) (quot 1000))
+       :p999-us (some-> (quantile lats 0.999) (quot 1000))
+       :max-us (some-> (quantile lats 1.0) (quot 1000))
+       :alloc-mb-per-s (long (/ (* allocated 1e9) elapsed-ns 1024 1024))
+       :alloc-bytes-per-req (quot allocated n)})))
+
+(defn run-scenario
+  "Run SCENARIO on a new plugin and return its results.  See `scenarios`."
+  [scenario]
+  (let [lightningd (start! (bench-plugin scenario))]
+    (try
+      (replay! lightningd scenario (max 1 (quot (:n scenario) 5)))
+      (merge (select-keys scenario [:name :mix :payload-size :rate :inline :tx-us :batch])
+             (replay! lightningd scenario (:n scenario)))
+      (finally (stop! lightningd)))))
+
+;;; results
+
+(defn- commit
+  "Return the short sha of the current git commit or \"unknown\"."
+  []
+  (try
+    (let [{:keys [exit out]} (shell/sh "git" "rev-parse" "--short" "HEAD")]
+      (if (zero? exit) (str/trim out) "unknown"))
+    (catch Exception _ "unknown")))
+
+(defn- save-results
+  "Save RESULTS in target/bench/ as EDN and JSON files and return the EDN file."
+  [results]
+  (let [date (.format (java.text.SimpleDateFormat. "yyyyMMdd-HHmmss") (java.util.Date.))
+        report {:commit (commit)
+                :date date
+                :java (System/getProperty "java.version")
+                :results results}
+        base (format "target/bench/harness-%s-%s" (:commit report) date)
+        edn-file (io/file (str base ".edn"))]
+    (io/make-parents edn-file)
+    (spit edn-file (with-out-str (pprint/pprint report)))
+    (spit (str base ".json") (json/write-str report))
+    (str edn-file)))
+
+(defn- print-result
+  "Print the results of a scenario."
+  [{:keys [name throughput-rps ns-per-req p50-us p99-us p999-us alloc-mb-per-s alloc-bytes-per-req]}]
+  (println (format "%-24s throughput-rps=%s ns-per-req=%s p50-us=%s p99-us=%s p999-us=%s alloc-mb-per-s=%s alloc-bytes-per-req=%s"
+                   name throughput-rps ns-per-req p50-us p99-us p999-us alloc-mb-per-s alloc-bytes-per-req)))
+
+(defn compare-results
+  "Print the ratio new/old of the throughput and latencies of the scenarios in OLD-FILE and NEW-FILE.
+
+  OLD-FILE and NEW-FILE are EDN files saved by `-main`."
+  [old-file new-file]
+  (let [by-name #(into {} (map (juxt :name identity) (:results (edn/read-string (slurp %)))))
+        old (by-name old-file)
+        new (by-name new-file)
+        ratio (fn [k o n] (when (and (k o) (k n) (pos? (k o)))
+                            (format "%.2f" (double (/ (k n) (k o))))))]
+    (doseq [[name n] (sort new)
+            :let [o (old name)]
+            :when o]
+      (println (format "%-24s throughput=x%s p50=x%s p99=x%s p999=x%s alloc=x%s"
+                       name
+                       (ratio :throughput-rps o n)
+                       (ratio :p50-us o n)
+                       (ratio :p99-us o n)
+                       (ratio :p999-us o n)
+                       (ratio :alloc-bytes-per-req o n))))))
+
+(defn -main [& args]
+  (if (= (first args) "compare")
+    (compare-results (second args) (nth args 2))
+    (let [selected (if (seq args)
+                     (filter #((set args) (:name %)) scenarios)
+                     scenarios)
+          results (mapv (fn [scenario]
+                          (let [r (run-scenario scenario)]
+                            (print-result r)
+                            r))
+                        selected)]
+      (println "Results saved in" (save-results results))))
+  (shutdown-agents)
+  (System/exit 0))
@@ -0,0 +1,84 @@
+(ns clnplugin-clj-startup
+  "Benchmark of the startup time of a plugin.
+
+  We measure the time from the start of the plugin's process to its
+  response to the getmanifest request, for the plugin in
+  pytest/plugins/java started in the following modes:
+
+  - plain:   `clojure -M --main myplugin`, compiling the plugin and
+             clnplugin-clj at startup,
+  - uberjar: target/myplugin launcher built with `clojure -T:build plugin`,
+             running the AOT compiled uberjar,
+  - cds:     target/myplugin-cds launcher built with `clojure -T:build cds`,
+             running the uberjar with its AppCDS archive.
+
+  Run it with
+
+      clojure -M:startup
+
+  The uberjar and the archive are built first unless :skip-build
+  is passed as argument."
+  (:require [clojure.java.io :as io])
+  (:require [clojure.string :as str]))
+
+(def plugin-dir "pytest/plugins/java")
+
+(def modes
+  "Commands starting the plugin in each mode, run from `plugin-dir`."
+  [["plain" ["clojure" "-M" "--main" "myplugin"]]
+   ["uberjar" ["target/myplugin"]]
+   ["cds" ["target/myplugin-cds"]]])
+
+(def getmanifest
+  "{\"jsonrpc\":\"2.0\",\"id\":\"startup:getmanifest\",\"method\":\"getmanifest\",\"params\":{\"allow-deprecated-apis\":false}}\n\n")
+
+(defn- build!
+  "Build the uberjar and the AppCDS archive of the plugin in `plugin-dir`."
+  []
+  (let [p (-> (ProcessBuilder. ["clojure" "-T:build" "cds"])
+              (.directory (io/file plugin-dir))
+              (.inheritIO)
+              (.start))]
+    (when-not (zero? (.waitFor p))
+      (throw (ex-info "Failed to build the plugin" {})))))
+
+(defn- time-to-getmanifest
+  "Return the milliseconds between the start of COMMAND and the response to getmanifest.
+
+  The process is destroyed once the response has been read."
+  [command]
+  (let [start (System/nanoTime)
+        p (-> (ProcessBuilder. ^java.util.List command)
+              (.directory (io/file plugin-dir))
+              (.redirectError java.lang.ProcessBuilder$Redirect/DISCARD)
+              (.start))
+        in (io/writer (.getOutputStream p))
+        out (.getInputStream p)]
+    (try
+      (.write in ^String getmanifest)
+      (.flush in)
+      ;; the response ends with "\n\n"
+      (loop [prev -1]
+        (let [c (.read out)]
+          (cond
+            (= c -1) (throw (ex-info (format "'%s' stopped before responding to getmanifest"
+                                             (str/join " " command)) {}))
+            (and (= c 10) (= prev 10)) nil
+            true (recur c))))
+      (/ (- (System/nanoTime) start) 1e6)
+      (finally (.destroyForcibly p)))))
+
+(defn startup-bench
+  "Measure N times the startup of the plugin in each mode and print the min and median."
+  [n]
+  (doseq [[mode command] modes]
+    (time-to-getmanifest command) ;; warm up the file system cache
+    (let [times (sort (repeatedly n #(time-to-getmanifest command)))]
+      (println (format "%-28s min-ms=%.0f median-ms=%.0f"
+                       (str "startup " mode) (first times) (nth times (quot n 2)))))))
+
+(defn -main [& args]
+  (when-not (some #{":skip-build"} args)
+    (build!))
+  (startup-bench 5)
+  (shutdown-agents))
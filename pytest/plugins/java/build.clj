@@ -6,6 +6,10 @@
 (def p "target/myplugin")
 (def uber-file "target/myplugin.jar")
 (def p-jar (str (fs/file (fs/cwd) uber-file)))
+(def p-cds "target/myplugin-cds")
+(def jsa-file "target/myplugin.jsa")
+(def p-jsa (str (fs/file (fs/cwd) jsa-file)))
+(def training-file "target/training.json")
 
 (defn clean [_]
   (b/delete {:path "target"}))
@@ -17,10 +21,40 @@
                  :target-dir class-dir})
     (b/compile-clj {:class-dir class-dir
                     :basis basis
-                    :ns-compile '[myplugin]})
+                    :ns-compile '[myplugin]
+                    :compile-opts {:direct-linking true}})
     (b/uber {:class-dir class-dir
              :basis basis
              :uber-file uber-file
              :main 'myplugin})
     (spit p (str "#!/usr/bin/env -S java -jar " p-jar))
     (b/process {:command-args ["chmod" "+x" p]})))
+
+(defn cds
+  "Build the uberjar with `plugin` and an AppCDS archive of the classes it loads at startup.
+
+  The archive is created during a training run of the plugin in which
+  it receives the getmanifest and init requests then the end of stdin,
+  as when lightningd starts and stops it.  The plugin started with
+  target/myplugin-cds launcher maps the archive in memory instead of
+  loading and verifying those classes again, which shortens the time
+  before it answers getmanifest.  Requires JDK 13 or above.
+
+  The JVM uses the archive only if the classpath is the one of the
+  training run, so both run the uberjar by its absolute path.  The
+  build fails if the training run fails."
+  [_]
+  (plugin nil)
+  (spit training-file
+        (str "{\"jsonrpc\":\"2.0\",\"id\":\"training:getmanifest\",\"method\":\"getmanifest\",\"params\":{\"allow-deprecated-apis\":false}}\n\n"
+             "{\"jsonrpc\":\"2.0\",\"id\":\"training:init\",\"method\":\"init\",\"params\":{\"options\":{},\"configuration\":{\"lightning-dir\":\"target\",\"rpc-file\":\"lightning-rpc\",\"startup\":true,\"network\":\"regtest\",\"feature_set\":{}}}}\n\n"))
+  (let [exit (-> (ProcessBuilder. ["java" (str "-XX:ArchiveClassesAtExit=" p-jsa) "-jar" p-jar])
+                 (.redirectInput (java.io.File. training-file))
+                 (.redirectOutput (java.io.File. "target/training.out"))
+                 (.redirectError (java.io.File. "target/training.err"))
+                 (.start)
+                 (.waitFor))]
+    (when-not (zero? exit)
+      (throw (ex-info (format "Training run exited with status %s, see target/training.err" exit) {}))))
+  (spit p-cds (str "#!/usr/bin/env -S java -XX:SharedArchiveFile=" p-jsa " -Xshare:auto -jar " p-jar))
+  (b/process {:command-args ["chmod" "+x" p-cds]}))
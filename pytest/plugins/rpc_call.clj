@@ -0,0 +1,18 @@
+(ns rpc-call
+  (:require [clnplugin-clj :as plugin]))
+
+(def plugin
+  (atom {:rpc-pool-size 2
+         :rpcmethods
+         {:node-id
+          {:fn (fn [params req plugin]
+                 {:id (:id (plugin/rpc-call plugin "getinfo"))})}
+          :node-id-parallel
+          {:fn (fn [params req plugin]
+                 (let [ids (doall (repeatedly 20 #(future (:id (plugin/rpc-call plugin "getinfo")))))]
+                   {:ids (distinct (map deref ids))}))}
+          :unknown-command
+          {:fn (fn [params req plugin]
+                 (plugin/rpc-call plugin "foo-unknown-command"))}}}))
+
+(plugin/run plugin)
@@ -2,6 +2,7 @@ from pyln.testing.fixtures import *
 from pyln.client import RpcError
 import os
 import subprocess
+import tempfile
 import time
 import re
 
@@ -400,6 +401,37 @@ def test_async(node_factory, executor):
     assert delta < 3
 
 
+def test_async_saturation(node_factory, executor):
+    # max-parallel-reqs set to 1 in async_saturation.clj plugin, so
+    # while a request is processed the others wait in the scheduler's
+    # queue.  While they wait, the plugin must be idle and not spinning
+    # on a core.
+    plugin = os.path.join(os.getcwd(), "plugins/async_saturation")
+    l1 = node_factory.get_node(options={"plugin": plugin})
+    pid = int(subprocess.check_output(["pgrep", "-n", "-f", "async_saturation.clj"]))
+
+    def cpu_time(pid):
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        # utime and stime are the 14th and 15th fields of /proc/<pid>/stat
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    start_time = time.time()
+    # each call takes about 1 second
+    fs = [executor.submit(l1.rpc.call, "sleep-and-update-counter") for _ in range(4)]
+    time.sleep(0.5)
+    cpu_start = cpu_time(pid)
+    time.sleep(2)
+    cpu_delta = cpu_time(pid) - cpu_start
+    counter = {f.result()["counter"] for f in fs}
+    delta = time.time() - start_time
+    assert counter == {1,2,3,4}
+    # ensure the requests are processed one at a time
+    assert delta > 4.0
+    # a busy-spinning dispatch loop would burn about 2s of CPU in that window
+    assert cpu_delta < 0.5
+
+
 def test_hooks_peer_connected(node_factory):
     plugins = [os.path.join(os.getcwd(), "plugins/hooks_peer_connected_foo"),
                os.path.join(os.getcwd(), "plugins/hooks_peer_connected_bar"),
@@ -440,6 +472,31 @@ def test_java(node_factory):
     assert l1.rpc.call("foo") == {"bar": "baz"}
 
 
+def test_java_cds(node_factory):
+    build = subprocess.run("cd plugins/java && clojure -T:build cds", shell=True,
+                           capture_output=True, text=True)
+    assert build.returncode == 0, build.stderr
+    assert os.path.exists("plugins/java/target/myplugin.jsa")
+
+    # Check that the archive is used.  With -Xshare:on, the JVM refuses
+    # to start if it can't map the archive (classpath different from
+    # the training run, other JDK, ...), and with -Xlog:class+load it
+    # tells where each class is loaded from.
+    jar = os.path.join(os.getcwd(), "plugins/java/target/myplugin.jar")
+    jsa = os.path.join(os.getcwd(), "plugins/java/target/myplugin.jsa")
+    with open("plugins/java/target/training.json") as f:
+        run = subprocess.run(["java", f"-XX:SharedArchiveFile={jsa}", "-Xshare:on",
+                              "-Xlog:class+load=info", "-jar", jar],
+                             cwd="plugins/java", stdin=f,
+                             capture_output=True, text=True, timeout=60)
+    assert run.returncode == 0, run.stdout + run.stderr
+    assert re.search(r"\bmyplugin\b.* source: shared objects file", run.stdout)
+
+    plugin = os.path.join(os.getcwd(), "plugins/java/target/myplugin-cds")
+    l1 = node_factory.get_node(options={"plugin": plugin})
+    assert l1.rpc.call("foo") == {"bar": "baz"}
+
+
 def test_tools_np(node_factory):
     # Generate myplugin from tools/np script with local clnplugin-clj
     os.popen("cd ../tools && rm -r src build.clj deps.edn myplugin target").read()
@@ -518,3 +575,72 @@ def test_tools_np(node_factory):
 
     # clean tools directory
     os.popen("cd ../tools && rm -r src build.clj deps.edn myplugin target").read()
+
+
+def test_rpc_call(node_factory):
+    plugin = os.path.join(os.getcwd(), "plugins/rpc_call")
+    l1 = node_factory.get_node(options={"plugin": plugin})
+    node_id = l1.rpc.getinfo()["id"]
+    assert l1.rpc.call("node-id") == {"id": node_id}
+    assert l1.rpc.call("node-id-parallel") == {"ids": [node_id]}
+    with pytest.raises(RpcError, match=r"Error calling 'foo-unknown-command'"):
+        l1.rpc.call("unknown-command")
+
+
+def test_host(node_factory):
+    # plugins of pytest/plugins run in one host JVM behind
+    # ../tools/clnplugin-shim launchers
+    names = ["rpcmethods", "log", "subscriptions", "notifications",
+             "getmanifest_getinfo_internal_method"]
+    socket_dir = tempfile.mkdtemp()
+    host = subprocess.Popen(["clojure", "-M", "-m", "clnplugin-clj.host", socket_dir]
+                            + [name + ".clj" for name in names],
+                            cwd="plugins")
+    try:
+        sockets = {name: os.path.join(socket_dir, name + ".sock") for name in names}
+        deadline = time.time() + 300
+        while not all(os.path.exists(s) for s in sockets.values()):
+            assert host.poll() is None and time.time() < deadline
+            time.sleep(0.5)
+        shim = os.path.join(os.getcwd(), "../tools/clnplugin-shim")
+        launchers = {}
+        for name in names:
+            launcher = os.path.join(socket_dir, name)
+            with open(launcher, "w") as f:
+                f.write("#!/usr/bin/env bash\n"
+                        f"CLNPLUGIN_SOCKET={sockets[name]} exec {shim}\n")
+            os.chmod(launcher, 0o755)
+            launchers[name] = launcher
+
+        l1 = node_factory.get_node(options={"plugin": [launchers["rpcmethods"],
+                                                       launchers["log"],
+                                                       launchers["subscriptions"],
+                                                       launchers["notifications"]]})
+        l2 = node_factory.get_node(options={"plugin": launchers["rpcmethods"]})
+
+        assert l1.rpc.call("foo-0") == {"bar": "baz"}
+        assert l1.rpc.call("foo-3") == {}
+        time.sleep(0.1)
+        assert l1.rpc.call("foo-4") == {"bar-4": "baz-3"}
+        # each session has its own plugin atom
+        assert l2.rpc.call("foo-4") == {"bar-4": None}
+
+        l1.rpc.call("log-info")
+        assert l1.daemon.is_in_log(r"INFO.*logged by 'log-info'")
+        l1.rpc.call("notify-topic-0")
+        l1.daemon.wait_for_log(r'Got a topic-0 notification {:foo-0 \\"bar-0\\"} from plugin notifications')
+
+        # a stopped plugin doesn't stop the host and can be started again
+        l1.rpc.plugin_stop(launchers["rpcmethods"])
+        l1.rpc.plugin_start(launchers["rpcmethods"])
+        assert l1.rpc.call("foo-4") == {"bar-4": None}
+        assert l2.rpc.call("foo-0") == {"bar": "baz"}
+
+        with pytest.raises(RpcError, match=r"exited before replying to getmanifest"):
+            l1.rpc.plugin_start(launchers["getmanifest_getinfo_internal_method"])
+
+        l1.stop()
+        assert host.poll() is None
+        assert l2.rpc.call("foo-0") == {"bar": "baz"}
+    finally:
+        host.kill()
@@ -3,7 +3,16 @@
   (:refer-clojure :exclude [read])
   (:require [clojure.string :as str])
   (:require [clojure.data.json :as json])
-  (:require [clojure.core.async :refer [go >!! <!! chan thread]]))
+  (:require [clojure.core.async :as async :refer [thread]])
+  (:import [java.util ArrayDeque])
+  (:import [java.util.concurrent ConcurrentHashMap CountDownLatch ExecutorService Executors Future
+            LinkedBlockingQueue ScheduledExecutorService ScheduledThreadPoolExecutor
+            ThreadFactory ThreadPoolExecutor TimeUnit])
+  (:import [java.util.concurrent.atomic AtomicBoolean AtomicLong AtomicLongArray LongAccumulator LongAdder])
+  (:import [java.net ProtocolFamily SocketAddress StandardProtocolFamily])
+  (:import [java.nio ByteBuffer])
+  (:import [java.nio.channels Channels SocketChannel])
+  (:import [java.util.concurrent.locks Condition ReentrantLock]))
 
 (defn- gm-option
   "Check option and return it in a format understable by lightningd.
@@ -88,6 +97,70 @@
   [options]
   (mapv gm-option (seq options)))
 
+(defn- check-executor
+  "Throw an error if EXECUTOR is not a valid :executor value for KW-NAME.
+
+  EXECUTOR can be nil (use the executor of the plugin), :blocking,
+  :cpu or :virtual.  See `executors`."
+  [kw-name executor]
+  (when-not (or (nil? executor) (some #{executor} #{:blocking :cpu :virtual}))
+    (throw (ex-info (format "Wrong :executor '%s' for '%s'.  Authorized executors are: :blocking, :cpu, :virtual."
+                            executor kw-name) {}))))
+
+(defn- check-method
+  "Throw an error if the scheduling keys of METHOD are not valid for KW-NAME.
+
+  METHOD is the definition map of KW-NAME in :rpcmethods, :hooks or
+  :subscriptions map.  Its :executor is checked with `check-executor`,
+  its :max-parallel, :timeout-ms and :inline-budget-ms must be positive
+  integers, its :shed must be :drop, :coalesce or :queue and its
+  :inline a boolean.  They are all optional, but an :inline method
+  can't have a :timeout-ms as nothing can interrupt it.
+
+  See `scheduler`, `dispatch` and `process-inline!`."
+  [kw-name method]
+  (check-executor kw-name (:executor method))
+  (when-not (contains? #{nil true false} (:inline method))
+    (throw (ex-info (format "Wrong :inline '%s' for '%s'.  It must be a boolean."
+                            (:inline method) kw-name) {})))
+  (when (and (:inline method) (:timeout-ms method))
+    (throw (ex-info (format "Wrong :timeout-ms for '%s'.  :inline methods can't have a :timeout-ms."
+                            kw-name) {})))
+  (doseq [k [:max-parallel :timeout-ms :inline-budget-ms]]
+    (when-let [v (get method k)]
+      (when-not (pos-int? v)
+        (throw (ex-info (format "Wrong %s '%s' for '%s'.  It must be a positive integer."
+                                k v kw-name) {})))))
+  (when-let [shed (:shed method)]
+    (when-not (#{:drop :coalesce :queue} shed)
+      (throw (ex-info (format "Wrong :shed '%s' for '%s'.  Authorized values are: :drop, :coalesce, :queue."
+                              shed kw-name) {})))))
+
+(defn- check-cache
+  "Throw an error if CACHE is not a valid :cache value for KW-NAME RPC method.
+
+  CACHE must be a map whose :ttl-ms is a positive integer.  Its
+  optional :max-entries must be a positive integer, its :keys a
+  vector of keywords and its :invalidate-on a vector of notification
+  topics.
+
+  See `response-caches`."
+  [kw-name cache]
+  (when cache
+    (let [{:keys [ttl-ms max-entries invalidate-on] ks :keys} cache]
+      (when-not (and (map? cache) (pos-int? ttl-ms)
+                     (or (nil? max-entries) (pos-int? max-entries)))
+        (throw (ex-info (format "Wrong :cache '%s' for '%s'.  :ttl-ms (mandatory) and :max-entries must be positive integers."
+                                cache kw-name) {})))
+      (when-not (or (nil? ks) (and (sequential? ks) (every? keyword? ks)))
+        (throw (ex-info (format "Wrong :keys '%s' in :cache of '%s'.  It must be a vector of keywords."
+                                ks kw-name) {})))
+      (when-not (or (nil? invalidate-on)
+                    (and (sequential? invalidate-on)
+                         (every? #(or (string? %) (keyword? %)) invalidate-on)))
+        (throw (ex-info (format "Wrong :invalidate-on '%s' in :cache of '%s'.  It must be a vector of notification topics."
+                                invalidate-on kw-name) {}))))))
+
 (defn- gm-rpcmethods
   "Return the vector of RPC methods meant to be used in the getmanifest response.
 
@@ -231,7 +304,9 @@
                                         kw-name) {}))
                 (not (fn? method-fn))
                 (throw (ex-info (format "Error in '%s' RPC method definition.  :fn must be a function not '%s' which is an instance of '%s'"
-                                        kw-name method-fn (class method-fn)) {}))))
+                                        kw-name method-fn (class method-fn)) {}))
+                true (do (check-method kw-name method)
+                         (check-cache kw-name (:cache method)))))
             (merge {:name (name kw-name)
                     :usage (get method :usage "")
                     :description (get method :description "")}
@@ -275,6 +350,25 @@
                 true {:method topic}))]
       (mapv f notifications))))
 
+(defn- check-batch
+  "Throw an error if the :batch of SUBSCRIPTION is not valid for KW-NAME topic.
+
+  :batch must be a map whose optional :max-size and :max-wait-ms are
+  positive integers, and a subscription with a :batch can't be :inline.
+
+  See `batch!`."
+  [kw-name subscription]
+  (when-let [batch (:batch subscription)]
+    (let [{:keys [max-size max-wait-ms]} batch]
+      (when-not (and (map? batch)
+                     (or (nil? max-size) (pos-int? max-size))
+                     (or (nil? max-wait-ms) (pos-int? max-wait-ms)))
+        (throw (ex-info (format "Wrong :batch '%s' for '%s'.  :max-size and :max-wait-ms must be positive integers."
+                                batch kw-name) {})))
+      (when (:inline subscription)
+        (throw (ex-info (format "Wrong :batch for '%s'.  :inline subscriptions can't have a :batch."
+                                kw-name) {}))))))
+
 (defn- gm-subscriptions
   "Return the vector of subscriptions meant to be used in the getmanifest response."
   [subscriptions]
@@ -286,7 +380,9 @@
                                         kw-name) {}))
                 (not (fn? subscription-fn))
                 (throw (ex-info (format "Error in '%s' notification topic in :subscriptions map.  :fn must be a function not '%s' which is an instance of '%s'"
-                                        kw-name subscription-fn (class subscription-fn)) {})))
+                                        kw-name subscription-fn (class subscription-fn)) {}))
+                true (do (check-method kw-name subscription)
+                         (check-batch kw-name subscription)))
               (name kw-name)))]
     (when-let [s (seq subscriptions)]
       (let [subs (mapv f s)]
@@ -300,14 +396,15 @@
   "Return the vector of hooks meant to be used in the getmanifest response."
   [hooks]
   (when hooks
-    (let [f (fn [[kw-name {:keys [before after fn]}]]
+    (let [f (fn [[kw-name {:keys [before after fn] :as hook}]]
               (cond
                 (nil? fn)
                 (throw (ex-info (format ":fn is not defined for '%s' hook :hooks map."
                                         kw-name) {}))
                 (not (fn? fn))
                 (throw (ex-info (format "Error in '%s' hook in :hooks map.  :fn must be a function not '%s' which is an instance of '%s'"
-                                        kw-name fn (class fn)) {})))
+                                        kw-name fn (class fn)) {}))
+                true (check-method kw-name hook))
               (merge {:name (name kw-name)}
                      (when before {:before before})
                      (when after {:after after})))]
@@ -337,6 +434,7 @@
   See `gm-rpcmethods`, `gm-options` and `set-defaults!`."
   [req plugin]
   (let [p @plugin]
+    (check-executor :plugin (:executor p))
     {:jsonrpc "2.0"
      :id (:id req)
      :result
@@ -354,12 +452,48 @@
             (when-let [custommessages (:custommessages p)]
               {:custommessages custommessages}))}))
 
+(declare metrics params->map record-bytes!)
+
 (defn- set-defaults!
   "Set default values for :dynamic, :options and :rpcmethods keys if omitted.
 
-  In particular, plugins are dynamic by default if not otherwise specified."
+  In particular, plugins are dynamic by default if not otherwise specified.
+
+  If :stats-method is set, we add to :rpcmethods a method with that
+  name returning the `metrics` of the plugin.  For instance, with the
+  plugin
+
+      {:stats-method :myplugin-stats
+       ,,,}
+
+  we can look at the metrics of the plugin by running:
+
+      lightning-cli myplugin-stats
+
+  We also subscribe to the notification topics in :invalidate-on
+  of the :cache of RPC methods (see `response-caches`) which are
+  not in :subscriptions map, so that lightningd sends them to us."
   [plugin]
-  (swap! plugin #(merge {:options {} :rpcmethods {} :dynamic true} %)))
+  (swap! plugin
+         (fn [p]
+           (let [p (merge {:options {} :rpcmethods {} :dynamic true} p)
+                 p (if-let [stats-method (:stats-method p)]
+                     (assoc-in p [:rpcmethods (keyword (name stats-method))]
+                               {:description "Return the metrics of the plugin"
+                                :fn (fn [params req plugin] (metrics plugin))})
+                     p)
+                 topics (distinct
+                         (for [[_ method] (:rpcmethods p)
+                               :let [invalidate-on (get-in method [:cache :invalidate-on])]
+                               :when (sequential? invalidate-on)
+                               topic invalidate-on
+                               :when (or (string? topic) (keyword? topic))]
+                           (keyword (name topic))))]
+             (if (or (empty? topics) (contains? (:subscriptions p) :*))
+               p
+               (assoc p :subscriptions
+                      (merge (zipmap topics (repeat {:fn (fn [params req plugin])}))
+                             (:subscriptions p))))))))
 
 (defn- add-request!
   "Store :params of REQ in PLUGIN.
@@ -553,6 +687,9 @@
                     :label \"some-label\"
                     :description \"some-description\"})
 
+     The socket file is also used by `rpc-call` which sends requests
+     through connections kept open from one call to the next.
+
   4) We try to set PLUGIN's :options with the values given by the user
      through REQ.  If not possible we disable the plugin by replying
      to lightningd with a JSON RPC response whose \"result\" field
@@ -613,6 +750,236 @@
     ;; json/write-string is private to clojure.data.json library!
     (#'json/write-string (str sw) out options)))
 
+(def ^:private data-json-codec
+  "The default codec, using clojure.data.json library.
+
+  See `codec`."
+  {:name :data-json
+   :read (fn [^chars buf offset len]
+           (json/read (java.io.PushbackReader. (java.io.CharArrayReader. buf offset len) 64)
+                      :key-fn keyword))
+   :write (fn [x out]
+            (json/write x out :escape-slash false))
+   :write-lenient (fn [x out]
+                    (json/write x out :escape-slash false
+                                :default-write-fn json-default-write))})
+
+(defn- codec
+  "Return the codec specified by C, the value of :codec key of the plugin.
+
+  A codec is what we use to parse the requests we receive from
+  lightningd and to serialize what we send to lightningd.  This is
+  a map with the following keys:
+
+  - :name:          the name of the codec,
+  - :read:          a function of [buf offset len] returning the JSON
+                    value in the LEN chars of char array BUF starting at
+                    OFFSET, with JSON objects as maps with keyword keys,
+  - :write:         a function of [x out] writing X as JSON to OUT, a
+                    java.io.Writer.  It must throw an exception if X
+                    contains objects it doesn't know how to write,
+  - :write-lenient: like :write but writing the objects it doesn't
+                    know how to write as strings.  Used to report
+                    responses that :write failed to write.  See
+                    `write-resp`.
+
+  Non ASCII chars must be escaped by :write and :write-lenient.
+
+  C can be:
+
+  - nil or :data-json: the default codec using clojure.data.json
+                       library (see `data-json-codec`),
+  - :jackson:          a faster codec using Jackson streaming parser
+                       and generator which also caches the keywords
+                       of the keys of the objects it parses.  Add
+                       com.fasterxml.jackson.core/jackson-core to your
+                       dependencies to use it.  See `clnplugin-clj.jackson`
+                       namespace,
+  - a codec map as described above.
+
+  For instance, the following plugin uses Jackson:
+
+      {:codec :jackson
+       ,,,}"
+  [c]
+  (cond
+    (or (nil? c) (= c :data-json)) data-json-codec
+    (= c :jackson)
+    (let [v (try
+              (requiring-resolve 'clnplugin-clj.jackson/codec)
+              (catch Exception e
+                (throw (ex-info (format "Jackson codec requires com.fasterxml.jackson.core/jackson-core dependency: %s"
+                                        (ex-message e)) {}))))]
+      @v)
+    (and (map? c) (every? #(fn? (get c %)) [:read :write :write-lenient])) c
+    true (throw (ex-info (format "Wrong :codec '%s'.  Authorized codecs are: :data-json, :jackson or a map with :read, :write and :write-lenient functions."
+                                 c) {}))))
+
+(def ^:private default-error-max-chars
+  "Default maximum number of chars of the copies of requests and
+  responses we put in error messages.  See `error-max-chars`."
+  2048)
+
+(defn- error-max-chars
+  "Return the maximum number of chars of the copies of requests and responses in errors.
+
+  When a request fails, we report it to lightningd in the error
+  response and in the logs with a copy of the request, and if the
+  response is not JSON writable, with a copy of the response (see
+  `error-resp` and `write-resp`).  To not double the memory used by
+  huge requests (\"htlc_accepted\" hooks with big onions,
+  \"listpeerchannels\" results, ...) and not flood the logs, these
+  copies are truncated to the value of :error-max-chars key of the
+  plugin P, default to `default-error-max-chars`:
+
+      {:error-max-chars 512
+       ,,,}
+
+  See `truncated-str`."
+  [p]
+  (let [n (:error-max-chars p default-error-max-chars)]
+    (if (pos-int? n)
+      n
+      (throw (ex-info (format "Wrong :error-max-chars '%s'.  It must be a positive integer." n) {})))))
+
+(defn- print-bounded
+  "Return [s truncated?] vector where s is X printed as by `str` up to MAX-CHARS chars.
+
+  If X is not a string, it is printed with `print-method` into
+  a writer that stops the printing once MAX-CHARS chars have been
+  written, so we never hold the whole printed form of X in memory.
+  truncated? is true if X didn't fit in MAX-CHARS chars."
+  [x max-chars]
+  (let [max-chars (long max-chars)
+        sb (StringBuilder.)
+        full (Exception. "max-chars reached")
+        add! (fn [^CharSequence cs start end]
+               (let [room (- max-chars (.length sb))]
+                 (.append sb cs (int start) (int (min end (+ start room))))
+                 (when (> (- end start) room)
+                   (throw full))))
+        w (proxy [java.io.Writer] []
+            (write
+              ([x]
+               (cond
+                 (integer? x) (add! (str (char x)) 0 1)
+                 (string? x) (add! x 0 (count x))
+                 true (add! (String. ^chars x) 0 (alength ^chars x))))
+              ([x off len]
+               (if (string? x)
+                 (add! x off (+ off len))
+                 (add! (String. ^chars x (int off) (int len)) 0 len))))
+            (flush [])
+            (close []))]
+    (try
+      (if (string? x)
+        (.write ^java.io.Writer w ^String x)
+        (print-method x w))
+      [(str sb) false]
+      (catch Exception e
+        (if (identical? e full)
+          [(str sb) true]
+          (throw e))))))
+
+(defn- truncated-str
+  "Return X printed as by `str` and truncated to MAX-CHARS chars.
+
+  If X doesn't fit in MAX-CHARS chars, \"...(truncated)\" is appended.
+  This is how we print requests, responses and exceptions in error
+  messages.  See `error-max-chars` and `print-bounded`."
+  [x max-chars]
+  (let [[s truncated?] (print-bounded x max-chars)]
+    (if truncated? (str s "...(truncated)") s)))
+
+(defn- truncated
+  "Return X if it is printed in MAX-CHARS chars or less, X printed and truncated if not.
+
+  See `truncated-str`."
+  [x max-chars]
+  (let [[s truncated?] (print-bounded x max-chars)]
+    (if truncated? (str s "...(truncated)") x)))
+
+(defn- tracer
+  "Return the function to call with the span of each request, nil if P doesn't trace them.
+
+  P is the plugin map.  Its requests are traced if it has a :trace-fn
+  key or a :jfr key set to true:
+
+      {:trace-fn (fn [span] ,,,)
+       :jfr true
+       ,,,}
+
+  The span of a request is a map with the following keys:
+
+  - :id:         id of the request as set by lightningd, for instance
+                 \"cli:foo#49479/cln:foo#66752\" which describes the
+                 chain of calls that lead to it.  nil for notifications,
+  - :method:     method of the request or topic of the notification,
+  - :outcome:    :ok, :error (:fn threw), :timeout (:timeout-ms expired),
+                 :rejected or :dropped (see :shedding in `scheduler`),
+  - :read-ns:    time to parse the request,
+  - :queue-ns:   time spent in the scheduler's queue (0 for :inline
+                 methods),
+  - :handler-ns: time from the call of :fn to its result (or the
+                 completion of its async value, see `process-async`),
+  - :write-ns:   time to serialize the response, absent for notifications.
+
+  :trace-fn is called with the span once the response has been
+  serialized (on the writer thread, see `writer`), or once :fn
+  returned for notifications.  It must return quickly and its
+  exceptions are ignored.
+
+  If :jfr is true, we also commit a \"clnplugin.Request\" Java Flight
+  Recorder event per span.  See `clnplugin-clj.jfr` namespace.
+
+  If P traces no request, requests carry no span and tracing costs
+  nothing.  Notifications of :batch subscriptions and the requests
+  received before the init request completed are not traced.
+
+  See `traced` and `end-span!`."
+  [p]
+  (let [trace-fn (:trace-fn p)
+        jfr (when (:jfr p)
+              (let [v (try
+                        (requiring-resolve 'clnplugin-clj.jfr/tracer)
+                        (catch Throwable e
+                          (throw (ex-info (format "JFR events require JDK 11 or above: %s" (ex-message e)) {}))))]
+                (@v)))]
+    (when-not (or (nil? trace-fn) (fn? trace-fn))
+      (throw (ex-info (format "Wrong :trace-fn '%s'.  It must be a function." trace-fn) {})))
+    (cond
+      (and trace-fn jfr) (fn [span] (jfr span) (trace-fn span))
+      true (or trace-fn jfr))))
+
+(defn- traced
+  "Return REQ with a span to be passed to TRACER, or REQ if TRACER is nil.
+
+  The span is a volatile map in the metadata of REQ, so it follows
+  REQ through the scheduler, the executors and the writer without
+  changing REQ's value.  READ-NS is the time it took to parse REQ.
+  See `tracer`."
+  [req read-ns tracer]
+  (if tracer
+    (with-meta req {::span (volatile! {:id (:id req) :method (:method req)
+                                       :read-ns read-ns :start-ns (System/nanoTime)})
+                    ::tracer tracer})
+    req))
+
+(defn- span
+  "Return the span of REQ (a volatile map), nil if REQ is not traced.  See `traced`."
+  [req]
+  (::span (meta req)))
+
+(defn- end-span!
+  "Call the tracer of REQ with its span if REQ is traced.  See `tracer`."
+  [req]
+  (let [m (meta req)]
+    (when-let [s (::span m)]
+      (try
+        ((::tracer m) (dissoc @s :start-ns))
+        ;; a failing tracer must not stop the writer
+        (catch Throwable _)))))
+
 (defn- log-
   "Send \"log\" notification to lightningd with debug \"level\" and MSG \"message\".
 
@@ -628,63 +995,111 @@
   they use `log-` (and also `json-default-write`) to report of this fact.
 
   You should not use `log-` to send \"log\" notification but \"log\"
-  function."
-  [msg out]
+  function.
+
+  The notifications are serialized with CODEC.  See `codec`."
+  [msg ^java.io.Writer out codec]
   (doseq [m (str/split-lines msg)]
     (let [notif (notif "log" {:level "debug" :message m})]
-      (json/write notif out :escape-slash false)
-      (. out (append "\n\n")) ;; required by lightningd
-      (. out (flush)))))
+      ((:write codec) notif out)
+      (.write out "\n\n")))) ;; required by lightningd
 
 (defn- write-resp
   "Write RESP to OUT.
 
-  If RESP contains non JSON writable objects, RESP is transformed into
-  a JSON RPC error with the following fields \"code\", \"message\",
-  \"exception\", \"request\" and \"response\" that we write to OUT instead
-  of RESP.
+  OUT is the java.io.StringWriter buffering what we write to
+  lightningd.  See `writer`.
+
+  RESP is serialized directly into OUT.  If RESP contains non JSON
+  writable objects, what has been written of RESP is removed from OUT
+  and RESP is transformed into a JSON RPC error with the following
+  fields \"code\", \"message\", \"exception\", \"request\" and \"response\"
+  that we write to OUT instead of RESP.
 
   See `gm-rpcmethods` docstring to understand why we do this.
 
+  RESP is serialized with CODEC.  See `codec`.
+
+  The copies of the request, the response and the exception in the
+  error are truncated to MAX-CHARS chars.  See `error-max-chars`.
+
   See also `log-` and `write`."
-  [req resp out]
-  (let [r (try
-            (json/write-str resp :escape-slash false)
-            (catch Exception e
-              (let [msg (format "Error while processing '%s', some objects in the response are not JSON writable" req)
-                    exception (exception e)
-                    error {:code -32603 :message msg :exception exception
-                           :request req :response resp}
-                    new-resp (assoc (dissoc resp :error :result) :error error) ]
-                (log- msg out)
-                (log- exception out)
-                (json/write-str new-resp :escape-slash false
-                                :default-write-fn json-default-write))))]
-    ;; an empty line after the r is expected by lightningd though not enforced
-    (. out (append (str r "\n\n")))
-    (. out (flush))))
+  [req resp ^java.io.StringWriter out codec max-chars]
+  (let [sb (.getBuffer out)
+        mark (.length sb)]
+    (try
+      ((:write codec) resp out)
+      (catch Exception e
+        (.setLength sb mark)
+        (let [msg (format "Error while processing '%s', some objects in the response are not JSON writable"
+                          (truncated-str req max-chars))
+              exception (truncated-str (exception e) max-chars)
+              error {:code -32603 :message msg :exception exception
+                     :request (truncated req max-chars)
+                     :response (truncated resp max-chars)}
+              new-resp (assoc (dissoc resp :error :result) :error error) ]
+          (log- msg out codec)
+          (log- exception out codec)
+          ((:write-lenient codec) new-resp out))))
+    ;; an empty line after the resp is expected by lightningd though not enforced
+    (.write out "\n\n")))
 
 (defn- write-notif
   "Write NOTIF to OUT.
 
+  OUT is the java.io.StringWriter buffering what we write to
+  lightningd.  See `writer`.
+
   If NOTIF contains non JSON writable objects, do not write NOTIF to OUT.
 
   Instead, we log NOTIF stringified and the exception thrown by the JSON
   writer.
 
+  NOTIF is serialized with CODEC.  See `codec`.  NOTIF and the
+  exception are truncated to MAX-CHARS chars in the logs.  See
+  `error-max-chars`.
+
   See `log-` and `write`."
-  [notif out]
-  (let [r (try
-            (json/write-str notif :escape-slash false)
-            (catch Exception e
-              (let [msg (format "Error while sending notification '%s', some objects are not JSON writable" notif)]
-                (log- msg out)
-                (log- (exception e) out)
-                nil)))]
-    (when r
-      ;; an empty line after the r is expected by lightningd though not enforced
-      (. out (append (str r "\n\n")))
-      (. out (flush)))))
+  [notif ^java.io.StringWriter out codec max-chars]
+  (let [sb (.getBuffer out)
+        mark (.length sb)]
+    (try
+      ((:write codec) notif out)
+      ;; an empty line after the notif is expected by lightningd though not enforced
+      (.write out "\n\n")
+      (catch Exception e
+        (.setLength sb mark)
+        (let [msg (format "Error while sending notification '%s', some objects are not JSON writable"
+                          (truncated-str notif max-chars))]
+          (log- msg out codec)
+          (log- (truncated-str (exception e) max-chars) out codec))))))
+
+(defn- write-failed
+  "Report to lightningd that writing RESP to OUT has failed with exception E.
+
+  This happens when the codec fails on something `write-resp` and
+  `write-notif` can't replace, a non finite double for instance.
+  We log the failure and, if REQ is non nil, we write instead of RESP
+  a JSON RPC error with REQ's id so that lightningd doesn't wait
+  forever for the response.  The error contains only strings, so
+  it can always be written.
+
+  REQ, RESP and E are truncated to MAX-CHARS chars.  See `write`."
+  [req resp e ^java.io.StringWriter out codec max-chars]
+  (let [msg (if req
+              (format "Error while writing the response to '%s': %s"
+                      (truncated-str req max-chars) (truncated-str resp max-chars))
+              (format "Error while writing notification '%s'"
+                      (truncated-str resp max-chars)))
+        exception (truncated-str (exception e) max-chars)]
+    (log- msg out codec)
+    (log- exception out codec)
+    (when (some? (:id req))
+      ((:write codec) {:jsonrpc "2.0"
+                       :id (:id req)
+                       :error {:code -32603 :message msg :exception exception}}
+       out)
+      (.write out "\n\n"))))
 
 (defn- write
   "Write to OUT the responses and notifications in RESPS collection.
@@ -715,23 +1130,342 @@
          :params {:level \"debug\"
                   :message \"Some message\"}}
 
-  That function is meant to be an action-fn we send to
-  an agent along with RESPS and OUT.  We use an agent to
-  synchronize writes to OUT.  Specifically, the agent
-  is the value of :_resps key of the plugin.
-
-  Note that to synchronize these writes, we don't need
-  to use the state of the agent which is passed as first
-  argument of any action-fn.  So the first argument of
-  `write` is ignored.
+  OUT is the java.io.StringWriter buffering what we write to
+  lightningd.  `write` doesn't flush anything, this is done by
+  the thread of `writer` once it has written all the RESPS it
+  found queued.
+
+  RESPS are serialized with CODEC, default to `data-json-codec`.
+  Requests and responses copied in errors are truncated to
+  ERROR-MAX-CHARS chars, default to `default-error-max-chars`.
+
+  If writing an element fails, what has been written of it is removed
+  from OUT, the failure is reported with `write-failed` and we go on
+  with the next elements.  The elements written before it in OUT are
+  kept.
+
+  If req is traced, the time to serialize resp is added to its span
+  which is then passed to its tracer.  See `tracer`.
+
+  If REGISTRY is non nil, the bytes of the response to req are
+  recorded in REGISTRY under req's method.  See `record-bytes!`.
+
+  See `write-resp`, `write-notif`, `writer`, `write!`, `log`,
+  `notify` and `run`."
+  ([resps out] (write resps out data-json-codec))
+  ([resps out codec] (write resps out codec default-error-max-chars))
+  ([resps out codec error-max-chars] (write resps out codec error-max-chars nil))
+  ([resps ^java.io.StringWriter out codec error-max-chars registry]
+   (let [sb (.getBuffer out)]
+     (doseq [[req resp] resps]
+       (let [mark (.length sb)
+             start (System/nanoTime)]
+         (try
+           (if (nil? req)
+             (write-notif resp out codec error-max-chars)
+             (do (write-resp req resp out codec error-max-chars)
+                 (when registry
+                   (record-bytes! registry (:method req) (- (.length sb) mark)))))
+           (catch Exception e
+             (.setLength sb mark)
+             (write-failed req resp e out codec error-max-chars)))
+         (when (span req)
+           (vswap! (span req) assoc :write-ns (- (System/nanoTime) start))
+           (end-span! req)))))))
+
+(defn- flush-buffer!
+  "Write to WRITER's :out the chars buffered in WRITER's :buf and flush :out.
+
+  Do nothing if nothing is buffered.  The chars written and the flushes
+  are counted in WRITER's :bytes-written and :flushes.  As we escape
+  non ASCII chars when serializing to JSON, one char is one byte."
+  [writer]
+  (let [{:keys [^java.io.StringWriter buf ^java.io.Writer out chars]} writer
+        sb (.getBuffer buf)
+        n (.length sb)]
+    (when (pos? n)
+      (when (< (alength ^chars @chars) n)
+        (vreset! chars (char-array (max n (* 2 (alength ^chars @chars))))))
+      (let [^chars cs @chars]
+        (.getChars sb 0 n cs 0)
+        (.setLength sb 0)
+        (.write out cs 0 n)
+        (.flush out)
+        (.add ^LongAdder (:bytes-written writer) n)
+        (.increment ^LongAdder (:flushes writer))))))
+
+(defn- write-loop
+  "Write forever to WRITER's :out what is queued in WRITER's :queue.
+
+  Each time we wake up, we take all the elements queued so far (the
+  batch), serialize them in WRITER's :buf with `write` and flush :buf
+  to :out with `flush-buffer!` at the end of the batch.  So however
+  many responses and notifications are in the batch, they cost only
+  one write and one flush to :out.  To not delay the first elements of
+  a big batch too much, we also flush :buf each time WRITER's
+  :latency-ms is exceeded while writing the batch.
+
+  Elements in :queue are either collections of [req resp] vectors to
+  be passed to `write`, CountDownLatch queued by `drain!` that we
+  count down once what was queued before them has been flushed, or
+  ::closed queued by `close-writer!` after which we return.
+
+  See `writer`."
+  [writer]
+  (let [{:keys [^LinkedBlockingQueue queue ^java.io.StringWriter buf latency-ms codec registry]} writer
+        sb (.getBuffer buf)
+        latency-ns (* 1000000 latency-ms)
+        batch (java.util.ArrayList.)
+        closed (volatile! false)]
+    (loop []
+      (.add batch (.take queue))
+      (.drainTo queue batch)
+      (let [deadline (volatile! (+ (System/nanoTime) latency-ns))
+            flush! (fn []
+                     (flush-buffer! writer)
+                     (vreset! deadline (+ (System/nanoTime) latency-ns)))]
+        (doseq [item batch]
+          (let [mark (.length sb)]
+            (try
+              (cond
+                (instance? CountDownLatch item)
+                (try (flush!) (finally (.countDown ^CountDownLatch item)))
+                (= item ::closed) (vreset! closed true)
+                true (do (write item buf codec (:error-max-chars writer) registry)
+                         (when (> (System/nanoTime) @deadline) (flush!))))
+              ;; We can't report an error writing to :out (lightningd has
+              ;; probably closed the connection), but the writer must keep
+              ;; going to not block `drain!` callers.  Errors serializing
+              ;; ITEM are reported by `write`, so we only get here if
+              ;; reporting them failed too, in which case we remove what
+              ;; has been written of ITEM but keep the items before it.
+              (catch Exception _
+                (.setLength sb (min mark (.length sb)))))))
+        ;; `flush-buffer!` empties :buf before writing to :out
+        (try (flush!) (catch Exception _)))
+      (.clear batch)
+      (when-not @closed
+        (recur)))))
 
-  See `write-resp`, `write-notif`, `log`, `notify`, `run`
-  `clojure.core/agent` and `clojure.core/send`."
-  [_ resps out]
-  (doseq [[req resp] resps]
-    (if req
-      (write-resp req resp out)
-      (write-notif resp out))))
+(defn- writer
+  "Return a writer of responses and notifications to OUT and start its thread.
+
+  OUT is the java.io.Writer connected to lightningd, `*out*` in the
+  default execution of the plugin.
+
+  The writer is the only one writing to OUT, so messages are never
+  interleaved and are written in the order they are queued with `write!`.
+  Its thread serializes the messages into a reusable buffer and
+  flushes it to OUT once per batch of messages queued since the last
+  flush, or each time LATENCY-MS (default to 5ms) is exceeded.  See
+  `write-loop`.
+
+  Messages are serialized with CODEC, default to `data-json-codec`.
+  See `codec`.  Copies of requests and responses in errors are
+  truncated to ERROR-MAX-CHARS chars.  See `error-max-chars`.
+
+  If REGISTRY is non nil, the bytes of each response are recorded in
+  REGISTRY under the method of its request.  See `metrics-registry`.
+
+  The writer is the value of :_writer key of the plugin.  See `run`."
+  ([out] (writer out 5))
+  ([out latency-ms] (writer out latency-ms data-json-codec))
+  ([out latency-ms codec] (writer out latency-ms codec default-error-max-chars))
+  ([out latency-ms codec error-max-chars] (writer out latency-ms codec error-max-chars nil))
+  ([out latency-ms codec error-max-chars registry]
+   (let [w {:queue (LinkedBlockingQueue.)
+            :buf (java.io.StringWriter. 65536)
+            :chars (volatile! (char-array 65536))
+            :out out
+            :latency-ms latency-ms
+            :codec codec
+            :error-max-chars error-max-chars
+            ;; see metrics
+            :registry registry
+            :bytes-written (LongAdder.)
+            :flushes (LongAdder.)}]
+     (doto (Thread. ^Runnable (fn [] (write-loop w)) "clnplugin-writer")
+       (.setDaemon true)
+       (.start))
+     w)))
+
+(defn- write!
+  "Queue RESPS to be written to lightningd by WRITER.
+
+  RESPS is a collection of [req resp] vectors.  See `write`."
+  [writer resps]
+  (.put ^LinkedBlockingQueue (:queue writer) resps))
+
+(defn- drain!
+  "Block until everything queued in WRITER so far has been written and flushed."
+  [writer]
+  (let [latch (CountDownLatch. 1)]
+    (.put ^LinkedBlockingQueue (:queue writer) latch)
+    (.await latch)))
+
+(defn- close-writer!
+  "Stop the thread of WRITER once everything queued so far has been written and flushed.
+
+  What is queued after is never written.  See `run`."
+  [writer]
+  (.put ^LinkedBlockingQueue (:queue writer) ::closed))
+
+(def ^:private log-levels
+  "Rank of the log levels of lightningd, from the least to the most severe.
+
+  As per common/status_levels.c file in lightning repository."
+  {"io" 0 "debug" 1 "info" 2 "unusual" 3 "warn" 3 "broken" 4 "error" 4})
+
+(defn- min-log-level
+  "Return the rank of the least severe log level P sends to lightningd.
+
+  P is the plugin map.  The level is the value of its :log-level key
+  if set.  If not, this is the log-level of lightningd, stored under
+  :_log-level key once we got it with `node-log-level!` just after
+  the init round, as lightningd doesn't send it in the init request.
+  Until then, or if we couldn't get it, we send everything and
+  lightningd filters the messages.  Levels can be specified as in
+  lightningd's log-level option, so \"info\" and
+  \"info:plugin-myplugin\" are both \"info\" for us.  If the level
+  is unknown, we send everything.
+
+  See `log-levels`."
+  [p]
+  (if-let [level (or (:log-level p) (:_log-level p))]
+    (get log-levels (first (str/split level #":" 2)) 0)
+    0))
+
+(defn log-enabled?
+  "Return true if messages of LEVEL are sent to lightningd by `log`.
+
+  Messages less severe than the log level of PLUGIN are dropped by
+  `log` (see `min-log-level`).  Use `log-enabled?` to not build
+  messages that would be dropped, for instance like this:
+
+      (when (plugin/log-enabled? \"debug\" plugin)
+        (plugin/log (format \"state: %s\" (expensive-state)) \"debug\" plugin))"
+  [level plugin]
+  (>= (long (get log-levels level 2)) (long (min-log-level @plugin))))
+
+(defn- log-limiter
+  "Return the state of the rate limiter of `log` for LOG-RATE-LIMIT.
+
+  LOG-RATE-LIMIT is the value of :log-rate-limit key of the plugin.
+  For instance, with the following plugin
+
+      {:log-rate-limit {:messages 10 :per-ms 1000}
+       ,,,}
+
+  each call site of `log` in the plugin (a file and a line) can send
+  at most 10 messages per second.  Messages above this limit are
+  dropped and counted, and once the next second starts, the first
+  message of that call site is preceded by a message reporting how
+  many messages have been suppressed.  If that call site doesn't log
+  anymore, the message is sent at the end of the second with the
+  \"unusual\" level (see `flush-suppressed!`), so suppressed messages
+  of a burst followed by silence are reported too.
+
+  Return nil if LOG-RATE-LIMIT is nil.  The state maps call sites
+  to atoms counting their messages in the current window.
+
+  See `allow-log!`."
+  [log-rate-limit]
+  (when log-rate-limit
+    (let [{:keys [messages per-ms]} log-rate-limit]
+      (when-not (and (pos-int? messages) (pos-int? per-ms))
+        (throw (ex-info (format "Wrong :log-rate-limit '%s'.  :messages and :per-ms must be positive integers."
+                                log-rate-limit) {})))
+      (ConcurrentHashMap.))))
+
+(defn- call-site
+  "Return the \"file:line\" of the code that called `log`.
+
+  This is the first frame of the stack that is not in `log` nor
+  in Clojure or Java runtime."
+  []
+  (.walk (StackWalker/getInstance)
+         (reify java.util.function.Function
+           (apply [_ frames]
+             (let [^java.lang.StackWalker$StackFrame f
+                   (-> ^java.util.stream.Stream frames
+                       (.filter (reify java.util.function.Predicate
+                                  (test [_ f]
+                                    (let [c (.getClassName ^java.lang.StackWalker$StackFrame f)]
+                                      (not (or (.startsWith c "clnplugin_clj$log")
+                                               (.startsWith c "clnplugin_clj$call_site")
+                                               (.startsWith c "clojure.")
+                                               (.startsWith c "java.")))))))
+                       (.findFirst)
+                       (.orElse nil))]
+               (if f
+                 (str (.getFileName f) ":" (.getLineNumber f))
+                 "unknown"))))))
+
+(defn- allow-log!
+  "Count a message of SITE in LIMITER and return [allowed? suppressed] vector.
+
+  allowed? is true if the message can be sent according to LOG-RATE-LIMIT.
+  suppressed is the number of messages of SITE dropped in the previous
+  window and not reported yet by `flush-suppressed!`, that we report
+  once when a new window starts.
+
+  See `log-limiter`."
+  [limiter site log-rate-limit]
+  (let [^ConcurrentHashMap m limiter
+        {:keys [messages per-ms]} log-rate-limit
+        a (or (.get m site)
+              (do (.putIfAbsent m site (atom {:start 0 :n 0 :suppressed 0}))
+                  (.get m site)))
+        now (System/currentTimeMillis)
+        [old new] (swap-vals! a (fn [{:keys [start n suppressed] :as w}]
+                                  (cond
+                                    (>= (- now start) per-ms) {:start now :n 1 :suppressed 0}
+                                    (< n messages) (assoc w :n (inc n))
+                                    true (assoc w :suppressed (inc suppressed)))))]
+    (if (not= (:start old) (:start new))
+      [true (:suppressed old)]
+      [(= (:suppressed old) (:suppressed new)) 0])))
+
+(defn- flush-suppressed!
+  "Report the messages of SITE suppressed by the rate limiter of PLUGIN not reported yet.
+
+  If START is not nil, we report them only if the window of SITE
+  still starts at START, i.e. if no message of SITE has been logged
+  since that window ended.  Otherwise `allow-log!` has reported them
+  with the first message of the new window.  We report them in an
+  \"unusual\" message, unless the log level of PLUGIN is more severe.
+
+  `log` schedules it at the end of the windows in which messages are
+  suppressed, and `run` calls it with nil START for all the call
+  sites when lightningd closes the connection.  See `log-limiter`."
+  [plugin site start]
+  (let [p @plugin
+        ^ConcurrentHashMap m (:_log-limiter p)
+        current? (fn [w] (or (nil? start) (= (:start w) start)))]
+    (when-let [a (and m (.get m site))]
+      (let [[old _] (swap-vals! a (fn [w] (if (current? w) (assoc w :suppressed 0) w)))
+            n (if (current? old) (:suppressed old) 0)]
+        (when (and (pos? n) (>= (long (get log-levels "unusual")) (long (min-log-level p))))
+          (write! (:_writer p)
+                  [[nil (notif "log" {:level "unusual"
+                                      :message (format "%s log messages suppressed at %s" n site)})]]))))))
+
+(defn- schedule-suppressed-flush!
+  "Schedule `flush-suppressed!` of SITE at the end of its current window.
+
+  We schedule it once per window, on the :timer executor of PLUGIN.
+  If PLUGIN has no executors (`run` not called), the messages are
+  reported when SITE logs again.  See `log-limiter`."
+  [plugin site log-rate-limit]
+  (let [p @plugin
+        ^ConcurrentHashMap m (:_log-limiter p)
+        [old new] (swap-vals! (.get m site) assoc :flush-scheduled true)]
+    (when-let [timer (and (not (:flush-scheduled old)) (:timer (:_executors p)))]
+      (.schedule ^ScheduledExecutorService timer
+                 ^Runnable (fn [] (flush-suppressed! plugin site (:start new)))
+                 (max 0 (- (+ (long (:start new)) (long (:per-ms log-rate-limit)))
+                           (System/currentTimeMillis)))
+                 TimeUnit/MILLISECONDS))))
 
 (defn log
   "Send a \"log\" notification to lightningd with LEVEL level.
@@ -746,19 +1480,47 @@
   - \"unusual\" (also \"warn\"),
   - \"broken\" (also \"error\").
 
+  If LEVEL is less severe than the log level of PLUGIN, by default
+  the log-level of lightningd (see `min-log-level`), nothing is sent.
+  For instance, the following plugin doesn't send \"io\" and
+  \"debug\" messages whatever the log-level of lightningd:
+
+      {:log-level \"info\"
+       ,,,}
+
+  See also `log-enabled?`.
+
+  If PLUGIN has a :log-rate-limit, the number of messages sent by
+  each call site of `log` is limited (see `log-limiter`).
+
   MESSAGE is a string.  If it contains multiple lines, it is split
   at newline separation and several \"log\" notifications are sent
   instead of one.  This is useful for sending exceptions when
-  our plugin stops working correctly and throws exceptions.
+  our plugin stops working correctly and throws exceptions.  All
+  these notifications are queued at once, so they are written
+  together without being interleaved with other messages.
 
   See `exception`, `write`, `write-resp`, `write-notif` and `run`."
   ([message plugin]
    (log message "info" plugin))
   ([message level plugin]
    {:pre [(string? message)]}
-   (let [notifs (map #(vector nil (notif "log" {:level level :message %}))
-                     (str/split-lines message))]
-     (send (:_resps @plugin) write notifs (:_out @plugin)))
+   (let [p @plugin]
+     (when (>= (long (get log-levels level 2)) (long (min-log-level p)))
+       (let [{:keys [log-rate-limit _log-limiter]} p
+             site (when (and log-rate-limit _log-limiter) (call-site))
+             [allowed? suppressed] (if site
+                                     (allow-log! _log-limiter site log-rate-limit)
+                                     [true 0])
+             _ (when-not allowed?
+                 (schedule-suppressed-flush! plugin site log-rate-limit))
+             lines (concat
+                    (when (pos? suppressed)
+                      [(format "%s log messages suppressed at %s" suppressed site)])
+                    (when allowed? (str/split-lines message)))]
+         (when (seq lines)
+           (write! (:_writer p)
+                   (mapv #(vector nil (notif "log" {:level level :message %})) lines))))))
    nil))
 
 (defn notify
@@ -780,7 +1542,7 @@
 
   See `gm-resp` and `gm-notifications`."
   ([topic params plugin]
-   (send (:_resps @plugin) write [[nil (notif topic params)]] (:_out @plugin))
+   (write! (:_writer @plugin) [[nil (notif topic params)]])
    nil))
 
 (defn notify-message
@@ -953,10 +1715,360 @@
                   {:stage {:num stage :total total-stages}}))]
      (notify "progress" params plugin))))
 
-(defn- process
-  "Return [log-msgs resp] vector where resp is the response to REQ.
-
-  Specifically, we look for a method defined for REQ's :method
+(defn- dispatch-table
+  "Return the dispatch table of plugin map P.
+
+  The dispatch table maps the names (strings) of the methods the
+  plugin handles to their definition maps (the maps containing :fn):
+
+  - :requests maps the methods of :rpcmethods and :hooks maps,
+  - :notifications maps the topics of :subscriptions map, \"*\"
+    mapping the subscription to all topics if any.
+
+  This way, for each request we receive we find its method with one
+  lookup by the \"method\" field of the request, without merging
+  :rpcmethods and :hooks maps and without converting that field
+  into a keyword.
+
+  The table also keeps the :rpcmethods, :hooks and :subscriptions
+  maps it has been built from to know when it must be rebuilt.
+  See `lookup-method`."
+  [p]
+  (let [by-name (fn [m]
+                  (persistent!
+                   (reduce-kv (fn [t k v] (assoc! t (name k) v))
+                              (transient {}) (or m {}))))]
+    {:rpcmethods (:rpcmethods p)
+     :hooks (:hooks p)
+     :subscriptions (:subscriptions p)
+     :requests (by-name (merge (:rpcmethods p) (:hooks p)))
+     :notifications (by-name (:subscriptions p))
+     :hook-names (set (map name (keys (:hooks p))))}))
+
+(defn- dispatch-table!
+  "Return the dispatch table of PLUGIN.
+
+  The dispatch table (see `dispatch-table`) is cached in the volatile
+  :_dispatch-table of PLUGIN set by `run`.  It is rebuilt only when
+  :rpcmethods, :hooks or :subscriptions maps of PLUGIN have changed,
+  for instance when `process-init!` adds :setconfig method or when we
+  use `dev-set-rpcmethod`, `dev-set-hook` or `dev-set-subscription`.
+  If PLUGIN has no :_dispatch-table, the table is built for each call."
+  [plugin]
+  (let [p @plugin
+        cache (:_dispatch-table p)
+        cached (when cache @cache)]
+    (if (and cached
+             (identical? (:rpcmethods cached) (:rpcmethods p))
+             (identical? (:hooks cached) (:hooks p))
+             (identical? (:subscriptions cached) (:subscriptions p)))
+      cached
+      (let [t (dispatch-table p)]
+        (when cache (vreset! cache t))
+        t))))
+
+(defn- lookup-method
+  "Return the definition map of the method REQ is for.
+
+  If REQ has an :id, look for the method in :rpcmethods and :hooks
+  maps of PLUGIN.  If not, REQ is a notification and we look for
+  the topic in :subscriptions map, defaulting to :* subscription.
+
+  See `dispatch-table!`."
+  [req plugin]
+  (let [table (dispatch-table! plugin)
+        m (:method req)]
+    (if (:id req)
+      (get (:requests table) m)
+      (let [notifs (:notifications table)]
+        (or (get notifs m) (get notifs "*"))))))
+
+(defn- response-caches
+  "Return the response caches of the RPC methods of plugin map P.
+
+  An RPC method whose result only depends on its params can declare
+  a :cache, so that repeated calls with the same params are answered
+  without calling its :fn (see `process`).  For instance, with the
+  following plugin
+
+      {:rpcmethods
+       {:invoice-summary
+        {:cache {:ttl-ms 5000
+                 :max-entries 10000
+                 :keys [:label :status]
+                 :invalidate-on [\"invoice_payment\" \"invoice_creation\"]}
+         :fn (fn [params req plugin] ,,,)}}
+       ,,,}
+
+  the result of \"invoice-summary\" for some params is reused during
+  5 seconds, the cache keeps the results of at most 10000 different
+  params (the least recently used are evicted first, :max-entries
+  defaults to 1024), and the whole cache is cleared each time we
+  receive an \"invoice_payment\" or \"invoice_creation\" notification
+  (see `invalidate-caches!`).  We subscribe to those topics for you if
+  they are not in :subscriptions map (see `set-defaults!`).
+
+  If :keys is specified, params are normalized with `params->map`,
+  so the same call made with positional params and with named
+  params shares the same entry.  In any case, params with nil
+  values are ignored.
+
+  Return a map with:
+
+  - :by-method: the cache of each method (by name) declaring a :cache,
+  - :by-topic:  the caches to clear for each notification topic.
+
+  Only :rpcmethods can be cached.  The caches are built by `run` once
+  the methods have been checked in the getmanifest round."
+  [p]
+  (let [caches (into {}
+                     (for [[kw-name method] (:rpcmethods p)
+                           :let [cache (:cache method)]
+                           :when cache]
+                       (let [max-entries (long (or (:max-entries cache) 1024))]
+                         [(name kw-name)
+                          (merge cache
+                                 {;; access ordered, so the eldest entry is
+                                  ;; the least recently used one
+                                  :entries (proxy [java.util.LinkedHashMap] [16 0.75 true]
+                                             (removeEldestEntry [_]
+                                               (> (.size ^java.util.Map this) max-entries)))
+                                  :loading (ConcurrentHashMap.)
+                                  :generation (AtomicLong. 0)
+                                  :hits (LongAdder.)
+                                  :misses (LongAdder.)})])))]
+    {:by-method caches
+     :by-topic (reduce-kv (fn [m _ cache]
+                            (reduce #(update %1 (name %2) (fnil conj []) cache)
+                                    m (:invalidate-on cache)))
+                          {} caches)}))
+
+(defn- cache-key
+  "Return the key of PARAMS in CACHE.  See `response-caches`."
+  [cache params]
+  (let [ks (:keys cache)
+        p (if ks (params->map ks params) params)]
+    (cond
+      (map? p) (into {} (remove (comp nil? val)) p)
+      (or (nil? p) (and (sequential? p) (empty? p))) {}
+      true p)))
+
+(defn- invalidate-caches!
+  "Clear the response caches invalidated by NOTIF notification.
+
+  These are the caches of RPC methods with the topic of NOTIF in
+  their :invalidate-on vector.  This is called by `run` as soon as
+  NOTIF is read, before it waits in the scheduler's queue.
+
+  See `response-caches`."
+  [notif plugin]
+  (doseq [cache (get-in @plugin [:_caches :by-topic (:method notif)])]
+    (let [{:keys [^java.util.Map entries ^AtomicLong generation]} cache]
+      (locking entries
+        (.incrementAndGet generation)
+        (.clear entries)))))
+
+(defn- error-resp
+  "Return [log-msgs resp] vector for REQ whose :fn threw E.
+
+  log-msgs is a vector of messages we want to log to report E and
+  resp is the JSON RPC error response (a Clojure map still) to REQ,
+  nil if REQ is a notification.
+
+  If E is a `clojure.lang.ExceptionInfo` with an :error key in its
+  data, this error map is merged into the :error field of resp.
+  See `gm-rpcmethods`.
+
+  This is only called when :fn failed, so processing a request that
+  succeeds never prints it.  REQ and E are printed truncated to
+  MAX-CHARS chars, default to `default-error-max-chars`.  See
+  `error-max-chars`."
+  ([req e] (error-resp req e default-error-max-chars))
+  ([req e max-chars]
+   (let [req-id (:id req)
+         msg (format "Error while processing '%s'" (truncated-str req max-chars))
+         jsonrpc {:jsonrpc "2.0" :id req-id}]
+     (if (instance? clojure.lang.ExceptionInfo e)
+       (let [error (merge {:code -32603 :message msg} (:error (ex-data e)))]
+         [[msg (truncated-str error max-chars)] (when req-id (merge jsonrpc {:error error}))])
+       (let [exception (truncated-str (exception e) max-chars)]
+         [[msg exception]
+          (when req-id (merge jsonrpc {:error {:code -32603 :message msg :exception exception}}))])))))
+
+(defn- async-value?
+  "Return true if X is a value :fn can return to respond later.
+
+  This is the case of core.async channels, java.util.concurrent.CompletionStage
+  (CompletableFuture, ...) and promises (or futures).  See `process-async`."
+  [x]
+  (or (instance? java.util.concurrent.CompletionStage x)
+      (instance? clojure.core.async.impl.protocols.ReadPort x)
+      (and (instance? clojure.lang.IBlockingDeref x)
+           (instance? clojure.lang.IPending x))))
+
+(defn- pending-derefs
+  "Return the state of the promises we wait for without blocking a thread.
+
+  This is a map with:
+
+  - :queue: a queue of [x f] vectors where x is a promise (or a
+            future) and f the function to call once x has been
+            delivered,
+  - :timer: the java.util.concurrent.ScheduledExecutorService on which
+            we poll :queue every millisecond with `poll-pending-derefs!`,
+  - :task:  an atom holding the polling task, nil when not polling.
+
+  We poll :queue only while it is not empty: promises are added with
+  `add-pending-deref!` which starts the polling if needed, and
+  `poll-pending-derefs!` stops it once :queue is empty.  So a plugin
+  with no promise to wait for never wakes up.
+
+  `run` creates it with the :timer executor.  See `on-complete!`."
+  [timer]
+  {:queue (java.util.concurrent.ConcurrentLinkedQueue.)
+   :timer timer
+   :task (atom nil)})
+
+(defn- deref-result
+  "Return [value nil] vector with the value of X or [nil e] if dereferencing X threw E."
+  [x]
+  (try
+    [(deref x) nil]
+    (catch java.util.concurrent.ExecutionException e [nil (or (.getCause e) e)])
+    (catch Throwable e [nil e])))
+
+(defn- poll-pending-derefs!
+  "Call the functions of the promises that have been delivered in PENDING.
+
+  Stop polling PENDING if no promise is left.  See `pending-derefs`."
+  [pending]
+  (let [{:keys [^java.util.concurrent.ConcurrentLinkedQueue queue task]} pending
+        it (.iterator queue)]
+    (while (.hasNext it)
+      (let [[x f] (.next it)]
+        (when (realized? x)
+          (.remove it)
+          (let [[v e] (deref-result x)]
+            ;; an exception would stop the polling
+            (try (f v e) (catch Throwable _))))))
+    ;; promises are added before `add-pending-deref!` takes the
+    ;; lock, so none can be left unpolled
+    (locking task
+      (when (.isEmpty queue)
+        (when-let [^Future t @task]
+          (.cancel t false)
+          (reset! task nil))))))
+
+(defn- add-pending-deref!
+  "Add promise X to PENDING so that (F value nil) is called once X is delivered.
+
+  Start polling PENDING if not already polling.  See `pending-derefs`."
+  [pending x f]
+  (let [{:keys [^java.util.concurrent.ConcurrentLinkedQueue queue
+                ^ScheduledExecutorService timer task]} pending]
+    (.add queue [x f])
+    (locking task
+      (when-not @task
+        (reset! task (.scheduleWithFixedDelay timer
+                                              ^Runnable (fn [] (poll-pending-derefs! pending))
+                                              1 1 TimeUnit/MILLISECONDS))))))
+
+(defn- on-complete!
+  "Call (F value nil) once X completes with value, or (F nil e) if it fails with E.
+
+  X is a value for which `async-value?` is true:
+
+  - a java.util.concurrent.CompletionStage which fails if completed
+    exceptionally,
+  - a core.async channel whose first value is taken.  If it is a
+    Throwable, X fails with it.  If the channel is closed without
+    value, X completes with nil,
+  - a promise (or a future).  As we can't be notified when it is
+    delivered, we add it to the :_pending-derefs of PLUGIN polled
+    while not empty (see `pending-derefs`).  If PLUGIN has none, we
+    wait for it on a core.async thread."
+  [x plugin f]
+  (cond
+    (instance? java.util.concurrent.CompletionStage x)
+    (.whenComplete ^java.util.concurrent.CompletionStage x
+                   (reify java.util.function.BiConsumer
+                     (accept [_ v e]
+                       (if e
+                         (f nil (if (instance? java.util.concurrent.CompletionException e)
+                                  (or (.getCause ^Throwable e) e)
+                                  e))
+                         (f v nil)))))
+    (instance? clojure.core.async.impl.protocols.ReadPort x)
+    (async/take! x (fn [v] (if (instance? Throwable v) (f nil v) (f v nil))))
+    true
+    (if-let [pending (:_pending-derefs @plugin)]
+      (add-pending-deref! pending x f)
+      (thread (let [[v e] (deref-result x)] (f v e))))))
+
+(defn- cached-result
+  "Return the result for PARAMS from CACHE, calling F if not cached.
+
+  If the result for PARAMS is in CACHE and is younger than :ttl-ms
+  of CACHE, it is returned.  If not, we call F (which calls the :fn
+  of the method) and we store its result in CACHE unless F throws.
+
+  If F returns an async value (see `async-value?`), we wait for it
+  with `on-complete!` and store the value it completes with, never
+  the async value itself: a core.async channel can be taken only once
+  and a CompletableFuture may fail later.  In that case we return a
+  CompletableFuture completed with the same value, or failing with
+  the same exception, which is not stored either.
+
+  Concurrent calls with the same params while F is running don't
+  call F again.  They get a CompletableFuture completed with the
+  result of the running call, or failing with its exception.  So
+  :misses of CACHE counts the calls of F and :hits the other calls.
+
+  A result computed while the cache was cleared by `invalidate-caches!`
+  is returned but not stored, as it may be stale.
+
+  See `response-caches` and `process-async`."
+  [cache params f plugin]
+  (let [{:keys [^java.util.Map entries ^ConcurrentHashMap loading ^AtomicLong generation
+                ^LongAdder hits ^LongAdder misses ttl-ms]} cache
+        k (cache-key cache params)
+        entry (locking entries (.get entries k))]
+    (if (and entry (< (System/nanoTime) (long (:expires-at entry))))
+      (do (.increment hits)
+          (:result entry))
+      (let [loaded (java.util.concurrent.CompletableFuture.)
+            running (.putIfAbsent loading k loaded)]
+        (if running
+          (do (.increment hits)
+              running)
+          (let [gen (.get generation)
+                loaded! (fn [result]
+                          (locking entries
+                            (when (= gen (.get generation))
+                              (.put entries k {:result result
+                                               :expires-at (+ (System/nanoTime) (* 1000000 (long ttl-ms)))})))
+                          (.remove loading k)
+                          (.complete loaded result))
+                failed! (fn [e]
+                          (.remove loading k)
+                          (.completeExceptionally loaded e))]
+            (.increment misses)
+            (let [result (try
+                           (f)
+                           (catch Throwable e
+                             (failed! e)
+                             (throw e)))]
+              (if (async-value? result)
+                (do (on-complete! result plugin (fn [v e] (if e (failed! e) (loaded! v))))
+                    loaded)
+                (do (loaded! result)
+                    result)))))))))
+
+(defn- process-async
+  "Process REQ and call RESPOND with [log-msgs resp] vector once done.
+
+  resp is the response to REQ.  Specifically, we look for a method
+  defined for REQ's :method
 
   - in PLUGIN's :rpcmethods map,
   - in PLUGIN's :hooks map and
@@ -968,52 +2080,165 @@
   1) if no exception is thrown, :fn's result becomes the value of
      :result field of the JSON RPC response (a Clojure map still) resp
      and log-msgs is set to nil because we have nothing to log.  So
-     in that case `process` returns [nil resp] vector.
+     in that case we call RESPOND with [nil resp] vector.
 
   2) if an exception is thrown, we catch it, create a vector log-msgs
      of messages we want to log to report this exception and we
      create an error map that becomes the value of :error field of the
-     JSON RPC response (a Clojure map still) resp.  Finally, we
-     return [log-msgs resp] vector.
+     JSON RPC response (a Clojure map still) resp (see `error-resp`).
+     Finally, we call RESPOND with [log-msgs resp] vector.
+
+  :fn can also return a core.async channel, a CompletableFuture (any
+  java.util.concurrent.CompletionStage) or a promise, in which case
+  we call RESPOND only when this value completes (see `on-complete!`),
+  on the thread completing it.  Its value becomes the :result of
+  resp, or, if it fails, we handle its exception as in 2).  For
+  instance, this method waits for a long-poll lightningd call without
+  holding a thread:
+
+      {:rpcmethods
+       {:wait-payment
+        {:fn (fn [params req plugin]
+               (let [ch (async/chan)]
+                 (some-rpc-client/call-async \"waitinvoice\" params
+                                             #(async/put! ch %))
+                 ch))}}}
+
+  Until then, REQ counts against the concurrency limits of the
+  scheduler (see `dispatch`).
+
+  For notifications, resp is nil.
+
+  The method is looked up with `lookup-method`.  If it is an RPC
+  method with a :cache, its result may come from its cache (see
+  `response-caches`).  If :fn returns an async value, the value it
+  completes with is cached, not the async value (see `cached-result`).
 
   See `gm-rpcmethods`, `log` and `run`."
-  [req plugin]
+  [req plugin respond]
   (let [req-id (:id req)
-        method (keyword (:method req))
-        method-fn (if req-id
-                    (get-in (merge (:rpcmethods @plugin) (:hooks @plugin))
-                            [method :fn])
-                    (when-let [subs (:subscriptions @plugin)]
-                      (or (get-in subs [method :fn])
-                          (get-in subs [:* :fn]))))
-        msg (format "Error while processing '%s'" req)
-        jsonrpc {:jsonrpc "2.0" :id req-id}]
-    (try
-      ;; nil because nothing to log
-      [nil (let [resp (merge jsonrpc {:result (method-fn (:params req) req plugin)})]
-             (when req-id resp))]
-      (catch clojure.lang.ExceptionInfo e
-        (let [error (merge {:code -32603 :message msg} (:error (ex-data e)))]
-          [[msg (format "%s" error)] (when req-id (merge jsonrpc {:error error}))]))
-      (catch Throwable e
-        [[msg (exception e)]
-         (when req-id (merge jsonrpc {:error {:code -32603 :message msg :exception (exception e)}}))]))))
+        method-fn (:fn (lookup-method req plugin))
+        cache (when req-id (get-in @plugin [:_caches :by-method (:method req)]))
+        ok (fn [result]
+             ;; nil because nothing to log
+             [nil (when req-id {:jsonrpc "2.0" :id req-id :result result})])
+        r (try
+            (let [params (:params req)
+                  result (if cache
+                           (cached-result cache params #(method-fn params req plugin) plugin)
+                           (method-fn params req plugin))]
+              (if (async-value? result)
+                (do (on-complete! result plugin
+                                  (fn [v e]
+                                    (respond (if e
+                                               (error-resp req e (error-max-chars @plugin))
+                                               (ok v)))))
+                    nil)
+                (ok result)))
+            (catch Throwable e
+              (error-resp req e (error-max-chars @plugin))))]
+    (when r
+      (respond r))))
+
+(defn- process
+  "Return [log-msgs resp] vector where resp is the response to REQ.
+
+  This is `process-async` waiting for the response, used where we
+  can wait: the notifications received before the init request and
+  the batches of notifications flushed when we exit.
+
+  See `process-async`."
+  [req plugin]
+  (let [r (promise)]
+    (process-async req plugin #(deliver r %))
+    @r))
+
+(defn- request-reader
+  "Return a reader of lightningd requests from IN to be used with `read`.
+
+  IN is a java.io.Reader, `*in*` in the default execution of the plugin.
+
+  Chars are read from IN by chunks into :buf char array which is
+  reused from one request to the next.  The chars of the next request
+  start at :start index and the chars read so far end at :end index.
+  :buf grows when a request doesn't fit in it, so it ends up being as
+  big as the biggest request received.
+
+  SIZE is the initial size of :buf, default to 65536 chars.
+
+  Requests are parsed with CODEC, default to `data-json-codec`.
+  See `codec`.  The time it took to parse the last request is
+  the first element of :read-ns long array.  See `tracer`."
+  ([in] (request-reader in 65536))
+  ([in size] (request-reader in size data-json-codec))
+  ([in size codec]
+   {:in in
+    :codec codec
+    :buf (volatile! (char-array size))
+    :start (volatile! 0)
+    :end (volatile! 0)
+    :read-ns (long-array 1)}))
+
+(defn- request-boundary
+  "Return the index of the first \"\\n\\n\" found in BUF between FROM and END indexes.
+
+  Return nil if not found."
+  [^chars buf from end]
+  (let [from (long from) end (long end)]
+    (loop [i from]
+      (cond
+        (>= (inc i) end) nil
+        (and (= (aget buf i) \newline) (= (aget buf (inc i)) \newline)) i
+        true (recur (inc i))))))
+
+(defn- fill!
+  "Read chars from RDR's :in at the end of RDR's :buf.
+
+  Before reading, the chars of the current request are moved at the
+  beginning of :buf and :buf is grown if it is full.
+
+  Return the number of chars read or -1 if the end of :in has
+  been reached."
+  [rdr]
+  (let [{:keys [^java.io.Reader in buf start end]} rdr
+        ^chars b @buf
+        s (long @start)
+        e (long @end)]
+    (when (pos? s)
+      (System/arraycopy b s b 0 (- e s))
+      (vreset! start 0)
+      (vreset! end (- e s)))
+    (when (= @end (alength b))
+      (let [bigger (char-array (* 2 (alength b)))]
+        (System/arraycopy b 0 bigger 0 (alength b))
+        (vreset! buf bigger)))
+    (let [^chars b @buf
+          e (long @end)
+          n (.read in b (int e) (int (- (alength b) e)))]
+      (when (pos? n) (vreset! end (+ e n)))
+      n)))
 
 (defn- read
-  "Read one lightningd JSON-RPC request from IN.
+  "Read one lightningd JSON-RPC request from RDR.
+
+  RDR is a request reader returned by `request-reader`.
 
   JSON fields are converted into keywords: \"id\" -> :id.
   We assumes lightningd requests end with an empty line \"\\n\\n\".
   Throw an error if the data read is not a valid JSON object.
 
-  In the default execution of the plugin, IN is `*in*`.  See `run`.
+  In the default execution of the plugin, RDR reads from `*in*`.  See `run`.
+
+  The request is parsed directly from the chars buffered in RDR, so
+  we don't build intermediate strings to read it, whatever its size
+  and its number of lines.  Blank lines before a request are ignored.
 
   Here an example.  Evaluating this expression
 
       (let [req-str \"{\\\"jsonrpc\\\":\\\"2.0\\\",\\\"id\\\":0,\\\"method\\\":\\\"foo\\\",\\\"params\\\":{}}\\n\\n\"]
           (with-open [in (-> (java.io.StringReader. req-str)
                              clojure.lang.LineNumberingPushbackReader.)]
-            (read in)))
+            (read (request-reader in))))
 
   gives us:
 
@@ -1038,104 +2263,1366 @@
 
   and so in that case `run` (the caller of `read`) doesn't need
   to exit itself and nothing special needs to be done by `read` either."
-  [in]
-  (binding [*in* in]
-    (loop [req-acc "" line (read-line)]
-      (cond
-        ;; This happens when we shutdown lightningd:
-        ;; - with `lightning-cli stop` or
-        ;; - by killing lightningd process.
-        (nil? line) nil
-        ;; lightningd requests end with an empty line "\n\n".
-        (empty? line) (try
-                        (json/read-str req-acc :key-fn keyword)
-                        (catch Exception e
-                          (throw
-                           (let [msg (format "Invalid token in json input: '%s'" req-acc)]
-                             (ex-info msg {:error {:code -32700 :message msg}})))))
-        true (let [next-line (read-line)]
-               (recur (str req-acc line) next-line))))))
-
+  [rdr]
+  (let [{:keys [buf start end codec ^longs read-ns]} rdr
+        read-fn (:read codec)]
+    (loop [scan @start]
+      ;; skip blank lines before the request
+      (let [^chars b @buf]
+        (while (and (< @start @end)
+                    (Character/isWhitespace (aget b (int @start))))
+          (vswap! start inc)))
+      (if-let [boundary (request-boundary @buf (max scan @start) @end)]
+        (let [^chars b @buf
+              s (long @start)
+              len (- (long boundary) s)]
+          (vreset! start (+ (long boundary) 2))
+          (try
+            (let [t (System/nanoTime)
+                  req (read-fn b s len)]
+              (when read-ns
+                (aset read-ns 0 (- (System/nanoTime) t)))
+              req)
+            (catch Exception e
+              (throw
+               (let [msg (format "Invalid token in json input: '%s'" (String. b (int s) (int len)))]
+                 (ex-info msg {:error {:code -32700 :message msg}}))))))
+        ;; "\n\n" not found, so we read more chars.  We don't look for
+        ;; it again in the chars already scanned (except the last one
+        ;; which can be the first \newline of the boundary).
+        (let [scanned (- (long @end) (long @start))]
+          ;; This happens when we shutdown lightningd:
+          ;; - with `lightning-cli stop` or
+          ;; - by killing lightningd process.
+          (when-not (neg? (fill! rdr))
+            (recur (+ (long @start) (max 0 (dec scanned))))))))))
+
+(defn- rpc-pool
+  "Return a pool of SIZE connections to lightningd.
+
+  We use it to send RPC requests to lightningd with `rpc-call`.
+  The pool is created by `run` before the init round and SIZE is
+  the value of :rpc-pool-size key of the plugin, default to 1:
+
+      {:rpc-pool-size 4
+       ,,,}
+
+  Connections to lightningd's socket file, set in :socket-file key
+  of the plugin by `process-init!`, are opened the first time they
+  are used and reopened if lightningd closed them.  Several requests can be in flight on
+  the same connection, the responses being matched to the requests
+  by their ids (see `rpc-connect`), so one connection is often enough
+  even when many handlers call lightningd at the same time.
+
+  Requests are serialized and responses parsed with CODEC (see `codec`)."
+  [size codec]
+  (when-not (pos-int? size)
+    (throw (ex-info (format "Wrong :rpc-pool-size '%s'.  It must be a positive integer." size) {})))
+  {:codec codec
+   :conns (vec (repeatedly size #(atom nil)))
+   :next (AtomicLong. 0)
+   :ids (AtomicLong. 0)})
+
+(defn- rpc-closed
+  "Return the exception reporting the connection to SOCKET-FILE is closed."
+  [socket-file cause]
+  (ex-info (format "Connection to lightningd '%s' closed" socket-file) {} cause))
+
+(defn- unix-socket-channel
+  "Return a java.nio.channels.SocketChannel connected to the unix socket SOCKET-FILE.
+
+  Unix domain socket channels are available since JDK 16.  As
+  clnplugin-clj must also run on older JDKs, we look up
+  java.net.UnixDomainSocketAddress and the UNIX protocol family by
+  reflection and throw an error if this is not possible.  So only
+  `rpc-call` requires JDK 16 or above."
+  [socket-file]
+  (let [[family address]
+        (try
+          [(Enum/valueOf StandardProtocolFamily "UNIX")
+           (.invoke (.getMethod (Class/forName "java.net.UnixDomainSocketAddress") "of"
+                                (into-array Class [String]))
+                    nil (object-array [socket-file]))]
+          (catch ClassNotFoundException _ nil)
+          (catch IllegalArgumentException _ nil))]
+    (when-not address
+      (throw (ex-info (format "Connecting to lightningd '%s' requires JDK 16 or above, not %s."
+                              socket-file (System/getProperty "java.version")) {})))
+    (let [^SocketChannel ch (.invoke (.getMethod SocketChannel "open" (into-array Class [ProtocolFamily]))
+                                     nil (object-array [family]))]
+      (try
+        (.connect ch ^SocketAddress address)
+        ch
+        (catch Throwable e
+          (.close ch)
+          (throw e))))))
+
+(defn- rpc-connect
+  "Open a connection of POOL to lightningd's SOCKET-FILE.
+
+  Return a map with the following keys:
+
+  - :channel: the java.nio.channels.SocketChannel of the connection,
+  - :pending: a map from the ids of the requests sent to lightningd
+              to the promises of their responses,
+  - :closed:  true once the connection has been closed.
+
+  A thread reads the responses of lightningd (which end with \"\\n\\n\"
+  as the requests we receive do, so we read them with `read`) and
+  delivers them to the promises in :pending.  When lightningd closes
+  the connection, the pending requests get an exception."
+  [pool socket-file]
+  (let [{:keys [codec]} pool
+        ch (unix-socket-channel socket-file)
+        in (Channels/newReader ch "UTF-8")
+        conn {:channel ch
+              :pending (ConcurrentHashMap.)
+              :closed (AtomicBoolean. false)}
+        rdr (request-reader in 65536 codec)]
+    (thread
+      (let [cause (try
+                    (loop [resp (read rdr)]
+                      (when resp
+                        (when-let [p (.remove ^ConcurrentHashMap (:pending conn) (:id resp))]
+                          (deliver p resp))
+                        (recur (read rdr))))
+                    (catch Exception e e))]
+        (.set ^AtomicBoolean (:closed conn) true)
+        (.close ch)
+        (doseq [p (vals (:pending conn))]
+          (deliver p (rpc-closed socket-file cause)))
+        (.clear ^ConcurrentHashMap (:pending conn))))
+    conn))
+
+(defn- rpc-conn!
+  "Return an open connection of POOL to SOCKET-FILE, opening it if needed.
+
+  Connections are used in turn."
+  [pool socket-file]
+  (let [{:keys [conns ^AtomicLong next]} pool
+        slot (nth conns (mod (.getAndIncrement next) (count conns)))]
+    (locking slot
+      (let [conn @slot]
+        (if (and conn (not (.get ^AtomicBoolean (:closed conn))))
+          conn
+          (reset! slot (rpc-connect pool socket-file)))))))
+
+(defn- close-rpc-pool!
+  "Close the connections of POOL.  See `rpc-pool`."
+  [pool]
+  (doseq [slot (:conns pool)]
+    (when-let [conn @slot]
+      (.set ^AtomicBoolean (:closed conn) true)
+      (.close ^SocketChannel (:channel conn)))))
+
+(defn rpc-call
+  "Send METHOD request with PARAMS to lightningd and return its result.
+
+  The request is sent through a connection of the pool the plugin
+  opens to lightningd (see `rpc-pool`), so we don't pay for a new
+  connection for each call.  For instance, in an RPC method of
+  our plugin, we can get the id of our node like this:
+
+      (:id (plugin/rpc-call plugin \"getinfo\"))
+
+  and create an invoice like this:
+
+      (plugin/rpc-call plugin \"invoice\"
+                       {:amount_msat 10000
+                        :label \"some-label\"
+                        :description \"some-description\"})
+
+  If lightningd replies with an error, we throw an exception whose
+  data is the :error of the response.  If TIMEOUT-MS is specified
+  and lightningd doesn't reply in TIMEOUT-MS milliseconds, we throw
+  an exception too.  If we can't connect to lightningd or the
+  connection is closed before we get the response, we throw the
+  exception returned by `rpc-closed` whose cause is the I/O error.
+
+  `rpc-call` can only be used after the init round with lightningd,
+  for instance in :init-fn or in :fn of methods.
+
+  PLUGIN is the plugin atom."
+  ([plugin method]
+   (rpc-call plugin method {} nil))
+  ([plugin method params]
+   (rpc-call plugin method params nil))
+  ([plugin method params timeout-ms]
+   (let [{pool :_rpc socket-file :socket-file} @plugin
+         _ (when-not (and pool socket-file)
+             (throw (ex-info "No connection to lightningd before the init round" {})))
+         ;; lightningd unreachable fails as a closed connection does
+         {:keys [^ConcurrentHashMap pending channel closed]}
+         (try
+           (rpc-conn! pool socket-file)
+           (catch java.io.IOException e
+             (throw (rpc-closed socket-file e))))
+         id (format "clnplugin-clj:%s#%s" method (.incrementAndGet ^AtomicLong (:ids pool)))
+         req {:jsonrpc "2.0" :id id :method method :params params}
+         buf (let [sw (java.io.StringWriter.)]
+               ((:write (:codec pool)) req sw)
+               (ByteBuffer/wrap (.getBytes (str sw) "UTF-8")))
+         p (promise)]
+     (.put pending id p)
+     (try
+       ;; the connection may have been closed since rpc-conn!
+       (when (.get ^AtomicBoolean closed)
+         (throw (rpc-closed socket-file nil)))
+       ;; requests of concurrent calls must not be interleaved.  We
+       ;; write to the channel directly, not with Channels/newWriter,
+       ;; which would wait for the reading thread blocked on the channel.
+       (locking channel
+         (while (.hasRemaining buf)
+           (.write ^SocketChannel channel buf)))
+       (let [resp (if timeout-ms (deref p timeout-ms ::timeout) @p)]
+         (cond
+           (= resp ::timeout)
+           (throw (ex-info (format "Timeout of %sms reached while calling '%s'" timeout-ms method) {}))
+           (instance? Throwable resp) (throw resp)
+           (:error resp)
+           (throw (ex-info (format "Error calling '%s': %s" method (get-in resp [:error :message]))
+                           (:error resp)))
+           true (:result resp)))
+       (catch java.io.IOException e
+         (throw (rpc-closed socket-file e)))
+       (finally (.remove pending id))))))
+
+(def ^:private node-log-level-timeout-ms
+  "Maximum time `node-log-level!` waits for lightningd's listconfigs response."
+  5000)
+
+(defn- node-log-level!
+  "Store the log-level of lightningd under :_log-level key of PLUGIN.
+
+  We get it with lightningd's listconfigs command (see `rpc-call`).
+  As lightningd's log-level option can be given several times with
+  different filters (\"debug:plugin-foo\" for instance), we store the
+  least severe of its levels so that we never drop a message
+  lightningd would log.
+
+  If :log-level of PLUGIN is set, or if we can't get lightningd's
+  log-level (older lightningd, JDK below 16, ...), we store nothing
+  and keep sending all the messages.
+
+  `run` calls it on its own thread just after the init round.  See
+  `min-log-level`."
+  [plugin]
+  (when-not (:log-level @plugin)
+    (let [result (try
+                   (rpc-call plugin "listconfigs" {:config "log-level"} node-log-level-timeout-ms)
+                   (catch Exception _ nil))
+          ;; lightningd v23.08 and above reply with :configs, older
+          ;; ones with the value directly
+          levels (or (get-in result [:configs :log-level :values_str])
+                     (some-> (get-in result [:configs :log-level :value_str]) vector)
+                     (some-> (:log-level result) vector))]
+      (when (seq levels)
+        (swap! plugin assoc :_log-level
+               (apply min-key #(long (min-log-level {:log-level %})) levels))))))
 (defn- max-parallel-reqs
   "Return the maximun number of requests allowed to be processed in parallel.
 
-  Look at PLUGIN's :max-parallel-reqs key which must be < 1024.
-  Default to 512"
+  Look at PLUGIN's :max-parallel-reqs key which must be a positive
+  integer.  Default to 512."
   [plugin]
   (let [mpr (:max-parallel-reqs @plugin)]
-    ;; because clojure.core.async.impl.protocols/MAX-QUEUE-SIZE is 1024
-    ;; if mpr not correctly provided we default to 512
-    (max 1 (or (and (int? mpr) (min mpr 1023)) 512))))
-
-(defn run [plugin]
-  (let [in *in* out *out*
-        max-parallel-reqs (max-parallel-reqs plugin)
-        resps (agent nil) ;; to synchronize writes to out
-        reqs (chan max-parallel-reqs) ;; to queue incoming requests from lightingd
+    (max 1 (or (and (int? mpr) mpr) 512))))
+
+(def ^:private default-lanes
+  "Lanes of the scheduler used when not specified in :lanes of the plugin.
+
+  :hooks lane also reserves a quarter of the permits by default, see
+  `scheduler`."
+  {:hooks {:priority 2}
+   :rpcmethods {:priority 1}
+   :subscriptions {:priority 0}})
+
+(defn- scheduler
+  "Return a scheduler allowing at most MAX-PARALLEL-REQS requests to be processed in parallel.
+
+  Requests are queued in lanes:
+
+  - :hooks for the requests of :hooks methods,
+  - :rpcmethods for the requests of :rpcmethods methods,
+  - :subscriptions for the notifications of :subscriptions topics.
+
+  Each lane has its own queue, its own :max-parallel limit (default
+  to MAX-PARALLEL-REQS), a :priority and a number of :reserved
+  permits that the other lanes can't take.  When a permit is
+  available, it goes to the lane with the highest :priority that has
+  queued requests, hasn't reached its :max-parallel limit and isn't
+  asking for a permit reserved by another lane.  LANES, the value of
+  :lanes key of the plugin, overrides `default-lanes`.
+
+  By default, :hooks lane reserves a quarter of MAX-PARALLEL-REQS
+  permits (rounded down) and the other lanes reserve none.  So a burst
+  of slow RPC requests or of notifications can take at most three
+  quarters of the permits and doesn't delay lightningd hooks that are
+  waiting for us, which would otherwise queue behind them.  With the
+  following plugin
+
+      {:max-parallel-reqs 32
+       :lanes {:hooks {:reserved 4}
+               :rpcmethods {:max-parallel 16}}
+       ,,,}
+
+  RPC requests can't take more than 16 permits and 4 permits are
+  kept for hooks.  Reserved permits are capped so that the other
+  lanes have at least one permit: the lanes reserve their permits by
+  decreasing :priority and a lane can't reserve more than the permits
+  left minus one.  For instance, with :max-parallel-reqs 4 and 3
+  permits reserved by :hooks and :subscriptions lanes, :hooks lane
+  reserves 3 permits and :subscriptions lane none, so RPC requests
+  can still be processed.
+
+  Methods in :rpcmethods, :hooks and :subscriptions maps can also
+  limit the number of their requests processed in parallel with
+  :max-parallel key:
+
+      {:rpcmethods {:foo {:max-parallel 2
+                          :fn (fn [params req plugin] ,,,)}}
+       ,,,}
+
+  The scheduler is a map holding:
+
+  - :lanes: the lanes sorted by :priority, each lane being a map
+            with :name, :priority, :max-parallel, :reserved, :queue and
+            :in-flight (an atom counting its requests being processed),
+  - :lanes-by-name: the same lanes by :name,
+  - :in-flight: an atom counting the requests being processed,
+  - :methods-in-flight: the number of requests being processed by method,
+  - :max-parallel-reqs: the number of permits, i.e. the maximum value
+            :in-flight can reach,
+  - :lock and :ready: the lock guarding the queues and the counters and
+            its condition signaled each time a request is queued or a
+            permit is released,
+  - :closed: an atom set to true by `close-scheduler!`.
+
+  Requests are queued with `schedule!`, taken with `next-req!` which
+  blocks until a request can be processed, and the permit is given
+  back with `release!` once the request has been processed.  Nothing
+  spins: while no request can be processed, the thread calling
+  `next-req!` is parked on :ready condition.
+
+  Queues are not bounded by MAX-PARALLEL-REQS.  Use `queue-depth`
+  and `in-flight` to know how busy the plugin is.
+
+  When the plugin can't keep up with lightningd, for instance
+  during a storm of forward_event or coin_movement notifications,
+  queues grow without limit unless SHEDDING, the value of :shedding
+  key of the plugin, is set.  In that case, once the number of
+  queued requests reaches its :high-water-mark, new requests are
+  handled according to the following rules (see `schedule!`):
+
+  - :notifications: what we do with notifications, :drop (default),
+                    :coalesce or :queue.  A notification coalesced
+                    replaces the queued notification of the same topic
+                    if any.  Each subscription can override this rule
+                    with its own :shed key,
+  - :requests:      what we do with requests of :rpcmethods, :queue
+                    (default) or :reject.  Rejected requests are
+                    replied to with a JSON RPC error, so they are never
+                    dropped silently.
+
+  Hooks are always queued as lightningd waits for their responses.
+  For instance, in the following plugin
+
+      {:shedding {:high-water-mark 1000
+                  :notifications :drop
+                  :requests :reject}
+       :subscriptions {:forward_event {:shed :coalesce
+                                       :fn (fn [params req plugin] ,,,)}
+                       :coin_movement {:shed :queue
+                                       :fn (fn [params req plugin] ,,,)}
+                       :* {:fn (fn [params req plugin] ,,,)}}
+       ,,,}
+
+  once 1000 requests are queued, we keep only the last forward_event
+  notification queued, we never drop coin_movement notifications
+  and we drop the others.  The number of requests shed is counted in
+  :shed atom of the scheduler.
+
+  See `run`."
+  ([max-parallel-reqs] (scheduler max-parallel-reqs nil nil))
+  ([max-parallel-reqs lanes] (scheduler max-parallel-reqs lanes nil))
+  ([max-parallel-reqs lanes shedding]
+   (when-let [unknown (seq (remove (set (keys default-lanes)) (keys lanes)))]
+     (throw (ex-info (format "Unknown lanes %s in :lanes.  Authorized lanes are: :hooks, :rpcmethods, :subscriptions."
+                             (vec unknown)) {})))
+   (when shedding
+     (let [{:keys [high-water-mark notifications requests]} shedding]
+       (cond
+         (not (pos-int? high-water-mark))
+         (throw (ex-info (format "Wrong :high-water-mark '%s' in :shedding.  It must be a positive integer."
+                                 high-water-mark) {}))
+         (not (#{nil :drop :coalesce :queue} notifications))
+         (throw (ex-info (format "Wrong :notifications '%s' in :shedding.  Authorized values are: :drop, :coalesce, :queue."
+                                 notifications) {}))
+         (not (#{nil :queue :reject} requests))
+         (throw (ex-info (format "Wrong :requests '%s' in :shedding.  Authorized values are: :queue, :reject."
+                                 requests) {})))))
+   (let [lock (ReentrantLock.)
+         lanes (->> (merge-with merge default-lanes lanes)
+                    (map (fn [[kw {:keys [priority max-parallel reserved]}]]
+                           {:name kw
+                            :priority priority
+                            :max-parallel (max 1 (or (and (int? max-parallel) max-parallel)
+                                                     max-parallel-reqs))
+                            :reserved (-> (cond
+                                            (int? reserved) reserved
+                                            (= kw :hooks) (quot max-parallel-reqs 4)
+                                            true 0)
+                                          (max 0))
+                            :queue (ArrayDeque.)
+                            :in-flight (atom 0)}))
+                    (sort-by :priority >)
+                    ;; lanes with higher :priority reserve their permits
+                    ;; first, leaving at least one permit to the others
+                    (reduce (fn [lanes lane]
+                              (let [left (- (dec max-parallel-reqs)
+                                            (reduce + (map :reserved lanes)))]
+                                (conj lanes (update lane :reserved min left))))
+                            []))]
+     {:lanes lanes
+      :lanes-by-name (into {} (map (juxt :name identity) lanes))
+      :in-flight (atom 0)
+      :methods-in-flight (java.util.HashMap.)
+      :max-parallel-reqs max-parallel-reqs
+      :shedding (when shedding
+                  (merge {:notifications :drop :requests :queue} shedding))
+      :shed (atom {:dropped 0 :coalesced 0 :rejected 0})
+      :lock lock
+      :ready (.newCondition lock)
+      :closed (atom false)})))
+
+(defn- request-lane
+  "Return the lane of the scheduler in which REQ must be queued.
+
+  See `scheduler`."
+  [req plugin]
+  (cond
+    (nil? (:id req)) :subscriptions
+    (contains? (:hook-names (dispatch-table! plugin)) (:method req)) :hooks
+    true :rpcmethods))
+
+(defn- shed-rule
+  "Return what to do with ENTRY if the queues of SCHEDULER are full.
+
+  M is the definition map of the method of ENTRY's request.
+  Return nil if SCHEDULER doesn't shed requests.  See `scheduler`."
+  [scheduler entry m]
+  (when-let [shedding (:shedding scheduler)]
+    (case (:lane entry)
+      :subscriptions (or (:shed m) (:notifications shedding))
+      :rpcmethods (:requests shedding)
+      :queue)))
+
+(defn- coalesce!
+  "Remove from QUEUE the last entry whose request is for the same method as ENTRY's request.
+
+  Return true if such an entry has been removed."
+  [^ArrayDeque queue entry]
+  (let [method (:method (:req entry))
+        ^java.util.Iterator it (.descendingIterator queue)]
+    (loop []
+      (when (.hasNext it)
+        (if (= (:method (:req (.next it))) method)
+          (do (.remove it) true)
+          (recur))))))
+
+(defn- overloaded-resp
+  "Return the JSON RPC error response to REQ rejected when DEPTH requests are queued."
+  [req depth]
+  {:jsonrpc "2.0"
+   :id (:id req)
+   :error {:code -32603
+           :message (format "Plugin overloaded, '%s' request rejected because %s requests are queued."
+                            (:method req) depth)}})
+
+(defn- queue-depth
+  "Return the number of requests queued in SCHEDULER not yet processed.
+
+  If LANE is specified, return only the number of requests queued in LANE."
+  ([scheduler]
+   (reduce + (map #(queue-depth scheduler (:name %)) (:lanes scheduler))))
+  ([scheduler lane]
+   (let [{:keys [lanes-by-name ^ReentrantLock lock]} scheduler]
+     (.lock lock)
+     (try
+       (.size ^ArrayDeque (:queue (get lanes-by-name lane)))
+       (finally (.unlock lock))))))
+
+(defn- in-flight
+  "Return the number of requests being processed according to SCHEDULER.
+
+  If LANE is specified, return only the number of requests of LANE
+  being processed."
+  ([scheduler]
+   @(:in-flight scheduler))
+  ([scheduler lane]
+   @(:in-flight (get (:lanes-by-name scheduler) lane))))
+
+(defn- schedule!
+  "Queue REQ in its lane of SCHEDULER and wake up the thread waiting in `next-req!`.
+
+  What we queue is an entry, a map with REQ as :req, its lane as
+  :lane and the :max-parallel and :timeout-ms of its method.
+
+  If the number of queued requests has reached the :high-water-mark
+  of SCHEDULER's :shedding, REQ may be dropped, coalesced with a
+  queued notification or rejected, in which case we reply to
+  lightningd with a JSON RPC error (see `scheduler`).
+
+  Return :queued, :coalesced, :dropped or :rejected."
+  [scheduler req plugin]
+  (let [{:keys [lanes-by-name shedding shed ^ReentrantLock lock ^Condition ready]} scheduler
+        m (lookup-method req plugin)
+        entry {:req req
+               :lane (request-lane req plugin)
+               :max-parallel (:max-parallel m)
+               :timeout-ms (:timeout-ms m)}
+        rule (shed-rule scheduler entry m)
+        ^ArrayDeque queue (:queue (get lanes-by-name (:lane entry)))
+        _ (.lock lock)
+        [outcome depth]
+        (try
+          (let [depth (queue-depth scheduler)
+                outcome (if (and rule (not= rule :queue)
+                                 (>= depth (:high-water-mark shedding)))
+                          (case rule
+                            :drop :dropped
+                            :reject :rejected
+                            :coalesce (if (coalesce! queue entry) :coalesced :queued))
+                          :queued)]
+            (when (#{:queued :coalesced} outcome)
+              (.addLast queue entry)
+              (.signalAll ready))
+            (when-not (= outcome :queued)
+              (swap! shed update outcome inc))
+            [outcome depth])
+          (finally (.unlock lock)))]
+    (when-let [s (span req)]
+      (case outcome
+        :rejected (vswap! s assoc :outcome :rejected)
+        :dropped (do (vswap! s assoc :outcome :dropped) (end-span! req))
+        nil))
+    (when (= outcome :rejected)
+      (write! (:_writer @plugin) [[req (overloaded-resp req depth)]]))
+    outcome))
+
+(defn- take-entry!
+  "Remove from LANE's queue and return its first entry that can be processed.
+
+  An entry can be processed if its method has less requests being
+  processed (counted in METHODS-IN-FLIGHT) than its :max-parallel limit.
+  Return nil if there's no such entry."
+  [lane ^java.util.HashMap methods-in-flight]
+  (let [^java.util.Iterator it (.iterator ^ArrayDeque (:queue lane))]
+    (loop []
+      (when (.hasNext it)
+        (let [entry (.next it)
+              limit (:max-parallel entry)]
+          (if (or (nil? limit)
+                  (< (long (.getOrDefault methods-in-flight (:method (:req entry)) 0))
+                     (long limit)))
+            (do (.remove it) entry)
+            (recur)))))))
+
+(defn- reserved-by-others
+  "Return the number of permits reserved by LANES other than LANE that they don't use.
+
+  See `scheduler`."
+  [lanes lane]
+  (reduce (fn [n l]
+            (if (identical? l lane)
+              n
+              (+ n (max 0 (- (long (:reserved l)) (long @(:in-flight l)))))))
+          0 lanes))
+
+(defn- next-req!
+  "Take a permit from SCHEDULER and return the next entry to be processed.
+
+  The entry is the one queued by `schedule!` (its request is
+  under :req key) and is chosen as explained in `scheduler`.
+
+  Block until a request can be processed.  The caller must call
+  `release!` with the returned entry once its request has been
+  processed.
+
+  Return nil once SCHEDULER has been closed.  See `close-scheduler!`."
+  [scheduler]
+  (let [{:keys [lanes lanes-by-name in-flight max-parallel-reqs closed
+                ^java.util.HashMap methods-in-flight
+                ^ReentrantLock lock ^Condition ready]} scheduler]
+    (.lock lock)
+    (try
+      (loop []
+        (if-let [entry (when (and (not @closed) (< @in-flight max-parallel-reqs))
+                         (some (fn [lane]
+                                 (when (and (< @(:in-flight lane) (:max-parallel lane))
+                                            (< (+ @in-flight (reserved-by-others lanes lane))
+                                               max-parallel-reqs))
+                                   (take-entry! lane methods-in-flight)))
+                               lanes))]
+          (let [method (:method (:req entry))]
+            (swap! in-flight inc)
+            (swap! (:in-flight (get lanes-by-name (:lane entry))) inc)
+            (.put methods-in-flight method
+                  (inc (long (.getOrDefault methods-in-flight method 0))))
+            entry)
+          (when-not @closed
+            (.await ready)
+            (recur))))
+      (finally (.unlock lock)))))
+
+(defn- release!
+  "Give back to SCHEDULER the permit taken by `next-req!` for ENTRY."
+  [scheduler entry]
+  (let [{:keys [lanes-by-name in-flight ^java.util.HashMap methods-in-flight
+                ^ReentrantLock lock ^Condition ready]} scheduler
+        method (:method (:req entry))]
+    (.lock lock)
+    (try
+      (swap! in-flight dec)
+      (swap! (:in-flight (get lanes-by-name (:lane entry))) dec)
+      (let [n (long (.getOrDefault methods-in-flight method 0))]
+        (if (<= n 1)
+          (.remove methods-in-flight method)
+          (.put methods-in-flight method (dec n))))
+      (.signalAll ready)
+      (finally (.unlock lock)))))
+
+(defn- close-scheduler!
+  "Close SCHEDULER so that `next-req!` returns nil instead of the next request.
+
+  Requests still queued are never processed.  See `run`."
+  [scheduler]
+  (let [{:keys [closed ^ReentrantLock lock ^Condition ready]} scheduler]
+    (.lock lock)
+    (try
+      (reset! closed true)
+      (.signalAll ready)
+      (finally (.unlock lock)))))
+
+(defn- await-idle!
+  "Block until SCHEDULER has no request queued or being processed, or TIMEOUT-MS has elapsed.
+
+  Return true if SCHEDULER is idle, false if TIMEOUT-MS has elapsed
+  first.  See `run`."
+  [scheduler timeout-ms]
+  (let [{:keys [lanes in-flight ^ReentrantLock lock ^Condition ready]} scheduler
+        deadline (+ (System/nanoTime) (* 1000000 (long timeout-ms)))]
+    (.lock lock)
+    (try
+      (loop []
+        (let [left (- deadline (System/nanoTime))]
+          (cond
+            (and (zero? (long @in-flight))
+                 (every? #(.isEmpty ^ArrayDeque (:queue %)) lanes)) true
+            (<= left 0) false
+            ;; :ready is signaled by schedule! and release!
+            true (do (.awaitNanos ready left) (recur)))))
+      (finally (.unlock lock)))))
+
+(defn- thread-factory
+  "Return a thread factory creating daemon threads named PREFIX-1, PREFIX-2, ..."
+  [prefix]
+  (let [n (atom 0)]
+    (reify ThreadFactory
+      (newThread [_ r]
+        (doto (Thread. ^Runnable r (format "%s-%d" prefix (swap! n inc)))
+          (.setDaemon true))))))
+
+(defn- bounded-executor
+  "Return an executor running tasks on at most N threads.
+
+  Threads are created on demand and terminated after 60 seconds
+  of inactivity.  Tasks submitted while N threads are busy are queued."
+  [n prefix]
+  (doto (ThreadPoolExecutor. n n 60 TimeUnit/SECONDS (LinkedBlockingQueue.)
+                             (thread-factory prefix))
+    (.allowCoreThreadTimeOut true)))
+
+(defn- virtual-executor
+  "Return an executor starting a virtual thread per task.
+
+  Virtual threads are available since JDK 21.  As clnplugin-clj
+  must also run on older JDKs, we look up the executor by reflection
+  and return nil if this is not possible."
+  []
+  (try
+    (.invoke (.getMethod Executors "newVirtualThreadPerTaskExecutor"
+                         (make-array Class 0))
+             nil (object-array 0))
+    (catch Exception _ nil)))
+
+(defn- executors
+  "Return the map of executors on which the plugin processes requests.
+
+  Requests are processed by the :fn functions defined in :rpcmethods,
+  :hooks and :subscriptions maps of the plugin.  These functions can
+  block (calls to lightningd with `clnrpc-clj`, database writes,
+  `Thread/sleep`, ...) or be CPU intensive.  So the plugin and each of
+  these methods can choose the executor that suits them with the
+  :executor key:
+
+  - :blocking: a pool of at most MAX-PARALLEL-REQS threads.  This is
+               the default and is suited for :fn functions that block,
+  - :cpu:      a pool with as many threads as available processors.
+               This is suited for CPU intensive :fn functions,
+  - :virtual:  a virtual thread per request (JDK 21 and above).  This is
+               suited for :fn functions that block most of the time.  If
+               virtual threads are not available, we fallback to the
+               :blocking executor.
+
+  For instance, in the following plugin, :foo is processed on a
+  virtual thread and the others methods on the :cpu executor:
+
+      {:executor :cpu
+       :rpcmethods {:foo {:executor :virtual
+                          :fn (fn [params req plugin] ,,,)}
+                    :bar {:fn (fn [params req plugin] ,,,)}}
+       ,,,}
+
+  Note that whatever the executor, no more than MAX-PARALLEL-REQS
+  requests are processed in parallel.  See `scheduler`."
+  [max-parallel-reqs]
+  (let [blocking (bounded-executor max-parallel-reqs "clnplugin-blocking")]
+    {:blocking blocking
+     :cpu (bounded-executor (.availableProcessors (Runtime/getRuntime)) "clnplugin-cpu")
+     :virtual (or (virtual-executor) blocking)
+     ;; to cancel requests when their :timeout-ms expires, see dispatch
+     :timer (doto (ScheduledThreadPoolExecutor. 1 ^ThreadFactory (thread-factory "clnplugin-timer"))
+              (.setRemoveOnCancelPolicy true))}))
+
+(defn- executor
+  "Return the executor from EXECUTORS on which REQ must be processed.
+
+  Look for :executor key of the method REQ is for and default
+  to PLUGIN's :executor key then to :blocking executor.
+
+  See `executors`."
+  [req executors plugin]
+  (let [m (lookup-method req plugin)]
+    (get executors (or (:executor m) (:executor @plugin)) (:blocking executors))))
+
+(def ^:private latency-buckets
+  "Upper bounds in microseconds of the buckets of latency histograms.
+
+  A last bucket counts the latencies above 10 seconds.
+  See `metrics-registry`."
+  (long-array [50 100 250 500 1000 2500 5000 10000 25000 50000 100000
+               250000 500000 1000000 2500000 5000000 10000000]))
+
+(defn- metrics-registry
+  "Return the registry in which we record the processing of requests.
+
+  The registry maps the names of the methods (strings) to maps of
+  metrics (see `method-metrics`) created the first time we record a
+  request of that method.  It is the value of :_metrics key of the
+  plugin set by `run`.
+
+  Recording a request (see `record!` and `record-bytes!`) takes no
+  lock and allocates nothing: we only increment a few
+  java.util.concurrent.atomic.LongAdder and one bucket of an
+  AtomicLongArray histogram.  What it costs per request, with the
+  registry and without, is documented in docs/docs.org and measured
+  by `metrics-bench` in bench/clnplugin_clj_bench.clj (run `make
+  bench`).
+
+  See `metrics`."
+  []
+  (ConcurrentHashMap.))
+
+(defn- method-metrics
+  "Return a map of metrics to record the processing of the requests of a method.
+
+  - :count:    number of requests processed,
+  - :errors:   number of requests whose :fn threw an exception,
+  - :timeouts: number of requests whose :timeout-ms expired,
+  - :total-ns: sum of processing times in nanoseconds,
+  - :max-ns:   longest processing time in nanoseconds,
+  - :bytes-written: bytes of the responses written to lightningd,
+  - :histogram: number of requests processed in each bucket
+               of `latency-buckets`."
+  []
+  {:count (LongAdder.)
+   :errors (LongAdder.)
+   :timeouts (LongAdder.)
+   :total-ns (LongAdder.)
+   :max-ns (LongAccumulator. (reify java.util.function.LongBinaryOperator
+                               (applyAsLong [_ a b] (Math/max a b)))
+                             0)
+   :bytes-written (LongAdder.)
+   :histogram (AtomicLongArray. (inc (alength ^longs latency-buckets)))})
+
+(defn- bucket
+  "Return the index of the bucket of `latency-buckets` in which US microseconds falls."
+  [us]
+  (let [^longs bounds latency-buckets
+        n (alength bounds)
+        us (long us)]
+    (loop [i 0]
+      (if (or (= i n) (<= us (aget bounds i)))
+        i
+        (recur (inc i))))))
+
+(defn- registry-metrics
+  "Return the metrics of METHOD in REGISTRY, creating them if needed.
+
+  See `method-metrics`."
+  [registry method]
+  (let [^ConcurrentHashMap r registry
+        method (str method)]
+    (or (.get r method)
+        (do (.putIfAbsent r method (method-metrics))
+            (.get r method)))))
+
+(defn- record!
+  "Record in REGISTRY that a request for METHOD has been processed in ELAPSED-NS nanoseconds.
+
+  OUTCOME is :ok, :error or :timeout.  See `metrics-registry`."
+  [registry method elapsed-ns outcome]
+  (let [m (registry-metrics registry method)
+        elapsed-ns (long elapsed-ns)]
+    (.increment ^LongAdder (:count m))
+    (case outcome
+      :error (.increment ^LongAdder (:errors m))
+      :timeout (.increment ^LongAdder (:timeouts m))
+      nil)
+    (.add ^LongAdder (:total-ns m) elapsed-ns)
+    (.accumulate ^LongAccumulator (:max-ns m) elapsed-ns)
+    (.incrementAndGet ^AtomicLongArray (:histogram m) (bucket (quot elapsed-ns 1000)))))
+
+(defn- record-bytes!
+  "Record in REGISTRY that N bytes of a response to a request for METHOD have been written.
+
+  This is called by the thread of the writer once the response has
+  been serialized.  As we escape non ASCII chars when serializing to
+  JSON, one char is one byte.  See `write` and `metrics-registry`."
+  [registry method n]
+  (.add ^LongAdder (:bytes-written (registry-metrics registry method)) (long n)))
+
+(defn- percentile
+  "Return the upper bound in microseconds of the bucket of COUNTS where the Q quantile falls.
+
+  COUNTS are the counts of a histogram whose buckets are `latency-buckets`.
+  As the last bucket has no upper bound, we return MAX-US for it.
+  Return nil if COUNTS are all 0."
+  [counts q max-us]
+  (let [total (reduce + counts)
+        target (Math/ceil (* q total))
+        n (alength ^longs latency-buckets)]
+    (when (pos? total)
+      (loop [i 0 acc 0]
+        (let [acc (+ acc (nth counts i))]
+          (if (>= acc target)
+            (if (< i n) (aget ^longs latency-buckets i) max-us)
+            (recur (inc i) acc)))))))
+
+(defn- method-snapshot
+  "Return the current values of the metrics M of a method.  See `method-metrics`."
+  [m]
+  (let [^AtomicLongArray h (:histogram m)
+        counts (mapv #(.get h %) (range (.length h)))
+        n (.sum ^LongAdder (:count m))
+        max-us (quot (.get ^LongAccumulator (:max-ns m)) 1000)]
+    {:count n
+     :errors (.sum ^LongAdder (:errors m))
+     :timeouts (.sum ^LongAdder (:timeouts m))
+     :mean-us (if (pos? n) (quot (.sum ^LongAdder (:total-ns m)) (* 1000 n)) 0)
+     :max-us max-us
+     :bytes-written (.sum ^LongAdder (:bytes-written m))
+     :p50-us (percentile counts 0.5 max-us)
+     :p90-us (percentile counts 0.9 max-us)
+     :p99-us (percentile counts 0.99 max-us)
+     :histogram (mapv (fn [i c]
+                        {:le-us (if (< i (alength ^longs latency-buckets))
+                                  (aget ^longs latency-buckets i)
+                                  "+Inf")
+                         :count c})
+                      (range) counts)}))
+
+(defn metrics
+  "Return a snapshot of the metrics of PLUGIN.
+
+  The snapshot is a JSON writable map with the following keys:
+
+  - :methods:   for each method (by name), the number of requests
+                processed, how many failed or timed out, processing
+                times in microseconds (mean, max and percentiles
+                estimated from the histogram), the bytes of its
+                responses written to lightningd and the histogram of
+                processing times.  The processing time of a request
+                goes from the moment it leaves the scheduler's queue
+                to the moment its response is handed to the writer.
+  - :scheduler: the requests queued and being processed per lane,
+                the maximum of requests processed in parallel and
+                the requests shed (see `scheduler`),
+  - :writer:    the messages waiting to be written to lightningd,
+                the bytes written to lightningd (responses and
+                notifications) and the number of flushes (see `writer`),
+  - :caches:    for each RPC method with a :cache, the number of
+                calls answered from the cache (:hits), the number of
+                calls of its :fn (:misses) and the number of cached
+                results (see `response-caches`).
+
+  This is meant to be exported to your monitoring system.  For
+  instance, to log the metrics every minute:
+
+      (future
+        (loop []
+          (Thread/sleep 60000)
+          (plugin/log (format \"%s\" (plugin/metrics plugin)) plugin)
+          (recur)))
+
+  Metrics are recorded once `run` has been called.  See also
+  :stats-method in `set-defaults!`."
+  [plugin]
+  (let [{:keys [_metrics _scheduler _writer _caches]} @plugin]
+    {:methods (into (sorted-map)
+                    (for [[method m] _metrics]
+                      [method (method-snapshot m)]))
+     :scheduler (when _scheduler
+                  (let [lanes (map :name (:lanes _scheduler))]
+                    {:queue-depth (into {} (for [l lanes] [l (queue-depth _scheduler l)]))
+                     :in-flight (into {} (for [l lanes] [l (in-flight _scheduler l)]))
+                     :max-parallel-reqs (:max-parallel-reqs _scheduler)
+                     :shed @(:shed _scheduler)}))
+     :writer (when _writer
+               {:queue-length (.size ^LinkedBlockingQueue (:queue _writer))
+                :bytes-written (.sum ^LongAdder (:bytes-written _writer))
+                :flushes (.sum ^LongAdder (:flushes _writer))})
+     :caches (into (sorted-map)
+                   (for [[method cache] (:by-method _caches)]
+                     [method {:hits (.sum ^LongAdder (:hits cache))
+                              :misses (.sum ^LongAdder (:misses cache))
+                              :entries (let [^java.util.Map entries (:entries cache)]
+                                         (locking entries (.size entries)))}]))}))
+
+(defn- timeout-resp
+  "Return [log-msgs resp] vector for REQ not processed within TIMEOUT-MS milliseconds.
+
+  resp is nil if REQ is a notification.  REQ is printed truncated to
+  MAX-CHARS chars, default to `default-error-max-chars`.  See `dispatch`
+  and `error-max-chars`."
+  ([req timeout-ms] (timeout-resp req timeout-ms default-error-max-chars))
+  ([req timeout-ms max-chars]
+   (let [msg (format "Timeout of %sms reached while processing '%s'"
+                     timeout-ms (truncated-str req max-chars))]
+     [[msg] (when-let [id (:id req)]
+              {:jsonrpc "2.0" :id id :error {:code -32603 :message msg}})])))
+
+(defn- process-inline!
+  "Process REQ of METHOD on the current thread and send its response to lightningd.
+
+  This is how `run` processes the requests of methods declared with
+  :inline, without going through the scheduler and the executors.
+  For instance, with the following plugin
+
+      {:hooks {:htlc_accepted {:inline true
+                               :inline-budget-ms 2
+                               :fn (fn [params req plugin]
+                                     {:result \"continue\"})}}
+       ,,,}
+
+  \"htlc_accepted\" requests are processed by the thread reading
+  the requests as soon as they are read, which saves the handoffs
+  between threads and the wait in the scheduler's queue.  Their
+  responses are still written by the writer thread (see `writer`).
+
+  As no other request is read while an :inline method is running,
+  this is only for methods that return quickly without blocking.
+  We can't interrupt them, so if one takes longer than its
+  :inline-budget-ms (default to 5 milliseconds), we log a warning
+  at \"unusual\" level.
+
+  If :fn returns an async value (see `process-async`), the response
+  is sent once it completes, and only the time :fn took to return
+  counts against :inline-budget-ms.
+
+  The processing of REQ is recorded in the :_metrics registry of
+  PLUGIN if any.  See `metrics`."
+  [req method plugin]
+  (let [start (System/nanoTime)
+        respond (fn [[log-msgs resp]]
+                  (let [elapsed-ns (- (System/nanoTime) start)
+                        ;; log-msgs are only set when :fn threw
+                        outcome (if log-msgs :error :ok)]
+                    (when-let [registry (:_metrics @plugin)]
+                      (record! registry (:method req) elapsed-ns outcome))
+                    (when-let [s (span req)]
+                      (vswap! s assoc :queue-ns 0 :handler-ns elapsed-ns :outcome outcome))
+                    (doseq [msg log-msgs] (log msg "debug" plugin))
+                    (if resp
+                      (write! (:_writer @plugin) [[req resp]])
+                      (end-span! req))))
+        _ (process-async req plugin respond)
+        elapsed-ns (- (System/nanoTime) start)
+        budget-ms (get method :inline-budget-ms 5)]
+    (when (> elapsed-ns (* 1000000 (long budget-ms)))
+      (log (format "Inline method '%s' took %.3fms, more than its :inline-budget-ms of %sms"
+                   (:method req) (/ elapsed-ns 1e6) budget-ms)
+           "unusual" plugin))))
+
+(defn- batch-topic
+  "Return the topic of the subscription NOTIF is batched in.
+
+  This is the topic of NOTIF unless we receive it because we
+  subscribed to all topics with :* in :subscriptions map, in which
+  case this is \"*\"."
+  [notif plugin]
+  (let [m (:method notif)]
+    (if (contains? (:notifications (dispatch-table! plugin)) m) m "*")))
+
+(defn- take-batch!
+  "Remove from PLUGIN's batches the notifications batched for TOPIC and return them.
+
+  Return nil if no notification is batched for TOPIC.  See `batch!`."
+  [topic plugin]
+  (when-let [b (.get ^ConcurrentHashMap (:_batches @plugin) topic)]
+    (locking b
+      (let [^java.util.ArrayList notifs (:notifs b)]
+        (when-not (.isEmpty notifs)
+          (let [batch (vec notifs)]
+            (.clear notifs)
+            (when-let [^Future t @(:flush-task b)]
+              (.cancel t false))
+            (vreset! (:flush-task b) nil)
+            batch))))))
+
+(defn- batch-req
+  "Return the notification of TOPIC passing NOTIFS to the :fn of a :batch subscription."
+  [topic notifs]
+  {:jsonrpc "2.0" :method topic :params notifs})
+
+(defn- flush-batch!
+  "Queue in SCHEDULER the notifications batched for TOPIC in PLUGIN, if any.
+
+  See `batch!`."
+  [topic scheduler plugin]
+  (when-let [notifs (take-batch! topic plugin)]
+    (schedule! scheduler (batch-req topic notifs) plugin)))
+
+(defn- batch!
+  "Add NOTIF to the batch of its SUBSCRIPTION in PLUGIN.
+
+  This is how `run` handles notifications of subscriptions declared
+  with a :batch.  For instance, with the following plugin
+
+      {:subscriptions
+       {:forward_event {:batch {:max-size 500 :max-wait-ms 50}
+                        :fn (fn [notifs req plugin]
+                              (save-forwards! (map :params notifs)))}}
+       ,,,}
+
+  \"forward_event\" notifications are not processed one by one.  We
+  batch them and call :fn with the vector of the notifications in
+  the order we received them as first argument (each notification
+  being a map with :jsonrpc, :method and :params keys, so that a :*
+  subscription can tell them apart).  A batch is queued in SCHEDULER
+  as one notification (see `batch-req`):
+
+  - as soon as it contains :max-size notifications (default to 100),
+  - :max-wait-ms milliseconds (default to 100) after its first
+    notification has been added, if not full before (see `flush-batch!`
+    and the :timer executor in `executors`) or
+  - when lightningd closes the connection, in which case the batch
+    is processed before we exit (see `flush-batches!`).
+
+  As batches are queued as one notification, the :shed policy of the
+  subscription applies to the whole batch."
+  [notif subscription scheduler plugin]
+  (let [^ConcurrentHashMap batches (:_batches @plugin)
+        ^ScheduledExecutorService timer (:timer (:_executors @plugin))
+        topic (batch-topic notif plugin)
+        {:keys [max-size max-wait-ms] :or {max-size 100 max-wait-ms 100}} (:batch subscription)
+        b (or (.get batches topic)
+              (do (.putIfAbsent batches topic {:notifs (java.util.ArrayList.)
+                                               :flush-task (volatile! nil)})
+                  (.get batches topic)))
+        full? (locking b
+                (let [^java.util.ArrayList notifs (:notifs b)]
+                  (.add notifs notif)
+                  (when (= (.size notifs) 1)
+                    (vreset! (:flush-task b)
+                             (.schedule timer
+                                        ^Runnable (fn [] (flush-batch! topic scheduler plugin))
+                                        (long max-wait-ms) TimeUnit/MILLISECONDS)))
+                  (>= (.size notifs) (long max-size))))]
+    (when full?
+      (flush-batch! topic scheduler plugin))))
+
+(defn- flush-batches!
+  "Process on the current thread the notifications still batched in PLUGIN.
+
+  `run` calls it once lightningd has closed the connection, so that
+  no batched notification is lost when we exit.  See `batch!`."
+  [plugin]
+  (doseq [topic (keys (:_batches @plugin))]
+    (when-let [notifs (take-batch! topic plugin)]
+      (let [[log-msgs _] (process (batch-req topic notifs) plugin)]
+        (doseq [msg log-msgs] (log msg "debug" plugin))))))
+
+(defn- dispatch
+  "Process the requests queued in SCHEDULER until it is closed.
+
+  Each request is processed on its executor (see `executor`) and
+  its response is sent to lightningd.  As soon as the response has
+  been sent, its permit is given back to SCHEDULER.
+
+  If the method of a request has a :timeout-ms key, like :foo in
+  the following plugin
+
+      {:rpcmethods {:foo {:timeout-ms 5000
+                          :fn (fn [params req plugin] ,,,)}}
+       ,,,}
+
+  and its :fn function doesn't return within :timeout-ms milliseconds,
+  the thread running :fn is interrupted and we reply to lightningd
+  with a JSON RPC error instead (see `timeout-resp`).  Whatever
+  happens first, we reply once.  Note that :fn is stopped only if it
+  responds to interruption (`Thread/sleep`, blocking queues, ...).
+  If it doesn't, it keeps running but its permit has been given back.
+
+  Requests are always replied to, even if their processing fails
+  outside of :fn (looking up their method, recording their metrics,
+  ...).  In that case we reply with a JSON RPC error as if :fn had
+  thrown (see `error-resp`), as lightningd would wait forever for the
+  response, and a hook waiting for us stalls the node.
+
+  If :fn returns an async value (see `process-async`), the thread
+  running :fn is given back to its executor right away but the
+  request keeps its permit until the value completes, or until its
+  :timeout-ms expires.  So we can wait for thousands of long-poll
+  requests without holding as many threads, within the limits of
+  the scheduler.
+
+  `dispatch` returns once SCHEDULER has been closed, which `run`
+  does when lightningd closes the connection and `*exit*` returns.
+  See `close-scheduler!`.
+
+  The processing of each request is recorded in the :_metrics
+  registry of PLUGIN if any.  See `metrics`.  The time it waited in
+  SCHEDULER's queue and the time it took to be processed are added
+  to its span if it is traced.  See `tracer`.
+
+  See `scheduler`, `executors`, `process-async` and `run`."
+  [scheduler executors plugin]
+  (let [^ScheduledExecutorService timer (:timer executors)
+        registry (:_metrics @plugin)]
+    (loop []
+      (when-let [entry (next-req! scheduler)]
+        (let [req (:req entry)
+              timeout-ms (:timeout-ms entry)
+              ;; if the method can't be looked up, process-fn fails
+              ;; the same way and replies with an error
+              ^ExecutorService e (try (executor req executors plugin)
+                                      (catch Throwable _ (:blocking executors)))
+              done (AtomicBoolean. false)
+              timed-out (volatile! false)
+              task (volatile! nil)
+              timeout (volatile! nil)
+              start (System/nanoTime)
+              span (span req)
+              ;; send resp to lightningd only if no resp has been sent yet
+              respond! (fn [outcome [log-msgs resp]]
+                         (when (.compareAndSet done false true)
+                           (when-let [^Future t @timeout] (.cancel t false))
+                           (try
+                             (let [elapsed-ns (- (System/nanoTime) start)]
+                               (when registry
+                                 (record! registry (:method req) elapsed-ns outcome))
+                               (when span
+                                 (vswap! span assoc :handler-ns elapsed-ns :outcome outcome)))
+                             (doseq [msg log-msgs] (log msg "debug" plugin))
+                             ;; whatever fails above, lightningd must get
+                             ;; resp and the permit must be given back
+                             (finally
+                               (try
+                                 (if resp
+                                   (write! (:_writer @plugin) [[req resp]])
+                                   (end-span! req))
+                                 (finally (release! scheduler entry)))))
+                           true))
+              process-fn (fn []
+                           (try
+                             (process-async req plugin
+                                            (fn [[log-msgs _ :as r]]
+                                              ;; log-msgs are only set when :fn threw
+                                              (respond! (if log-msgs :error :ok) r)))
+                             (catch Throwable e
+                               ;; process-async threw before calling :fn
+                               ;; (while looking up the method for
+                               ;; instance), so we reply with an error
+                               ;; as we do when :fn throws
+                               (respond! :error (error-resp req e (error-max-chars @plugin))))))]
+          (when span
+            (vswap! span assoc :queue-ns (- start (long (:start-ns @span)))))
+          (if timeout-ms
+            (do
+              (vreset! timeout
+                       (.schedule timer
+                                  ^Runnable (fn []
+                                              (when (respond! :timeout (timeout-resp req timeout-ms (error-max-chars @plugin)))
+                                                (vreset! timed-out true)
+                                                (when-let [^Future t @task] (.cancel t true))))
+                                  (long timeout-ms) TimeUnit/MILLISECONDS))
+              (vreset! task (.submit e ^Runnable process-fn))
+              ;; the timeout may have expired before the task was submitted
+              (when @timed-out
+                (.cancel ^Future @task true)))
+            (.execute e ^Runnable process-fn))
+          (recur))))))
+
+(def ^:private exit-timeout-ms
+  "Maximum time `run` waits for the requests queued or being processed
+  when lightningd closes the connection before exiting anyway."
+  30000)
+
+(def ^:dynamic *exit*
+  "Function called by `run` with status 0 once lightningd has closed the connection.
+
+  Default to `System/exit`.  Bind it to another function to run a
+  plugin in a JVM that must not exit when the plugin stops, as do
+  the benchmark harness in bench/clnplugin_clj_harness.clj and the
+  plugin host (see `clnplugin-clj.host` namespace).  If it returns,
+  `run` stops processing requests, stops the threads of the plugin
+  and returns."
+  (fn [status] (System/exit status)))
+
+(def ^:dynamic *run*
+  "Function called by `run` with the plugin instead of running it, if not nil.
+
+  `clnplugin-clj.host` binds it while loading plugin files to get
+  their plugin atoms without running them."
+  nil)
+
+(defn- run-plugin
+  "Run PLUGIN connected to lightningd through `*in*` and `*out*`.  See `run`."
+  [plugin]
+  (let [codec (codec (:codec @plugin))
+        in (request-reader *in* 65536 codec)
+        ;; see metrics
+        registry (metrics-registry)
+        writer (writer *out* 5 codec (error-max-chars @plugin) registry) ;; to synchronize writes to *out*
+        tracer (tracer @plugin)
+        exit *exit*
         ;; to apply backpressure on incoming lightingd requests we restrict
         ;; the number of parallel requests being processed to max-parallel-reqs.
-        ;; So we always have reqs-in-progress < max-parallel-reqs.
-        reqs-in-progress (atom 0)]
-
-    (set-defaults! plugin)
-    ;; for log and notify functions
-    (swap! plugin assoc :_out out)
-    (swap! plugin assoc :_resps resps)
-
-    ;; getmanifest round
-    (let [req (read in) resp (gm-resp req plugin)]
-      (add-request! req plugin)
-      (send resps write [[req resp]] out))
-
-    ;; init round
-    ;;
-    ;; It is possible to receive notifications before receiving the
-    ;; init request.  See the following function calls (in lightning repository):
-    ;;
-    ;;     plugin_manifest_cb
-    ;;     └── check_plugins_manifests
-    ;;         └── plugin_check_subscriptions
-    ;;
-    ;; We test this in test_subscriptions_and_notifications.
-    (loop [req (read in)]
-      (cond
-        ;; init request
-        (and (:id req) (= (:method req) "init"))
-        (let [resp (process-init! req plugin)]
-          (send resps write [[req resp]] out))
-        ;; this is a notification
-        (nil? (:id req))
-        (let [[log-msgs _] (process req plugin)]
-          (doseq [msg log-msgs] (log msg "debug" plugin))
-          (recur (read in)))
-        true (throw (ex-info (format "Expect 'init' request but received %s" req) {}))))
-
-    ;; read incoming requests and queue them
-    (thread
+        ;; Requests that can't be processed yet wait in the scheduler's queue.
+        max-parallel-reqs (max-parallel-reqs plugin)
+        scheduler (scheduler max-parallel-reqs (:lanes @plugin) (:shedding @plugin))
+        executors (executors max-parallel-reqs)]
+    (try
+      (set-defaults! plugin)
+      ;; for log and notify functions
+      (swap! plugin assoc :_writer writer)
+      ;; see lookup-method
+      (swap! plugin assoc :_dispatch-table (volatile! nil))
+      ;; to inspect the queue from a REPL connected to the plugin
+      (swap! plugin assoc :_scheduler scheduler)
+      (swap! plugin assoc :_executors executors)
+      ;; see metrics
+      (swap! plugin assoc :_metrics registry)
+      ;; see batch!
+      (swap! plugin assoc :_batches (ConcurrentHashMap.))
+      ;; see on-complete!
+      (swap! plugin assoc :_pending-derefs (pending-derefs (:timer executors)))
+      ;; see log
+      (swap! plugin assoc :_log-limiter (log-limiter (:log-rate-limit @plugin)))
+      ;; see rpc-call
+      (swap! plugin assoc :_rpc (rpc-pool (:rpc-pool-size @plugin 1) codec))
+
+      ;; getmanifest round
+      (let [req (read in) resp (gm-resp req plugin)]
+        (add-request! req plugin)
+        (write! writer [[req resp]]))
+      ;; methods have been checked by gm-resp
+      (swap! plugin assoc :_caches (response-caches @plugin))
+
+      ;; init round
+      ;;
+      ;; It is possible to receive notifications before receiving the
+      ;; init request.  See the following function calls (in lightning repository):
+      ;;
+      ;;     plugin_manifest_cb
+      ;;     └── check_plugins_manifests
+      ;;         └── plugin_check_subscriptions
+      ;;
+      ;; We test this in test_subscriptions_and_notifications.
       (loop [req (read in)]
-        (if req
-          (do (>!! reqs req)
+        (cond
+          ;; init request
+          (and (:id req) (= (:method req) "init"))
+          (let [resp (process-init! req plugin)]
+            (write! writer [[req resp]])
+            ;; see min-log-level.  On its own thread so that we
+            ;; don't wait for lightningd before processing requests
+            (thread (node-log-level! plugin)))
+          ;; this is a notification
+          (nil? (:id req))
+          (let [[log-msgs _] (process req plugin)]
+            (doseq [msg log-msgs] (log msg "debug" plugin))
+            (recur (read in)))
+          true (throw (ex-info (format "Expect 'init' request but received %s" req) {}))))
+
+      ;; methods are all known now, so we build the dispatch table once
+      ;; for all.  It is rebuilt only if they change.  See lookup-method.
+      (vreset! (:_dispatch-table @plugin) (dispatch-table @plugin))
+
+      ;; read incoming requests and queue them
+      (thread
+        (loop [req (read in)]
+          (if req
+            (let [req (traced req (aget ^longs (:read-ns in) 0) tracer)]
+              (when-not (:id req)
+                (invalidate-caches! req plugin))
+              (let [method (lookup-method req plugin)]
+                (cond
+                  (:inline method) (process-inline! req method plugin)
+                  (and (:batch method) (nil? (:id req))) (batch! req method scheduler plugin)
+                  true (schedule! scheduler req plugin)))
               (recur (read in)))
-          ;; This happens when we shutdown lightningd:
-          ;; - with `lightning-cli stop` or
-          ;; - by killing lightningd process.
-          ;; As we are using agents and they use non-daemon background
-          ;; threads which prevents shutdown of the JVM, we need
-          ;; to exit explicitly.
-          (System/exit 0))))
+            ;; This happens when we shutdown lightningd:
+            ;; - with `lightning-cli stop` or
+            ;; - by killing lightningd process.
+            ;; As the main thread doesn't return from `dispatch` until
+            ;; we close the scheduler and :fn functions may use agents
+            ;; whose non-daemon background threads prevent shutdown of
+            ;; the JVM, we need to exit explicitly, once what remains to
+            ;; be processed and written has been.  We don't read
+            ;; requests anymore, so the only work left is the batches
+            ;; still being filled, that we process here, and what is
+            ;; queued in the scheduler or being processed (batches
+            ;; flushed before included), that we wait for.
+            (do (flush-batches! plugin)
+                (when-not (await-idle! scheduler exit-timeout-ms)
+                  (log (format "Exiting with requests still queued or being processed after %sms"
+                               exit-timeout-ms)
+                       "unusual" plugin))
+                ;; see log-limiter
+                (when-let [^ConcurrentHashMap limiter (:_log-limiter @plugin)]
+                  (doseq [site (.keySet limiter)]
+                    (flush-suppressed! plugin site nil)))
+                (drain! writer)
+                (close-rpc-pool! (:_rpc @plugin))
+                (exit 0)
+                ;; exit returned (see *exit*), so dispatch must return
+                (close-scheduler! scheduler)))))
+
+      ;; process queued requests until lightningd closes the connection
+      (dispatch scheduler executors plugin)
+      (finally
+        ;; we get here once exit returned or if the plugin failed to
+        ;; start, so we stop the threads of the plugin
+        (doseq [^ExecutorService e (distinct (vals executors))]
+          (.shutdown e))
+        (close-writer! writer)))))
 
-    ;; process queued requests
-    (loop []
-      (if (< @reqs-in-progress max-parallel-reqs)
-        (let [req (<!! reqs)]
-          (swap! reqs-in-progress inc)
-          (go
-            (try
-              (let [[log-msgs resp] (process req plugin)]
-                (doseq [msg log-msgs] (log msg "debug" plugin))
-                (when resp (send resps write [[req resp]] out)))
-              (finally (swap! reqs-in-progress dec))))
-          (recur))
-        (recur)))))
+(defn run [plugin]
+  (if *run*
+    (*run* plugin)
+    (run-plugin plugin)))
 
 (load "clnplugin_utils")
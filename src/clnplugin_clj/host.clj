@@ -0,0 +1,187 @@
+(ns clnplugin-clj.host
+  "Host running several clnplugin-clj plugins in one JVM.
+
+  Each plugin started by lightningd usually runs in its own JVM,
+  with its own heap, its own JIT warm-up and a startup of a few
+  seconds.  With a host, plugins share one long-lived JVM:
+
+  1) the host loads the plugin files (which call `clnplugin-clj/run`
+     as usual, see pytest/plugins/ for examples) and listens on
+     one unix socket per plugin:
+
+         clojure -M -m clnplugin-clj.host /var/run/clnplugin rpcmethods.clj subscriptions.clj
+
+     listens on /var/run/clnplugin/rpcmethods.sock and
+     /var/run/clnplugin/subscriptions.sock,
+
+  2) lightningd is given a launcher per plugin that connects its
+     stdin and stdout to the socket of the plugin with socat.  For
+     instance, with tools/clnplugin-shim symlinked under the name of
+     the plugin:
+
+         ln -s /path/to/clnplugin-shim /path/to/rpcmethods
+         CLNPLUGIN_SOCKET_DIR=/var/run/clnplugin lightningd --plugin=/path/to/rpcmethods
+
+  Each connection to a plugin's socket is a session in which we run
+  the plugin with `clnplugin-clj/run` as in its own JVM:
+
+  - the plugin atom of the session is a new atom holding the plugin
+    map as it was when the file was loaded.  So sessions don't share
+    what the plugin stores in its atom, even sessions of the same
+    plugin started by different lightningd nodes,
+  - getmanifest and init rounds are done in the session,
+  - when lightningd closes the connection, `clnplugin-clj/*exit*` is
+    bound to a function that returns instead of calling `System/exit`,
+    so `run` stops the threads of the session and returns, and we
+    close the connection.  The host keeps running and the plugin can
+    be started again with `lightning-cli plugin start`.
+
+  Note that plugins are loaded once, so what they define at the top
+  level of their namespace (vars, atoms, ...) is shared by their
+  sessions.  :fn functions should use their plugin argument to
+  access the plugin atom of their session."
+  (:require [clnplugin-clj :as plugin])
+  (:require [clojure.java.io :as io])
+  (:import [java.net ProtocolFamily SocketAddress StandardProtocolFamily])
+  (:import [java.nio ByteBuffer])
+  (:import [java.nio.channels Channels ServerSocketChannel SocketChannel]))
+
+(defn- load-plugin
+  "Load the plugin FILE and return the plugin atom it passes to `clnplugin-clj/run`.
+
+  The plugin is not run.  Throw an error if FILE doesn't call
+  `clnplugin-clj/run`."
+  [file]
+  (let [p (promise)]
+    (binding [plugin/*run* (fn [plugin] (deliver p plugin))]
+      (load-file (str file)))
+    (or (deref p 0 nil)
+        (throw (ex-info (format "Plugin '%s' doesn't call clnplugin-clj/run" file) {})))))
+
+(defn- plugin-name
+  "Return the name of the plugin FILE, its file name without .clj extension."
+  [file]
+  (let [n (.getName (io/file file))]
+    (if (.endsWith n ".clj") (subs n 0 (- (count n) 4)) n)))
+
+(defn- channel-writer
+  "Return a java.io.Writer writing UTF-8 chars to the socket channel CH.
+
+  We don't use `Channels/newWriter` as its writes would wait for
+  the reads of `Channels/newReader` in progress on the same
+  channel, so the plugin couldn't respond while waiting for the
+  next request."
+  [^SocketChannel ch]
+  (java.io.OutputStreamWriter.
+   (proxy [java.io.OutputStream] []
+     (write
+       ([b]
+        (if (integer? b)
+          (.write ^java.io.OutputStream this (byte-array [(unchecked-byte b)]) 0 1)
+          (.write ^java.io.OutputStream this ^bytes b 0 (alength ^bytes b))))
+       ([b off len]
+        (let [buf (ByteBuffer/wrap ^bytes b (int off) (int len))]
+          (while (.hasRemaining buf)
+            (.write ch buf))))))
+   "UTF-8"))
+
+(defn- session
+  "Run a new instance of TEMPLATE plugin connected to lightningd through CH.
+
+  TEMPLATE is the plugin atom returned by `load-plugin`.  Return once
+  lightningd has closed the connection.  See `clnplugin-clj.host`."
+  [template ^SocketChannel ch]
+  (try
+    (binding [*in* (clojure.lang.LineNumberingPushbackReader.
+                    (Channels/newReader ch "UTF-8"))
+              *out* (channel-writer ch)
+              plugin/*exit* (fn [_])]
+      (plugin/run (atom @template)))
+    (finally (.close ch))))
+
+(defn- unix-server-channel
+  "Return a java.nio.channels.ServerSocketChannel bound to the unix socket SOCKET-FILE.
+
+  As for `clnplugin-clj/rpc-call`, unix domain socket channels
+  require JDK 16 or above.  We look them up by reflection so that
+  loading this namespace doesn't fail on older JDKs, and throw an
+  error when trying to listen."
+  [socket-file]
+  (let [[family address]
+        (try
+          [(Enum/valueOf StandardProtocolFamily "UNIX")
+           (.invoke (.getMethod (Class/forName "java.net.UnixDomainSocketAddress") "of"
+                                (into-array Class [String]))
+                    nil (object-array [(str socket-file)]))]
+          (catch ClassNotFoundException _ nil)
+          (catch IllegalArgumentException _ nil))]
+    (when-not address
+      (throw (ex-info (format "Listening on '%s' requires JDK 16 or above, not %s."
+                              socket-file (System/getProperty "java.version")) {})))
+    (let [^ServerSocketChannel server
+          (.invoke (.getMethod ServerSocketChannel "open" (into-array Class [ProtocolFamily]))
+                   nil (object-array [family]))]
+      (try
+        (.bind server ^SocketAddress address)
+        server
+        (catch Throwable e
+          (.close server)
+          (throw e))))))
+
+(defn- listen!
+  "Listen on SOCKET-FILE and run a session of TEMPLATE for each connection.
+
+  Sessions are run on their own thread.  Return the server channel
+  listening on SOCKET-FILE, close it to stop listening."
+  [name template socket-file]
+  (let [_ (java.nio.file.Files/deleteIfExists (.toPath (io/file socket-file)))
+        ^ServerSocketChannel server (unix-server-channel socket-file)]
+    (doto (Thread.
+           ^Runnable
+           (fn []
+             (while (.isOpen server)
+               (when-let [ch (try (.accept server) (catch java.io.IOException _ nil))]
+                 (doto (Thread.
+                        ^Runnable
+                        (fn []
+                          (try
+                            (session template ch)
+                            (catch Throwable e
+                              (binding [*out* *err*]
+                                (println (format "Session of plugin '%s' failed: %s" name (ex-message e)))))))
+                        (str "clnplugin-host-" name "-session"))
+                   (.setDaemon true)
+                   (.start)))))
+           (str "clnplugin-host-" name))
+      (.setDaemon true)
+      (.start))
+    server))
+
+(defn start!
+  "Load the plugin FILES and listen on a unix socket per plugin in SOCKET-DIR.
+
+  The socket of the plugin defined in foo.clj is SOCKET-DIR/foo.sock.
+  Return a map of the server channels by plugin name.  See `stop!`."
+  [socket-dir files]
+  (.mkdirs (io/file socket-dir))
+  (into {}
+        (for [file files
+              :let [name (plugin-name file)
+                    template (load-plugin file)]]
+          [name (listen! name template (str (io/file socket-dir (str name ".sock"))))])))
+
+(defn stop!
+  "Stop listening on the sockets of HOST returned by `start!`.
+
+  Sessions in progress go on until lightningd closes their connection."
+  [host]
+  (doseq [^ServerSocketChannel server (vals host)]
+    (.close server)))
+
+(defn -main [socket-dir & files]
+  (let [host (start! socket-dir files)]
+    (binding [*out* *err*]
+      (doseq [name (keys host)]
+        (println (format "Plugin '%s' listening on %s" name (io/file socket-dir (str name ".sock"))))))
+    ;; sessions run on daemon threads
+    @(promise)))
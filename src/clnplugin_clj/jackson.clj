@@ -0,0 +1,169 @@
+(ns clnplugin-clj.jackson
+  "JSON codec of clnplugin-clj using Jackson streaming API.
+
+  This codec is used by plugins declaring :codec :jackson and
+  requires com.fasterxml.jackson.core/jackson-core in the dependencies
+  of the plugin:
+
+      {:deps
+       {io.github.tonyaldon/clnplugin-clj {,,,}
+        com.fasterxml.jackson.core/jackson-core {:mvn/version \"2.17.2\"}}}
+
+  It parses and writes the same JSON values as the default codec
+  using clojure.data.json, but faster:
+
+  - we parse requests with a streaming parser directly from the chars
+    of the request reader, without going through a java.io.Reader,
+  - the keys of the objects we parse are converted to keywords with
+    a cache (see `key->keyword`).  lightningd sends the same field
+    names over and over, for instance in \"listpeerchannels\" results
+    passed through hooks, so we avoid interning a new keyword for
+    each key of each request.
+
+  See `clnplugin-clj/codec`."
+  (:import [com.fasterxml.jackson.core JsonFactory JsonGenerator JsonGenerator$Feature JsonParser JsonParser$NumberType JsonToken])
+  (:import [com.fasterxml.jackson.core.json JsonWriteFeature])
+  (:import [java.util.concurrent ConcurrentHashMap]))
+
+(def ^:private ^JsonFactory factory
+  (-> (JsonFactory/builder)
+      ;; as clojure.data.json does by default
+      (.enable JsonWriteFeature/ESCAPE_NON_ASCII)
+      (.build)))
+
+(def ^:private ^ConcurrentHashMap keywords
+  "Cache of keywords by field name.  See `key->keyword`."
+  (ConcurrentHashMap.))
+
+(def ^:private max-cached-keywords
+  "Maximum number of keywords in `keywords` cache.
+
+  Field names of JSON objects are not all known in advance (for
+  instance the ids of the peers in some results are used as keys).
+  Once the cache is full, new field names are converted with
+  `keyword` without being cached."
+  8192)
+
+(defn- key->keyword
+  "Return the keyword of the field name K using `keywords` cache."
+  [^String k]
+  (or (.get keywords k)
+      (let [kw (keyword k)]
+        (when (< (.size keywords) max-cached-keywords)
+          (.putIfAbsent keywords k kw))
+        kw)))
+
+(declare parse-value)
+
+(defn- parse-object
+  "Return the JSON object P is positioned at as a map with keyword keys."
+  [^JsonParser p]
+  (loop [m (transient {})]
+    (if (= (.nextToken p) JsonToken/END_OBJECT)
+      (persistent! m)
+      (let [k (key->keyword (.currentName p))]
+        (.nextToken p)
+        (recur (assoc! m k (parse-value p)))))))
+
+(defn- parse-array
+  "Return the JSON array P is positioned at as a vector."
+  [^JsonParser p]
+  (loop [v (transient [])]
+    (if (= (.nextToken p) JsonToken/END_ARRAY)
+      (persistent! v)
+      (recur (conj! v (parse-value p))))))
+
+(defn- parse-value
+  "Return the JSON value of the current token of P.
+
+  Numbers are parsed as clojure.data.json does: integers as longs (or
+  bigints if they don't fit in a long) and decimals as doubles."
+  [^JsonParser p]
+  (let [t (.currentToken p)]
+    (cond
+      (= t JsonToken/START_OBJECT) (parse-object p)
+      (= t JsonToken/START_ARRAY) (parse-array p)
+      (= t JsonToken/VALUE_STRING) (.getText p)
+      (= t JsonToken/VALUE_NUMBER_INT) (if (= (.getNumberType p) JsonParser$NumberType/BIG_INTEGER)
+                                         (bigint (.getBigIntegerValue p))
+                                         (.getLongValue p))
+      (= t JsonToken/VALUE_NUMBER_FLOAT) (.getDoubleValue p)
+      (= t JsonToken/VALUE_TRUE) true
+      (= t JsonToken/VALUE_FALSE) false
+      (= t JsonToken/VALUE_NULL) nil
+      true (throw (ex-info (format "Unexpected JSON token '%s'" t) {})))))
+
+(defn- read-json
+  "Return the first JSON value in the LEN chars of BUF starting at OFFSET."
+  [^chars buf offset len]
+  (with-open [p (.createParser factory buf (int offset) (int len))]
+    (.nextToken p)
+    (parse-value p)))
+
+(defn- stringify
+  "Return X printed as by `print-method`."
+  [x]
+  (let [sw (java.io.StringWriter.)]
+    (print-method x sw)
+    (str sw)))
+
+(defn- write-value
+  "Write X with the JSON generator G.
+
+  Values are written as clojure.data.json does.  If LENIENT? is true,
+  objects we don't know how to write are written as strings with
+  `stringify`.  If not, we throw an exception."
+  [^JsonGenerator g x lenient?]
+  (cond
+    (nil? x) (.writeNull g)
+    (string? x) (.writeString g ^String x)
+    (or (map? x) (instance? java.util.Map x))
+    (do (.writeStartObject g)
+        (doseq [[k v] x]
+          (let [^String field (cond
+                                (instance? clojure.lang.Named k) (name k)
+                                (nil? k) (throw (Exception. "JSON object keys cannot be nil/null"))
+                                true (str k))]
+            (.writeFieldName g field))
+          (write-value g v lenient?))
+        (.writeEndObject g))
+    (instance? clojure.lang.Named x) (.writeString g ^String (name x))
+    (boolean? x) (.writeBoolean g (boolean x))
+    (or (instance? Long x) (instance? Integer x)
+        (instance? Short x) (instance? Byte x)) (.writeNumber g (long x))
+    (or (instance? Double x) (instance? Float x))
+    (let [d (double x)]
+      (if (or (Double/isNaN d) (Double/isInfinite d))
+        (throw (Exception. (format "JSON cannot encode non-finite number %s" d)))
+        (.writeNumber g d)))
+    (instance? clojure.lang.BigInt x) (.writeNumber g (.toBigInteger ^clojure.lang.BigInt x))
+    (instance? java.math.BigInteger x) (.writeNumber g ^java.math.BigInteger x)
+    (instance? java.math.BigDecimal x) (.writeNumber g ^java.math.BigDecimal x)
+    (ratio? x) (.writeNumber g (double x))
+    (or (sequential? x) (set? x) (instance? java.util.Collection x)
+        (some-> x class .isArray))
+    (do (.writeStartArray g)
+        (doseq [v x] (write-value g v lenient?))
+        (.writeEndArray g))
+    (or (instance? Character x) (uuid? x) (instance? java.time.Instant x))
+    (.writeString g ^String (str x))
+    (instance? java.util.Date x) (.writeString g ^String (str (.toInstant ^java.util.Date x)))
+    lenient? (.writeString g ^String (stringify x))
+    true (throw (Exception. (format "Don't know how to write JSON of %s" (class x))))))
+
+(defn- write-json
+  "Write X as JSON to OUT, a java.io.Writer.  See `write-value`."
+  [x ^java.io.Writer out lenient?]
+  (let [g (doto (.createGenerator factory out)
+            (.disable JsonGenerator$Feature/AUTO_CLOSE_TARGET)
+            (.disable JsonGenerator$Feature/FLUSH_PASSED_TO_STREAM))]
+    (write-value g x lenient?)
+    ;; write what's buffered in g to out without flushing out
+    (.flush g)))
+
+(def codec
+  "The Jackson codec.  See `clnplugin-clj/codec`."
+  {:name :jackson
+   :read read-json
+   :write (fn [x out] (write-json x out false))
+   :write-lenient (fn [x out] (write-json x out true))})
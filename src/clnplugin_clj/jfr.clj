@@ -0,0 +1,84 @@
+(ns clnplugin-clj.jfr
+  "Java Flight Recorder events of clnplugin-clj.
+
+  This namespace is loaded by plugins declaring :jfr true:
+
+      {:jfr true
+       ,,,}
+
+  in which case we commit a \"clnplugin.Request\" event for each
+  request processed by the plugin, with the timings of its span (see
+  `clnplugin-clj/tracer`).  Events are recorded only while a recording
+  is running, for instance if the plugin has been started with
+
+      -XX:StartFlightRecording=filename=myplugin.jfr
+
+  JVM option or if a recording has been started with
+
+      jcmd <pid> JFR.start
+
+  and they can be inspected with JDK Mission Control or with:
+
+      jfr print --events clnplugin.Request myplugin.jfr
+
+  The event type is created at runtime with `jdk.jfr.EventFactory`
+  (JDK 11 and above), so clnplugin-clj doesn't need to be AOT
+  compiled to define it."
+  (:import [jdk.jfr AnnotationElement Category Description Event EventFactory Label Name Timespan ValueDescriptor]))
+
+(def ^:private fields
+  "Fields of \"clnplugin.Request\" events as [name type label description] vectors.
+
+  Durations are in nanoseconds."
+  [["id" String "Request Id" "Id of the request, as set by lightningd (cli:foo#49479/cln:foo#66752)"]
+   ["method" String "Method" "Method of the request or topic of the notification"]
+   ["outcome" String "Outcome" "ok, error, timeout or rejected"]
+   ["readTime" Long/TYPE "Read Time" "Time to parse the request"]
+   ["queueTime" Long/TYPE "Queue Time" "Time spent in the scheduler's queue"]
+   ["handlerTime" Long/TYPE "Handler Time" "Time from the call of :fn to its result"]
+   ["writeTime" Long/TYPE "Write Time" "Time to serialize the response"]])
+
+(defn- value-descriptor
+  "Return the jdk.jfr.ValueDescriptor of the field [NAME TYPE LABEL DESCRIPTION]."
+  [[name type label description]]
+  (let [^java.util.List annotations
+        (cond-> [(AnnotationElement. Label label)
+                 (AnnotationElement. Description description)]
+          (= type Long/TYPE) (conj (AnnotationElement. Timespan Timespan/NANOSECONDS)))]
+    (ValueDescriptor. ^Class type ^String name annotations)))
+
+(def ^:private factory
+  (delay
+    (doto (EventFactory/create
+           [(AnnotationElement. Name "clnplugin.Request")
+            (AnnotationElement. Label "Plugin Request")
+            (AnnotationElement. Category (into-array String ["clnplugin-clj"]))
+            (AnnotationElement. Description "Request or notification processed by a clnplugin-clj plugin")]
+           (mapv value-descriptor fields))
+      (.register))))
+
+(defn- commit!
+  "Commit a \"clnplugin.Request\" event with the timings of SPAN.
+
+  Nothing is allocated if no recording is running.
+  See `clnplugin-clj/tracer`."
+  [span]
+  (let [^EventFactory f @factory]
+    (when (.isEnabled (.getEventType f))
+      (let [^Event e (.newEvent f)]
+        (doto e
+          (.set 0 (some-> (:id span) str))
+          (.set 1 (:method span))
+          (.set 2 (some-> (:outcome span) name))
+          (.set 3 (long (:read-ns span 0)))
+          (.set 4 (long (:queue-ns span 0)))
+          (.set 5 (long (:handler-ns span 0)))
+          (.set 6 (long (:write-ns span 0)))
+          (.commit))))))
+
+(defn tracer
+  "Return the tracer committing a JFR event per span.  See `clnplugin-clj/tracer`."
+  []
+  ;; create and register the event type now rather than on the first request
+  @factory
+  commit!)
@@ -2,6 +2,7 @@
   "Test clnplugin-clj library."
   (:require [clojure.test :refer :all])
   (:require [clnplugin-clj :as plugin])
+  (:require [clnplugin-clj.host :as host])
   (:require [clojure.data.json :as json])
   (:require [clojure.string :as str]))
 
@@ -210,7 +211,96 @@
   (is (thrown-with-msg?
        Throwable
        #"Error in ':foo' RPC method definition.  :fn must be a function not 'some-symbol' which is an instance of 'class clojure.lang.Symbol'"
-       (#'plugin/gm-rpcmethods {:foo {:fn 'some-symbol}}))))
+       (#'plugin/gm-rpcmethods {:foo {:fn 'some-symbol}})))
+  ;; :executor
+  (is (= (#'plugin/gm-rpcmethods
+          {:foo {:executor :virtual
+                 :fn (fn [params req plugin])}})
+         [{:name "foo" :usage "" :description ""}]))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :executor ':not-an-executor' for ':foo'.  Authorized executors are: :blocking, :cpu, :virtual."
+       (#'plugin/gm-rpcmethods {:foo {:executor :not-an-executor
+                                      :fn (fn [params req plugin])}})))
+  ;; :max-parallel, :timeout-ms and :shed
+  (is (= (#'plugin/gm-rpcmethods
+          {:foo {:max-parallel 2 :timeout-ms 1000
+                 :fn (fn [params req plugin])}})
+         [{:name "foo" :usage "" :description ""}]))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :timeout-ms '-1' for ':foo'.  It must be a positive integer."
+       (#'plugin/gm-rpcmethods {:foo {:timeout-ms -1
+                                      :fn (fn [params req plugin])}})))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :max-parallel 'foo' for ':foo'.  It must be a positive integer."
+       (#'plugin/gm-rpcmethods {:foo {:max-parallel "foo"
+                                      :fn (fn [params req plugin])}})))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :shed ':foo' for ':bar'.  Authorized values are: :drop, :coalesce, :queue."
+       (#'plugin/gm-subscriptions {:bar {:shed :foo
+                                         :fn (fn [params req plugin])}})))
+  ;; :batch
+  (is (= (#'plugin/gm-subscriptions {:forward_event {:batch {:max-size 500 :max-wait-ms 50}
+                                                     :fn (fn [params req plugin])}})
+         ["forward_event"]))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :batch '\{:max-size 0\}' for ':forward_event'.  :max-size and :max-wait-ms must be positive integers."
+       (#'plugin/gm-subscriptions {:forward_event {:batch {:max-size 0}
+                                                   :fn (fn [params req plugin])}})))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :batch for ':forward_event'.  :inline subscriptions can't have a :batch."
+       (#'plugin/gm-subscriptions {:forward_event {:batch {} :inline true
+                                                   :fn (fn [params req plugin])}})))
+  ;; :inline
+  (is (= (#'plugin/gm-hooks {:peer_connected {:inline true :inline-budget-ms 2
+                                              :fn (fn [params req plugin])}})
+         [{:name "peer_connected"}]))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :inline 'yes' for ':foo'.  It must be a boolean."
+       (#'plugin/gm-rpcmethods {:foo {:inline "yes"
+                                      :fn (fn [params req plugin])}})))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :timeout-ms for ':foo'.  :inline methods can't have a :timeout-ms."
+       (#'plugin/gm-rpcmethods {:foo {:inline true :timeout-ms 100
+                                      :fn (fn [params req plugin])}})))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :inline-budget-ms '0' for ':foo'.  It must be a positive integer."
+       (#'plugin/gm-rpcmethods {:foo {:inline true :inline-budget-ms 0
+                                      :fn (fn [params req plugin])}})))
+  ;; :cache
+  (is (= (#'plugin/gm-rpcmethods
+          {:foo {:cache {:ttl-ms 1000 :max-entries 10 :keys [:bar]
+                         :invalidate-on ["invoice_payment" :invoice_creation]}
+                 :fn (fn [params req plugin])}})
+         [{:name "foo" :usage "" :description ""}]))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :cache '\{:max-entries 10\}' for ':foo'.  :ttl-ms \(mandatory\) and :max-entries must be positive integers."
+       (#'plugin/gm-rpcmethods {:foo {:cache {:max-entries 10}
+                                      :fn (fn [params req plugin])}})))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :cache .* for ':foo'.  :ttl-ms \(mandatory\) and :max-entries must be positive integers."
+       (#'plugin/gm-rpcmethods {:foo {:cache {:ttl-ms 1000 :max-entries 0}
+                                      :fn (fn [params req plugin])}})))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :keys '\[\"bar\"\]' in :cache of ':foo'.  It must be a vector of keywords."
+       (#'plugin/gm-rpcmethods {:foo {:cache {:ttl-ms 1000 :keys ["bar"]}
+                                      :fn (fn [params req plugin])}})))
+  (is (thrown-with-msg?
+       Throwable
+       #"Wrong :invalidate-on 'invoice_payment' in :cache of ':foo'.  It must be a vector of notification topics."
+       (#'plugin/gm-rpcmethods {:foo {:cache {:ttl-ms 1000 :invalidate-on "invoice_payment"}
+                                      :fn (fn [params req plugin])}}))))
 
 (deftest gm-notifications-test
   (is (= (#'plugin/gm-notifications nil) nil))
@@ -446,6 +536,14 @@
          (#'plugin/gm-resp req plugin)))))
 
 (deftest set-defaults!-test
+  (let [plugin (atom {:stats-method :myplugin-stats
+                      :rpcmethods {:foo 'foo}})]
+    (#'plugin/set-defaults! plugin)
+    (is (= (keys (:rpcmethods @plugin)) [:foo :myplugin-stats]))
+    (is (= (#'plugin/gm-rpcmethods (dissoc (:rpcmethods @plugin) :foo))
+           [{:name "myplugin-stats" :usage "" :description "Return the metrics of the plugin"}]))
+    (is (= (:methods ((get-in @plugin [:rpcmethods :myplugin-stats :fn]) {} {} plugin))
+           {})))
   (is (= (let [plugin (atom nil)]
            (#'plugin/set-defaults! plugin)
            @plugin)
@@ -484,7 +582,19 @@
            @plugin)
          {:options {:opt1 'opt1}
           :rpcmethods {:foo 'foo}
-          :dynamic false})))
+          :dynamic false}))
+  ;; subscribe to the topics invalidating caches
+  (let [plugin (atom {:rpcmethods {:foo {:cache {:ttl-ms 1000 :invalidate-on ["invoice_payment" :invoice_creation]}}
+                                   :bar {:cache {:ttl-ms 1000 :invalidate-on ["invoice_payment"]}}}
+                      :subscriptions {:invoice_creation {:fn 'invoice-creation}}})]
+    (#'plugin/set-defaults! plugin)
+    (is (= (set (keys (:subscriptions @plugin))) #{:invoice_payment :invoice_creation}))
+    (is (= (get-in @plugin [:subscriptions :invoice_creation :fn]) 'invoice-creation))
+    (is (nil? ((get-in @plugin [:subscriptions :invoice_payment :fn]) {} {} plugin))))
+  (let [plugin (atom {:rpcmethods {:foo {:cache {:ttl-ms 1000 :invalidate-on ["invoice_payment"]}}}
+                      :subscriptions {:* {:fn 'all}}})]
+    (#'plugin/set-defaults! plugin)
+    (is (= (:subscriptions @plugin) {:* {:fn 'all}}))))
 
 (deftest add-request!-test
   (is (= (let [plugin (atom nil)
@@ -984,9 +1094,9 @@
         resp-2 {:jsonrpc "2.0" :id "id-2" :result nil}
         resp-3 {:jsonrpc "2.0" :id "id-3" :error {:code -32600 :message "Something wrong happened"}}
         resp-4 {:jsonrpc "2.0" :method "log" :params {:level "debug" :message "Some message"}}]
-    (#'plugin/write nil [['req-0 resp-0]] out)
-    (#'plugin/write nil [['req-0 resp-0] ['req-1 resp-1] ['req-2 resp-2] ['req-3 resp-3]] out)
-    (#'plugin/write nil [[nil resp-4]] out)
+    (#'plugin/write [['req-0 resp-0]] out)
+    (#'plugin/write [['req-0 resp-0] ['req-1 resp-1] ['req-2 resp-2] ['req-3 resp-3]] out)
+    (#'plugin/write [[nil resp-4]] out)
     (let [outs (str/split (str out) #"\n\n")
           resps (map #(json/read-str % :key-fn keyword) outs)]
       (is (= resps (list resp-0
@@ -999,7 +1109,7 @@
   (let [out (new java.io.StringWriter)
         req {:jsonrpc "2.0" :id "some-id" :method "foo" :params {:bar "baz"}}
         resp {:jsonrpc "2.0" :id "some-id" :result (atom nil)}]
-    (#'plugin/write nil [[req resp]] out)
+    (#'plugin/write [[req resp]] out)
     (let [outs (str/split (str out) #"\n\n")
           resp-and-logs (map #(json/read-str % :key-fn keyword) outs)
           err (some #(when (= (:id %) "some-id") %) resp-and-logs)]
@@ -1028,7 +1138,7 @@
   (let [out (new java.io.StringWriter)
         req {:jsonrpc "2.0" :id "some-id" :method "foo" :params {:bar "baz"}}
         resp {:jsonrpc "2.0" :id "some-id" :error (atom nil)}]
-    (#'plugin/write nil [[req resp]] out)
+    (#'plugin/write [[req resp]] out)
     (let [outs (str/split (str out) #"\n\n")
           resp-and-logs (map #(json/read-str % :key-fn keyword) outs)
           err (some #(when (= (:id %) "some-id") %) resp-and-logs)]
@@ -1056,7 +1166,7 @@
   ;; notifications
   (let [out (new java.io.StringWriter)
         notif {:jsonrpc "2.0" :method "some-notif" :params (atom nil)}]
-    (#'plugin/write nil [[nil notif]] out)
+    (#'plugin/write [[nil notif]] out)
     (let [outs (str/split (str out) #"\n\n")
           logs (map #(json/read-str % :key-fn keyword) outs)]
       ;; logs
@@ -1069,72 +1179,334 @@
                           (get-in % [:params :message]))
                 logs)))))
 
+(deftest error-truncation-test
+  (let [big-req {:jsonrpc "2.0" :id "some-id" :method "foo"
+                 :params {:onion (apply str (repeat 100000 "a"))}}]
+    ;; error-max-chars
+    (is (= (#'plugin/error-max-chars {}) 2048))
+    (is (= (#'plugin/error-max-chars {:error-max-chars 100}) 100))
+    (is (thrown-with-msg?
+         clojure.lang.ExceptionInfo
+         #"Wrong :error-max-chars '0'.  It must be a positive integer."
+         (#'plugin/error-max-chars {:error-max-chars 0})))
+    ;; truncated-str
+    (is (= (#'plugin/truncated-str {:foo "bar"} 100) "{:foo \"bar\"}"))
+    (is (= (#'plugin/truncated-str {:foo "bar"} 12) "{:foo \"bar\"}"))
+    (is (= (#'plugin/truncated-str {:foo "bar"} 11) "{:foo \"bar\"...(truncated)"))
+    (is (= (#'plugin/truncated-str "foo-bar" 3) "foo...(truncated)"))
+    (is (= (#'plugin/truncated-str big-req 100)
+           (str (subs (str big-req) 0 100) "...(truncated)")))
+    (is (= (#'plugin/truncated {:foo "bar"} 100) {:foo "bar"}))
+    (is (= (#'plugin/truncated {:foo "bar"} 5) "{:foo...(truncated)"))
+    ;; error-resp
+    (let [[log-msgs resp] (#'plugin/error-resp big-req (Exception. "boom") 100)]
+      (is (every? #(< (count %) 200) log-msgs))
+      (is (= (get-in resp [:error :message])
+             (format "Error while processing '%s...(truncated)'" (subs (str big-req) 0 100))))
+      (is (re-find #"(?s)^#error.*\.\.\.\(truncated\)$" (get-in resp [:error :exception]))))
+    ;; failing :fn with :error-max-chars set in the plugin
+    (let [plugin (atom {:error-max-chars 100
+                        :rpcmethods {:foo {:fn (fn [params req plugin]
+                                                 (throw (Exception. "boom")))}}})
+          [log-msgs resp] (#'plugin/process big-req plugin)]
+      (is (< (count (get-in resp [:error :message])) 200)))
+    ;; timeout-resp
+    (let [[[msg] resp] (#'plugin/timeout-resp big-req 100 100)]
+      (is (< (count msg) 200))
+      (is (= (get-in resp [:error :message]) msg)))
+    ;; non JSON writable responses
+    (let [out (new java.io.StringWriter)
+          resp {:jsonrpc "2.0" :id "some-id"
+                :result {:foo (apply str (repeat 100000 "b")) :bar (atom nil)}}]
+      (#'plugin/write [[big-req resp]] out (#'plugin/codec nil) 100)
+      (let [resps-and-logs (map #(json/read-str % :key-fn keyword) (str/split (str out) #"\n\n"))
+            err (some #(when (= (:id %) "some-id") %) resps-and-logs)]
+        (is (< (count (str out)) 2000))
+        (is (= (get-in err [:error :request])
+               (str (subs (str big-req) 0 100) "...(truncated)")))
+        (is (re-find #"\.\.\.\(truncated\)$" (get-in err [:error :response])))))
+    (let [out (new java.io.StringWriter)
+          notif {:jsonrpc "2.0" :method "some-notif"
+                 :params {:foo (apply str (repeat 100000 "b")) :bar (atom nil)}}]
+      (#'plugin/write [[nil notif]] out (#'plugin/codec nil) 100)
+      (is (< (count (str out)) 2000))
+      (is (re-find #"Error while sending notification.*some-notif.*\.\.\.\(truncated\)" (str out))))))
+
+(defn- allocated-bytes
+  "Return the number of bytes allocated so far by the current thread."
+  []
+  (.getThreadAllocatedBytes
+   ^com.sun.management.ThreadMXBean (java.lang.management.ManagementFactory/getThreadMXBean)
+   (.getId (Thread/currentThread))))
+
+(deftest process-allocation-test
+  ;; requests that succeed are never printed, so the bytes allocated
+  ;; to process them don't depend on their size
+  (let [plugin (atom {:rpcmethods {:foo {:fn (fn [params req plugin] {})}}
+                      :_dispatch-table (volatile! nil)})
+        small-req {:jsonrpc "2.0" :id 1 :method "foo" :params {}}
+        big-req {:jsonrpc "2.0" :id 1 :method "foo"
+                 :params {:onion (vec (repeat 1000 (apply str (repeat 100 "a"))))}}
+        bytes-per-req (fn [req]
+                        (dotimes [_ 10000] (#'plugin/process req plugin))
+                        (let [n 10000
+                              start (allocated-bytes)]
+                          (dotimes [_ n] (#'plugin/process req plugin))
+                          (/ (- (allocated-bytes) start) n)))
+        small (bytes-per-req small-req)
+        big (bytes-per-req big-req)]
+    (is (< big (+ small 1024)))))
+
+(deftest writer-test
+  ;; messages are written in order, and those queued while the writer
+  ;; is busy are flushed together
+  (let [flushes (atom 0)
+        gate (java.util.concurrent.CountDownLatch. 1)
+        out (proxy [java.io.StringWriter] []
+              (flush []
+                (.await gate)
+                (swap! flushes inc)))
+        w (#'plugin/writer out)
+        notifs (for [i (range 100)]
+                 {:jsonrpc "2.0" :method "foo" :params {:i i}})]
+    (#'plugin/write! w [[nil (first notifs)]])
+    ;; the writer is now blocked flushing the first notification
+    (Thread/sleep 100)
+    (doseq [n (rest notifs)]
+      (#'plugin/write! w [[nil n]]))
+    (.countDown gate)
+    (#'plugin/drain! w)
+    (is (<= @flushes 2))
+    (is (= (map #(json/read-str % :key-fn keyword) (str/split (str out) #"\n\n"))
+           notifs)))
+  ;; non JSON writable responses are replaced by an error without
+  ;; leaving partially written JSON in the output
+  (let [out (new java.io.StringWriter)
+        w (#'plugin/writer out)
+        req {:jsonrpc "2.0" :id "some-id" :method "foo" :params {}}]
+    (#'plugin/write! w [[req {:jsonrpc "2.0" :id "some-id" :result {:foo "bar" :baz (atom nil)}}]
+                        [nil {:jsonrpc "2.0" :method "some-notif" :params {:foo "bar" :baz (atom nil)}}]
+                        [req {:jsonrpc "2.0" :id "some-id" :result {:foo "bar"}}]])
+    (#'plugin/drain! w)
+    (let [resps-and-logs (map #(json/read-str % :key-fn keyword) (str/split (str out) #"\n\n"))]
+      (is (re-find #"Error while processing.*:method.*foo"
+                   (get-in (first (filter :id resps-and-logs)) [:error :message])))
+      (is (= (last resps-and-logs)
+             {:jsonrpc "2.0" :id "some-id" :result {:foo "bar"}}))))
+  ;; a response that can't be written even as an error (non finite
+  ;; doubles are refused by the codec) is replaced by an error with
+  ;; its id, and the responses queued with it are still written
+  (let [out (new java.io.StringWriter)
+        w (#'plugin/writer out)
+        req (fn [id] {:jsonrpc "2.0" :id id :method "foo" :params {}})]
+    (#'plugin/write! w [[(req 1) {:jsonrpc "2.0" :id 1 :result {:foo "bar"}}]
+                        [(req 2) {:jsonrpc "2.0" :id 2 :result {:foo ##NaN}}]
+                        [nil {:jsonrpc "2.0" :method "some-notif" :params {:foo ##Inf}}]
+                        [(req 3) {:jsonrpc "2.0" :id 3 :result {:foo "baz"}}]])
+    (#'plugin/write! w [[(req 4) {:jsonrpc "2.0" :id 4 :result {:foo "qux"}}]])
+    (#'plugin/drain! w)
+    (let [resps-and-logs (map #(json/read-str % :key-fn keyword) (str/split (str out) #"\n\n"))
+          resps (filter :id resps-and-logs)
+          logs (map #(get-in % [:params :message]) (remove :id resps-and-logs))]
+      (is (= (map :id resps) [1 2 3 4]))
+      (is (= (map :result resps) [{:foo "bar"} nil {:foo "baz"} {:foo "qux"}]))
+      (is (re-find #"Error while writing the response to.*:id 2"
+                   (get-in (second resps) [:error :message])))
+      (is (some #(re-find #"Error while writing the response to.*:id 2" %) logs))
+      (is (some #(re-find #"Error while sending notification.*some-notif" %) logs)))))
+
 (deftest log-test
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         message "foo"]
     ;; test that notify returns nil so that it can be used
     ;; as last expression in :fn of RPC methods which expect
     ;; a json writable object as last expression
     (is (nil? (plugin/log message plugin)))
-    (await (:_resps @plugin))
-    (Thread/sleep 100) ;; if we don't wait, :_out would be empty
-    (is (= (json/read-str (str (:_out @plugin)) :key-fn keyword)
+    (#'plugin/drain! (:_writer @plugin))
+    (is (= (json/read-str (str (:out (:_writer @plugin))) :key-fn keyword)
            {:jsonrpc "2.0"
             :method "log"
             :params {:level "info" :message "foo"}})))
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         message "bar"
         level "debug"]
     (is (nil? (plugin/log message level plugin)))
-    (await (:_resps @plugin))
-    (Thread/sleep 100) ;; if we don't wait, :_out would be empty
-    (is (= (json/read-str (str (:_out @plugin)) :key-fn keyword)
+    (#'plugin/drain! (:_writer @plugin))
+    (is (= (json/read-str (str (:out (:_writer @plugin))) :key-fn keyword)
            {:jsonrpc "2.0"
             :method "log"
             :params {:level "debug" :message "bar"}})))
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         message "foo-1\nfoo-2\nfoo-3\n"]
     (plugin/log message plugin)
-    (await (:_resps @plugin))
-    (Thread/sleep 100) ;; if we don't wait, :_out would be empty
-    (is (= (let [srdr (java.io.StringReader. (str (:_out @plugin)))
+    (#'plugin/drain! (:_writer @plugin))
+    (is (= (let [srdr (java.io.StringReader. (str (:out (:_writer @plugin))))
                  pbr (java.io.PushbackReader. srdr 64)]
              (for [_ (range 3)]
                (json/read pbr :key-fn keyword)))
            '({:jsonrpc "2.0", :method "log", :params {:level "info", :message "foo-1"}}
              {:jsonrpc "2.0", :method "log", :params {:level "info", :message "foo-2"}}
              {:jsonrpc "2.0", :method "log", :params {:level "info", :message "foo-3"}}))))
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         message 'not-a-string]
     (is (thrown-with-msg?
          Throwable
          #"Assert failed: \(string\? message\)"
          (plugin/log message plugin)))))
 
+(deftest log-level-test
+  (is (= (#'plugin/min-log-level {}) 0))
+  (is (= (#'plugin/min-log-level {:log-level "info"}) 2))
+  (is (= (#'plugin/min-log-level {:log-level "info:plugin-myplugin"}) 2))
+  ;; only :log-level of the plugin is honoured, lightningd doesn't
+  ;; send its log-level in the init request
+  (is (= (#'plugin/min-log-level {:init {:configuration {:log-level "unusual"}}}) 0))
+  (is (= (#'plugin/min-log-level {:log-level "debug"
+                                  :init {:configuration {:log-level "unusual"}}}) 1))
+  (is (= (#'plugin/min-log-level {:log-level "foo"}) 0))
+  ;; lightningd's log-level got after the init round
+  (is (= (#'plugin/min-log-level {:_log-level "info"}) 2))
+  (is (= (#'plugin/min-log-level {:log-level "debug" :_log-level "info"}) 1))
+  (is (plugin/log-enabled? "debug" (atom {})))
+  (is (not (plugin/log-enabled? "debug" (atom {:log-level "info"}))))
+  (is (plugin/log-enabled? "broken" (atom {:log-level "info"})))
+  ;; messages below the log level are dropped
+  (let [plugin (atom {:log-level "info"
+                      :_writer (#'plugin/writer (new java.io.StringWriter))})]
+    (plugin/log "dropped" "debug" plugin)
+    (plugin/log "dropped" "io" plugin)
+    (plugin/log "kept" "unusual" plugin)
+    (#'plugin/drain! (:_writer @plugin))
+    (is (= (json/read-str (str (:out (:_writer @plugin))) :key-fn keyword)
+           {:jsonrpc "2.0"
+            :method "log"
+            :params {:level "unusual" :message "kept"}})))
+  ;; the precondition still holds for dropped messages
+  (let [plugin (atom {:log-level "info"
+                      :_writer (#'plugin/writer (new java.io.StringWriter))})]
+    (is (thrown-with-msg?
+         Throwable
+         #"Assert failed: \(string\? message\)"
+         (plugin/log 'not-a-string "debug" plugin)))))
+
+(deftest log-rate-limit-test
+  (is (nil? (#'plugin/log-limiter nil)))
+  (is (thrown-with-msg?
+       clojure.lang.ExceptionInfo
+       #"Wrong :log-rate-limit"
+       (#'plugin/log-limiter {:messages 0 :per-ms 1000})))
+  (is (thrown-with-msg?
+       clojure.lang.ExceptionInfo
+       #"Wrong :log-rate-limit"
+       (#'plugin/log-limiter {:messages 10})))
+  ;; allow-log!
+  (let [limiter (#'plugin/log-limiter {:messages 2 :per-ms 200})
+        rate {:messages 2 :per-ms 200}]
+    (is (= (#'plugin/allow-log! limiter "site-a" rate) [true 0]))
+    (is (= (#'plugin/allow-log! limiter "site-a" rate) [true 0]))
+    (is (= (#'plugin/allow-log! limiter "site-a" rate) [false 0]))
+    (is (= (#'plugin/allow-log! limiter "site-a" rate) [false 0]))
+    ;; call sites are limited independently
+    (is (= (#'plugin/allow-log! limiter "site-b" rate) [true 0]))
+    (Thread/sleep 250)
+    ;; new window, we report the 2 suppressed messages
+    (is (= (#'plugin/allow-log! limiter "site-a" rate) [true 2]))
+    (is (= (#'plugin/allow-log! limiter "site-a" rate) [true 0])))
+  ;; log
+  (let [rate {:messages 3 :per-ms 200}
+        plugin (atom {:log-rate-limit rate
+                      :_log-limiter (#'plugin/log-limiter rate)
+                      :_writer (#'plugin/writer (new java.io.StringWriter))})
+        read-notifs (fn []
+                      (#'plugin/drain! (:_writer @plugin))
+                      (let [out (str (:out (:_writer @plugin)))
+                            pbr (java.io.PushbackReader. (java.io.StringReader. out) 64)]
+                        (take-while some? (repeatedly #(json/read pbr :eof-error? false :key-fn keyword)))))
+        ;; same call site for all the messages
+        log-it (fn [message] (plugin/log message plugin))]
+    (dotimes [i 10]
+      (log-it (str "foo-" i)))
+    (is (= (map (comp :message :params) (read-notifs))
+           ["foo-0" "foo-1" "foo-2"]))
+    (Thread/sleep 250)
+    (dotimes [i 10]
+      (log-it (str "bar-" i)))
+    (let [messages (map (comp :message :params) (read-notifs))]
+      (is (= (count messages) 7))
+      (is (re-matches #"7 log messages suppressed at clnplugin_clj_test\.clj:\d+"
+                      (nth messages 3)))
+      (is (= (drop 4 messages) ["bar-0" "bar-1" "bar-2"]))))
+  ;; suppressed messages of a burst followed by silence are reported
+  ;; at the end of the window, or when lightningd closes the connection
+  (let [rate {:messages 3 :per-ms 200}
+        timer (java.util.concurrent.Executors/newSingleThreadScheduledExecutor)
+        plugin (atom {:log-rate-limit rate
+                      :_log-limiter (#'plugin/log-limiter rate)
+                      :_executors {:timer timer}
+                      :_writer (#'plugin/writer (new java.io.StringWriter))})
+        read-notifs (fn []
+                      (#'plugin/drain! (:_writer @plugin))
+                      (let [out (str (:out (:_writer @plugin)))
+                            pbr (java.io.PushbackReader. (java.io.StringReader. out) 64)]
+                        (take-while some? (repeatedly #(json/read pbr :eof-error? false :key-fn keyword)))))
+        log-it (fn [message] (plugin/log message plugin))]
+    (dotimes [i 10]
+      (log-it (str "foo-" i)))
+    (is (= (map (comp :message :params) (read-notifs))
+           ["foo-0" "foo-1" "foo-2"]))
+    (Thread/sleep 300)
+    (let [notifs (read-notifs)]
+      (is (= (count notifs) 4))
+      (is (= (:level (:params (last notifs))) "unusual"))
+      (is (re-matches #"7 log messages suppressed at clnplugin_clj_test\.clj:\d+"
+                      (:message (:params (last notifs))))))
+    ;; reported once: the next window has nothing to report
+    (log-it "bar-0")
+    (is (= (:message (:params (last (read-notifs)))) "bar-0"))
+    ;; nil start reports whatever the window, as `run` does at the end
+    (dotimes [i 5]
+      (log-it (str "baz-" i)))
+    (let [site (first (.keySet ^java.util.concurrent.ConcurrentHashMap (:_log-limiter @plugin)))]
+      (#'plugin/flush-suppressed! plugin site nil)
+      (#'plugin/flush-suppressed! plugin site nil))
+    (let [messages (map (comp :message :params) (read-notifs))]
+      (is (= (count messages) 8))
+      (is (re-matches #"3 log messages suppressed at clnplugin_clj_test\.clj:\d+"
+                      (last messages))))
+    (.shutdownNow timer)))
+
+(deftest log-multi-lines-test
+  ;; multi-line messages are queued at once, so their notifications
+  ;; are written together in the same batch
+  (let [queue (java.util.concurrent.LinkedBlockingQueue.)
+        plugin (atom {:_writer {:queue queue}})]
+    (plugin/log "foo-1\nfoo-2\nfoo-3" plugin)
+    (is (= (.size queue) 1))
+    (is (= (map (comp :message :params second) (.take queue))
+           ["foo-1" "foo-2" "foo-3"]))))
+
 (deftest notify-test
   ;; In these tests, we don't specify :notifications in plugin,
   ;; because clnplugin-clj doesn't check if we've declared the
   ;; notifications to lightningd during the getmanifest round.  We
   ;; just send the notification always.  lightningd will ignore it
   ;; if it had to and log a message.
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         topic "foo" params {:bar "baz"}]
     ;; test that notify returns nil so that it can be used
     ;; as last expression in :fn of RPC methods which expect
     ;; a json writable object as last expression
     (is (nil? (plugin/notify topic params plugin)))
-    (await (:_resps @plugin))
-    (Thread/sleep 100) ;; if we don't wait, :_out would be empty
-    (is (= (json/read-str (str (:_out @plugin)) :key-fn keyword)
+    (#'plugin/drain! (:_writer @plugin))
+    (is (= (json/read-str (str (:out (:_writer @plugin))) :key-fn keyword)
            {:jsonrpc "2.0" :method topic :params params})))
   ;; non json writable in :params of the notification we
   ;; try to send to lightningd.  So we log it
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         topic "foo" params (atom nil)]
     (plugin/notify topic params plugin)
-    (await (:_resps @plugin))
-    (Thread/sleep 100)
-    (let [outs (str/split (str (:_out @plugin)) #"\n\n")
+    (#'plugin/drain! (:_writer @plugin))
+    (let [outs (str/split (str (:out (:_writer @plugin))) #"\n\n")
           logs (map #(json/read-str % :key-fn keyword) outs)]
       ;; logs
       (is (some #(re-find #"Error while sending notification.*:method.*foo"
@@ -1147,29 +1519,27 @@
                 logs)))))
 
 (deftest notify-message-test
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         message "foo"
         req {:id 16}]
     (is (nil? (plugin/notify-message message req plugin)))
-    (await (:_resps @plugin))
-    (Thread/sleep 100) ;; if we don't wait, :_out would be empty
-    (is (= (json/read-str (str (:_out @plugin)) :key-fn keyword)
+    (#'plugin/drain! (:_writer @plugin))
+    (is (= (json/read-str (str (:out (:_writer @plugin))) :key-fn keyword)
            {:jsonrpc "2.0"
             :method "message"
             :params {:id 16 :level "info" :message "foo"}})))
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         message "foo"
         level "debug"
         req {:id 16}]
     (is (nil? (plugin/notify-message message level req plugin)))
-    (await (:_resps @plugin))
-    (Thread/sleep 100) ;; if we don't wait, :_out would be empty
-    (is (= (json/read-str (str (:_out @plugin)) :key-fn keyword)
+    (#'plugin/drain! (:_writer @plugin))
+    (is (= (json/read-str (str (:out (:_writer @plugin))) :key-fn keyword)
            {:jsonrpc "2.0"
             :method "message"
             :params {:id 16 :level "debug" :message "foo"}})))
   ;; error if message is not a string
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         message 'not-a-string
         req {:id 16}]
     (is (thrown-with-msg?
@@ -1178,31 +1548,29 @@
          (plugin/notify-message message req plugin)))))
 
 (deftest notify-progress-test
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         step 0
         total-steps 3
         req {:id 16}]
     (is (nil? (plugin/notify-progress step total-steps req plugin)))
-    (await (:_resps @plugin))
-    (Thread/sleep 100) ;; if we don't wait, :_out would be empty
-    (is (= (json/read-str (str (:_out @plugin)) :key-fn keyword)
+    (#'plugin/drain! (:_writer @plugin))
+    (is (= (json/read-str (str (:out (:_writer @plugin))) :key-fn keyword)
            {:jsonrpc "2.0"
             :method "progress"
             :params {:id 16 :num 0 :total 3}})))
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         step 1 total-steps 3
         stage 1 total-stages 5
         req {:id 16}]
     (is (nil? (plugin/notify-progress step total-steps stage total-stages req plugin)))
-    (await (:_resps @plugin))
-    (Thread/sleep 100) ;; if we don't wait, :_out would be empty
-    (is (= (json/read-str (str (:_out @plugin)) :key-fn keyword)
+    (#'plugin/drain! (:_writer @plugin))
+    (is (= (json/read-str (str (:out (:_writer @plugin))) :key-fn keyword)
            {:jsonrpc "2.0"
             :method "progress"
             :params {:id 16 :num 1 :total 3
                      :stage {:num 1 :total 5}}})))
   ;; error: step must be < to total-steps
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         step 3
         total-steps 3
         req {:id 16}]
@@ -1212,7 +1580,7 @@
          (plugin/notify-progress step total-steps req plugin)))
     )
   ;; error: stage must be < to total-stages
-  (let [plugin (atom {:_resps (agent nil) :_out (new java.io.StringWriter)})
+  (let [plugin (atom {:_writer (#'plugin/writer (new java.io.StringWriter))})
         step 1 total-steps 3
         stage 3 total-stages 3
         req {:id 16}]
@@ -1221,6 +1589,37 @@
          #"Assert failed"
          (plugin/notify-progress step total-steps stage total-stages req plugin)))))
 
+(deftest lookup-method-test
+  (let [foo {:fn (fn [params req plugin] "foo")}
+        bar {:fn (fn [params req plugin] "bar")}
+        baz {:fn (fn [params req plugin] "baz")}
+        all {:fn (fn [params req plugin] "all")}
+        p {:rpcmethods {:foo foo} :hooks {:bar bar}
+           :subscriptions {:baz baz :* all}}]
+    (is (= (:requests (#'plugin/dispatch-table p)) {"foo" foo "bar" bar}))
+    (is (= (:notifications (#'plugin/dispatch-table p)) {"baz" baz "*" all}))
+    ;; without cache
+    (let [plugin (atom p)]
+      (is (= (#'plugin/lookup-method {:id 1 :method "foo"} plugin) foo))
+      (is (= (#'plugin/lookup-method {:id 1 :method "bar"} plugin) bar))
+      (is (nil? (#'plugin/lookup-method {:id 1 :method "baz"} plugin)))
+      (is (= (#'plugin/lookup-method {:method "baz"} plugin) baz))
+      (is (= (#'plugin/lookup-method {:method "other-topic"} plugin) all)))
+    ;; with cache, rebuilt when methods change
+    (let [plugin (atom (assoc p :_dispatch-table (volatile! nil)))]
+      (is (= (#'plugin/lookup-method {:id 1 :method "foo"} plugin) foo))
+      (let [table @(:_dispatch-table @plugin)]
+        (is (= (:requests table) {"foo" foo "bar" bar}))
+        (swap! plugin assoc :some-key "some-value")
+        (#'plugin/lookup-method {:id 1 :method "foo"} plugin)
+        (is (identical? @(:_dispatch-table @plugin) table)))
+      (plugin/dev-set-rpcmethod plugin :foo (:fn bar))
+      (is (= (#'plugin/lookup-method {:id 1 :method "foo"} plugin) {:fn (:fn bar)}))
+      (plugin/dev-set-hook plugin :qux (:fn baz))
+      (is (= (#'plugin/lookup-method {:id 1 :method "qux"} plugin) {:fn (:fn baz)}))
+      (plugin/dev-set-subscription plugin :qux (:fn foo))
+      (is (= (#'plugin/lookup-method {:method "qux"} plugin) {:fn (:fn foo)})))))
+
 (deftest process-test
   (let [foo-2 (fn [params req plugin] {:bar-2 "baz-2"})
         plugin (atom {:rpcmethods
@@ -1281,8 +1680,7 @@
                        {:fn (fn [params req plugin]
                               (throw
                                (ex-info "custom-error" {:error {:code -100}})))}}
-                      :_out (new java.io.StringWriter)
-                      :_resps (agent nil)})
+                      :_writer (#'plugin/writer (new java.io.StringWriter))})
         req {:jsonrpc "2.0" :id "some-id" :method "custom-error" :params {}}]
     (let [[log-msgs resp] (#'plugin/process req plugin)]
       (is (= (get-in resp [:error :code]) -100))
@@ -1295,8 +1693,7 @@
                        {:fn (fn [params req plugin]
                               (throw
                                (ex-info "custom-error" {})))}}
-                      :_out (new java.io.StringWriter)
-                      :_resps (agent nil)})
+                      :_writer (#'plugin/writer (new java.io.StringWriter))})
         req {:jsonrpc "2.0" :id "some-id" :method "custom-error" :params {}}]
     (let [[log-msgs resp] (#'plugin/process req plugin)]
       (is (= (get-in resp [:error :code]) -32603))
@@ -1375,18 +1772,117 @@
     (is (re-find #"Error while processing.*method.*peer_connected" (first log-msgs)))
     (is (re-find #":cause.*Cannot.*invoke.*clojure.lang.IFn.invoke.*because.*method_fn.*is.*null" (second log-msgs)))))
 
+(deftest response-cache-test
+  (let [calls (atom 0)
+        plugin (atom {:rpcmethods
+                      {:foo {:cache {:ttl-ms 200 :max-entries 2 :keys [:bar :baz]
+                                     :invalidate-on ["invoice_payment"]}
+                             :fn (fn [params req plugin]
+                                   {:n (swap! calls inc) :params params})}
+                       :no-cache {:fn (fn [params req plugin] (swap! calls inc))}
+                       :fail {:cache {:ttl-ms 1000}
+                              :fn (fn [params req plugin]
+                                    (swap! calls inc)
+                                    (throw (ex-info "fail" {})))}}})
+        _ (swap! plugin assoc :_caches (#'plugin/response-caches @plugin))
+        call (fn [method params]
+               (second (#'plugin/process {:jsonrpc "2.0" :id 1 :method method :params params} plugin)))
+        cache-metrics #(get-in (plugin/metrics plugin) [:caches "foo"])]
+    (is (= (set (keys (get-in @plugin [:_caches :by-method]))) #{"foo" "fail"}))
+    (is (= (keys (get-in @plugin [:_caches :by-topic])) ["invoice_payment"]))
+    ;; hits
+    (is (= (call "foo" {:bar "a"}) {:jsonrpc "2.0" :id 1 :result {:n 1 :params {:bar "a"}}}))
+    (is (= (call "foo" {:bar "a"}) {:jsonrpc "2.0" :id 1 :result {:n 1 :params {:bar "a"}}}))
+    ;; params normalized with params->map
+    (is (= (get-in (call "foo" ["a"]) [:result :n]) 1))
+    (is (= (get-in (call "foo" {:bar "a" :baz nil :other "ignored"}) [:result :n]) 1))
+    (is (= (cache-metrics) {:hits 3 :misses 1 :entries 1}))
+    ;; methods without :cache are not cached
+    (call "no-cache" {}) (call "no-cache" {})
+    (is (= @calls 3))
+    ;; LRU eviction
+    (is (= (get-in (call "foo" {:bar "b"}) [:result :n]) 4))
+    (call "foo" {:bar "a"}) ;; "a" becomes the most recently used
+    (is (= (get-in (call "foo" {:bar "c"}) [:result :n]) 5)) ;; evicts "b"
+    (is (= (get-in (call "foo" {:bar "a"}) [:result :n]) 1))
+    (is (= (get-in (call "foo" {:bar "b"}) [:result :n]) 6))
+    (is (= (:entries (cache-metrics)) 2))
+    ;; TTL
+    (Thread/sleep 250)
+    (is (= (get-in (call "foo" {:bar "a"}) [:result :n]) 7))
+    ;; invalidation by notification topics
+    (#'plugin/invalidate-caches! {:jsonrpc "2.0" :method "connect" :params {}} plugin)
+    (is (= (get-in (call "foo" {:bar "a"}) [:result :n]) 7))
+    (#'plugin/invalidate-caches! {:jsonrpc "2.0" :method "invoice_payment" :params {}} plugin)
+    (is (= (:entries (cache-metrics)) 0))
+    (is (= (get-in (call "foo" {:bar "a"}) [:result :n]) 8))
+    ;; errors are not cached
+    (is (= (get-in (call "fail" {}) [:error :message]) "Error while processing '{:jsonrpc \"2.0\", :id 1, :method \"fail\", :params {}}'"))
+    (call "fail" {})
+    (is (= @calls 10)))
+  ;; concurrent misses with the same params run :fn once
+  (let [calls (atom 0)
+        gate (promise)
+        plugin (atom {:rpcmethods
+                      {:foo {:cache {:ttl-ms 10000}
+                             :fn (fn [params req plugin]
+                                   @gate
+                                   (swap! calls inc))}}})
+        _ (swap! plugin assoc :_caches (#'plugin/response-caches @plugin))
+        resps (doall (for [_ (range 10)]
+                       (future (#'plugin/process {:jsonrpc "2.0" :id 1 :method "foo" :params {}} plugin))))]
+    (Thread/sleep 100)
+    (deliver gate true)
+    (is (every? #(= (:result (second @%)) 1) resps))
+    (is (= @calls 1))
+    (is (= (get-in (plugin/metrics plugin) [:caches "foo"]) {:hits 9 :misses 1 :entries 1})))
+  ;; async values are never cached, only the values they complete with
+  (let [calls (atom 0)
+        plugin (atom {:rpcmethods
+                      {:chan {:cache {:ttl-ms 10000}
+                              :fn (fn [params req plugin]
+                                    (let [ch (clojure.core.async/chan 1)]
+                                      (clojure.core.async/>!! ch {:n (swap! calls inc)})
+                                      ch))}
+                       :cf-fail {:cache {:ttl-ms 10000}
+                                 :fn (fn [params req plugin]
+                                       (swap! calls inc)
+                                       (java.util.concurrent.CompletableFuture/supplyAsync
+                                        (reify java.util.function.Supplier
+                                          (get [_] (throw (ex-info "fail" {}))))))}}})
+        _ (swap! plugin assoc :_caches (#'plugin/response-caches @plugin))
+        call (fn [method]
+               (let [r (promise)]
+                 (#'plugin/process-async {:jsonrpc "2.0" :id 1 :method method :params {}}
+                                         plugin #(deliver r %))
+                 (second (deref r 1000 [nil :timeout]))))
+        entries (fn [method]
+                  (vec (vals (get-in @plugin [:_caches :by-method method :entries]))))]
+    ;; the channel has been taken once, later calls get its value
+    (is (= (call "chan") {:jsonrpc "2.0" :id 1 :result {:n 1}}))
+    (is (= (call "chan") {:jsonrpc "2.0" :id 1 :result {:n 1}}))
+    (is (= (call "chan") {:jsonrpc "2.0" :id 1 :result {:n 1}}))
+    (is (= @calls 1))
+    (is (= (map :result (entries "chan")) [{:n 1}]))
+    ;; a future failing after :fn has returned is not cached
+    (is (re-find #"Error while processing" (get-in (call "cf-fail") [:error :message])))
+    (is (re-find #"Error while processing" (get-in (call "cf-fail") [:error :message])))
+    (is (= @calls 3))
+    (is (= (entries "cf-fail") []))
+    (is (= (get-in (plugin/metrics plugin) [:caches "cf-fail"]) {:hits 0 :misses 2 :entries 0}))))
+
 (deftest read-test
   (is (= (let [req {:jsonrpc "2.0" :id 0 :method "foo" :params {}}
                req-str (str (json/write-str req :escape-slash false) "\n\n")]
            (with-open [in (-> (java.io.StringReader. req-str) clojure.lang.LineNumberingPushbackReader.)]
-             (#'plugin/read in)))
+             (#'plugin/read (#'plugin/request-reader in))))
          {:jsonrpc "2.0" :id 0 :method "foo" :params {}}))
   (is (= (let [req-str (str "{\"jsonrpc\":\"2.0\","
                             "\n"
                             "\"id\":0,\"method\":\"foo\",\"params\":{}}"
                             "\n\n")]
            (with-open [in (-> (java.io.StringReader. req-str) clojure.lang.LineNumberingPushbackReader.)]
-             (#'plugin/read in)))
+             (#'plugin/read (#'plugin/request-reader in))))
          {:jsonrpc "2.0" :id 0 :method "foo" :params {}}))
   (is (= (let [req-0 {:jsonrpc "2.0" :id 0 :method "foo-0" :params {}}
                req-1 {:jsonrpc "2.0" :id 0 :method "foo-1" :params {}}
@@ -1394,20 +1890,35 @@
                req-1-str (str (json/write-str req-1 :escape-slash false) "\n\n")
                reqs-str (str req-0-str req-1-str)]
            (with-open [in (-> (java.io.StringReader. reqs-str) clojure.lang.LineNumberingPushbackReader.)]
-             (#'plugin/read in)))
+             (#'plugin/read (#'plugin/request-reader in))))
          {:jsonrpc "2.0" :id 0 :method "foo-0" :params {}}))
   (is (=
        (let [req-str "foo\n"]
          (with-open [in (-> (java.io.StringReader. req-str) clojure.lang.LineNumberingPushbackReader.)]
-           (#'plugin/read in)))
+           (#'plugin/read (#'plugin/request-reader in))))
        nil))
   (try
     (let [req-str "foo\n\n"]
       (with-open [in (-> (java.io.StringReader. req-str) clojure.lang.LineNumberingPushbackReader.)]
-        (#'plugin/read in)))
+        (#'plugin/read (#'plugin/request-reader in))))
     (catch clojure.lang.ExceptionInfo e
       (is (= (ex-data e)
-             {:error {:code -32700 :message "Invalid token in json input: 'foo'"}})))))
+             {:error {:code -32700 :message "Invalid token in json input: 'foo'"}}))))
+  ;; successive requests read with the same request reader whose
+  ;; buffer is smaller than the requests, so that the buffer grows
+  ;; and requests are split between several reads
+  (let [reqs (for [i (range 10)]
+               {:jsonrpc "2.0" :id i :method (str "foo-" i)
+                :params {:bar (apply str (repeat (* i 10) "x"))}})
+        reqs-str (str "\n"
+                      (apply str (map #(str (json/write-str % :escape-slash false) "\n\n") reqs))
+                      ;; pretty-printed request
+                      "{\"jsonrpc\": \"2.0\",\n \"id\": 10,\n \"method\": \"foo-10\",\n \"params\": {}}\n\n")]
+    (with-open [in (-> (java.io.StringReader. reqs-str) clojure.lang.LineNumberingPushbackReader.)]
+      (let [rdr (#'plugin/request-reader in 4)]
+        (is (= (doall (for [_ (range 11)] (#'plugin/read rdr)))
+               (concat reqs [{:jsonrpc "2.0" :id 10 :method "foo-10" :params {}}])))
+        (is (nil? (#'plugin/read rdr)))))))
 
 (deftest max-parallel-reqs-test
   (let [plugin-0 (atom {})
@@ -1418,9 +1929,1178 @@
     (is (= (#'plugin/max-parallel-reqs plugin-0) 512))
     (is (= (#'plugin/max-parallel-reqs plugin-1) 1))
     (is (= (#'plugin/max-parallel-reqs plugin-2) 32))
-    (is (= (#'plugin/max-parallel-reqs plugin-3) 1023))
+    (is (= (#'plugin/max-parallel-reqs plugin-3) 2048))
     (is (= (#'plugin/max-parallel-reqs plugin-4) 512))))
 
+(deftest scheduler-test
+  (let [s (#'plugin/scheduler 2)
+        plugin (atom {})]
+    (#'plugin/schedule! s {:id 0} plugin)
+    (#'plugin/schedule! s {:id 1} plugin)
+    (#'plugin/schedule! s {:id 2} plugin)
+    (is (= (#'plugin/queue-depth s) 3))
+    (is (= (#'plugin/queue-depth s :rpcmethods) 3))
+    (let [e0 (#'plugin/next-req! s)]
+      (is (= (:req e0) {:id 0}))
+      (is (= (:lane e0) :rpcmethods))
+      (is (= (:req (#'plugin/next-req! s)) {:id 1}))
+      (is (= (#'plugin/queue-depth s) 1))
+      (is (= (#'plugin/in-flight s) 2))
+      (is (= (#'plugin/in-flight s :rpcmethods) 2))
+      ;; no permit left, so next-req! blocks until a permit is released
+      (let [f (future (#'plugin/next-req! s))]
+        (Thread/sleep 100)
+        (is (not (realized? f)))
+        (#'plugin/release! s e0)
+        (is (= (:req (deref f 1000 {:req :timeout})) {:id 2}))
+        (is (= (#'plugin/queue-depth s) 0))
+        (is (= (#'plugin/in-flight s) 2)))))
+  ;; next-req! blocks until a request is queued
+  (let [s (#'plugin/scheduler 1)
+        f (future (#'plugin/next-req! s))]
+    (Thread/sleep 100)
+    (is (not (realized? f)))
+    (#'plugin/schedule! s {:id 0} (atom {}))
+    (is (= (:req (deref f 1000 {:req :timeout})) {:id 0}))
+    (is (= (#'plugin/in-flight s) 1)))
+  ;; unknown lanes
+  (is (thrown-with-msg?
+       clojure.lang.ExceptionInfo
+       #"Unknown lanes \[:foo\] in :lanes"
+       (#'plugin/scheduler 2 {:foo {:priority 3}}))))
+
+(deftest scheduler-lanes-test
+  (let [plugin (atom {:rpcmethods {:foo {:fn (fn [params req plugin])}
+                                   :bar {:max-parallel 1
+                                         :fn (fn [params req plugin])}}
+                      :hooks {:peer_connected {:fn (fn [params req plugin])}}
+                      :subscriptions {:* {:fn (fn [params req plugin])}}})]
+    ;; lanes of requests
+    (is (= (#'plugin/request-lane {:id 1 :method "foo"} plugin) :rpcmethods))
+    (is (= (#'plugin/request-lane {:id 1 :method "peer_connected"} plugin) :hooks))
+    (is (= (#'plugin/request-lane {:method "connect"} plugin) :subscriptions))
+    ;; hooks are served first, then rpcmethods, then subscriptions
+    (let [s (#'plugin/scheduler 10)]
+      (#'plugin/schedule! s {:method "connect"} plugin)
+      (#'plugin/schedule! s {:id 0 :method "foo"} plugin)
+      (#'plugin/schedule! s {:id 1 :method "peer_connected"} plugin)
+      (is (= (#'plugin/queue-depth s :hooks) 1))
+      (is (= (#'plugin/queue-depth s :rpcmethods) 1))
+      (is (= (#'plugin/queue-depth s :subscriptions) 1))
+      (is (= (map (comp :req #(#'plugin/next-req! %)) [s s s])
+             [{:id 1 :method "peer_connected"}
+              {:id 0 :method "foo"}
+              {:method "connect"}])))
+    ;; priorities set in :lanes
+    (let [s (#'plugin/scheduler 10 {:subscriptions {:priority 3}})]
+      (#'plugin/schedule! s {:id 1 :method "peer_connected"} plugin)
+      (#'plugin/schedule! s {:method "connect"} plugin)
+      (is (= (:req (#'plugin/next-req! s)) {:method "connect"})))
+    ;; :max-parallel of lanes
+    (let [s (#'plugin/scheduler 10 {:rpcmethods {:max-parallel 1}})]
+      (#'plugin/schedule! s {:id 0 :method "foo"} plugin)
+      (#'plugin/schedule! s {:id 1 :method "foo"} plugin)
+      (#'plugin/schedule! s {:id 2 :method "peer_connected"} plugin)
+      (let [e0 (#'plugin/next-req! s)
+            e1 (#'plugin/next-req! s)
+            f (future (#'plugin/next-req! s))]
+        (is (= (:req e0) {:id 2 :method "peer_connected"}))
+        (is (= (:req e1) {:id 0 :method "foo"}))
+        (Thread/sleep 100)
+        (is (not (realized? f)))
+        (#'plugin/release! s e1)
+        (is (= (:req (deref f 1000 {:req :timeout})) {:id 1 :method "foo"}))))
+    ;; :max-parallel of methods doesn't block other methods of the lane
+    (let [s (#'plugin/scheduler 10)]
+      (#'plugin/schedule! s {:id 0 :method "bar"} plugin)
+      (#'plugin/schedule! s {:id 1 :method "bar"} plugin)
+      (#'plugin/schedule! s {:id 2 :method "foo"} plugin)
+      (let [e0 (#'plugin/next-req! s)
+            e2 (#'plugin/next-req! s)
+            f (future (#'plugin/next-req! s))]
+        (is (= (:req e0) {:id 0 :method "bar"}))
+        (is (= (:req e2) {:id 2 :method "foo"}))
+        (Thread/sleep 100)
+        (is (not (realized? f)))
+        (#'plugin/release! s e2)
+        (Thread/sleep 100)
+        (is (not (realized? f)))
+        (#'plugin/release! s e0)
+        (is (= (:req (deref f 1000 {:req :timeout})) {:id 1 :method "bar"}))))
+    ;; by default a quarter of the permits is reserved for hooks
+    (let [s (#'plugin/scheduler 4)]
+      (is (= (map :reserved (:lanes s)) [1 0 0]))
+      (dotimes [i 5]
+        (#'plugin/schedule! s {:id i :method "foo"} plugin))
+      (dotimes [i 2]
+        (#'plugin/schedule! s {:method "connect"} plugin))
+      (let [es (doall (repeatedly 3 #(#'plugin/next-req! s)))
+            f (future (#'plugin/next-req! s))]
+        (is (= (map (comp :id :req) es) [0 1 2]))
+        ;; the last permit is kept for hooks
+        (Thread/sleep 100)
+        (is (not (realized? f)))
+        (#'plugin/schedule! s {:id 10 :method "peer_connected"} plugin)
+        (is (= (:req (deref f 1000 {:req :timeout})) {:id 10 :method "peer_connected"}))
+        ;; hooks can also take the permits not reserved
+        (#'plugin/release! s (first es))
+        (#'plugin/schedule! s {:id 11 :method "peer_connected"} plugin)
+        (is (= (:req (#'plugin/next-req! s)) {:id 11 :method "peer_connected"}))))
+    ;; :reserved set in :lanes, capped to leave a permit to other lanes
+    (is (= (map :reserved (:lanes (#'plugin/scheduler 10 {:hooks {:reserved 0}
+                                                          :rpcmethods {:reserved 3}})))
+           [0 3 0]))
+    (is (= (map :reserved (:lanes (#'plugin/scheduler 4 {:hooks {:reserved 10}})))
+           [3 0 0]))
+    (is (= (map :reserved (:lanes (#'plugin/scheduler 1))) [0 0 0]))
+    ;; the sum of :reserved is capped too, lanes with higher
+    ;; :priority reserving first
+    (is (= (map :reserved (:lanes (#'plugin/scheduler 4 {:hooks {:reserved 1}
+                                                         :rpcmethods {:reserved 2}
+                                                         :subscriptions {:reserved 3}})))
+           [1 2 0]))
+    (let [s (#'plugin/scheduler 4 {:hooks {:reserved 3}
+                                   :subscriptions {:reserved 3}})]
+      (is (= (map :reserved (:lanes s)) [3 0 0]))
+      ;; so over-reserved lanes don't starve RPC requests nor
+      ;; notifications
+      (#'plugin/schedule! s {:id 0 :method "foo"} plugin)
+      (let [e (deref (future (#'plugin/next-req! s)) 1000 {:req :timeout})]
+        (is (= (:req e) {:id 0 :method "foo"}))
+        (#'plugin/release! s e))
+      (#'plugin/schedule! s {:method "connect"} plugin)
+      (is (= (:req (deref (future (#'plugin/next-req! s)) 1000 {:req :timeout}))
+             {:method "connect"})))))
+
+(deftest dispatch-lanes-test
+  ;; While the rpcmethods lane is saturated with slow requests, hooks
+  ;; are still processed right away, with the default lanes (a quarter
+  ;; of the permits reserved for hooks) and with :max-parallel set on
+  ;; the rpcmethods lane.
+  (doseq [[lanes rpc-max] [[nil 6] [{:rpcmethods {:max-parallel 4}} 4]]]
+    (let [out (new java.io.StringWriter)
+          plugin (atom {:rpcmethods
+                        {:slow {:fn (fn [params req plugin]
+                                      (Thread/sleep 2000)
+                                      {})}}
+                        :hooks
+                        {:peer_connected {:fn (fn [params req plugin]
+                                                {:result "continue"})}}
+                        :_writer (#'plugin/writer out)})
+          scheduler (#'plugin/scheduler 8 lanes)
+          executors (#'plugin/executors 8)
+          resp? (fn [id] (re-find (re-pattern (format "\"id\":%s," id)) (str out)))]
+      (doto (Thread. #(#'plugin/dispatch scheduler executors plugin))
+        (.setDaemon true)
+        (.start))
+      (dotimes [i 100]
+        (#'plugin/schedule! scheduler {:jsonrpc "2.0" :id i :method "slow" :params {}} plugin))
+      (Thread/sleep 100)
+      (is (= (#'plugin/in-flight scheduler :rpcmethods) rpc-max))
+      (let [latencies
+            (for [i (range 1000 1010)]
+              (let [start (System/currentTimeMillis)]
+                (#'plugin/schedule! scheduler {:jsonrpc "2.0" :id i :method "peer_connected" :params {}} plugin)
+                (loop []
+                  (when (and (not (resp? i))
+                             (< (- (System/currentTimeMillis) start) 5000))
+                    (Thread/sleep 1)
+                    (recur)))
+                (- (System/currentTimeMillis) start)))]
+        (is (every? #(< % 500) (doall latencies))))
+      (is (= (#'plugin/in-flight scheduler :rpcmethods) rpc-max))
+      (is (> (#'plugin/queue-depth scheduler :rpcmethods) 90)))))
+
+(deftest executor-test
+  (let [executors {:blocking 'blocking :cpu 'cpu :virtual 'virtual}
+        plugin (atom {:executor :cpu
+                      :rpcmethods {:foo {:fn (fn [params req plugin])}
+                                   :bar {:executor :virtual
+                                         :fn (fn [params req plugin])}}
+                      :hooks {:baz {:executor :blocking
+                                    :fn (fn [params req plugin])}}
+                      :subscriptions {:* {:executor :virtual
+                                          :fn (fn [params req plugin])}}})]
+    (is (= (#'plugin/executor {:id 1 :method "foo"} executors plugin) 'cpu))
+    (is (= (#'plugin/executor {:id 1 :method "bar"} executors plugin) 'virtual))
+    (is (= (#'plugin/executor {:id 1 :method "baz"} executors plugin) 'blocking))
+    (is (= (#'plugin/executor {:method "some-topic"} executors plugin) 'virtual)))
+  (let [executors {:blocking 'blocking :cpu 'cpu :virtual 'virtual}
+        plugin (atom {:rpcmethods {:foo {:fn (fn [params req plugin])}}})]
+    (is (= (#'plugin/executor {:id 1 :method "foo"} executors plugin) 'blocking))))
+
+(deftest dispatch-test
+  ;; 500 handlers sleeping 500ms must all be processed in about one
+  ;; sleep period and not be serialized on a small pool of threads
+  (doseq [executor [:blocking :virtual]]
+    (let [n 500
+          out (new java.io.StringWriter)
+          plugin (atom {:executor executor
+                        :rpcmethods
+                        {:sleep {:fn (fn [params req plugin]
+                                       (Thread/sleep 500)
+                                       {})}}
+                        :_writer (#'plugin/writer out)})
+          ;; no permit reserved for hooks, all go to :sleep requests
+          scheduler (#'plugin/scheduler n {:hooks {:reserved 0}})
+          executors (#'plugin/executors n)
+          nb-resps #(count (re-seq #"\n\n" (str out)))
+          start (System/currentTimeMillis)]
+      (doto (Thread. #(#'plugin/dispatch scheduler executors plugin))
+        (.setDaemon true)
+        (.start))
+      (dotimes [i n]
+        (#'plugin/schedule! scheduler {:jsonrpc "2.0" :id i :method "sleep" :params {}} plugin))
+      (loop []
+        (when (and (< (nb-resps) n)
+                   (< (- (System/currentTimeMillis) start) 10000))
+          (Thread/sleep 10)
+          (recur)))
+      (is (= (nb-resps) n))
+      (is (< (- (System/currentTimeMillis) start) 1500)))))
+
+(deftest scheduler-shedding-test
+  (let [plugin (atom {:rpcmethods {:foo {:fn (fn [params req plugin])}}
+                      :hooks {:peer_connected {:fn (fn [params req plugin])}}
+                      :subscriptions {:forward_event {:shed :coalesce
+                                                      :fn (fn [params req plugin])}
+                                      :coin_movement {:shed :queue
+                                                      :fn (fn [params req plugin])}
+                                      :* {:fn (fn [params req plugin])}}
+                      :_writer (#'plugin/writer (new java.io.StringWriter))})
+        s (#'plugin/scheduler 1 nil {:high-water-mark 2 :requests :reject})
+        notif (fn [topic n] {:jsonrpc "2.0" :method topic :params {:n n}})]
+    ;; below the high-water mark everything is queued
+    (is (= (#'plugin/schedule! s (notif "connect" 0) plugin) :queued))
+    (is (= (#'plugin/schedule! s (notif "forward_event" 1) plugin) :queued))
+    ;; above the high-water mark
+    (is (= (#'plugin/schedule! s (notif "connect" 2) plugin) :dropped))
+    (is (= (#'plugin/schedule! s (notif "forward_event" 3) plugin) :coalesced))
+    (is (= (#'plugin/schedule! s (notif "coin_movement" 4) plugin) :queued))
+    (is (= (#'plugin/schedule! s {:jsonrpc "2.0" :id 5 :method "peer_connected" :params {}} plugin) :queued))
+    (is (= (#'plugin/schedule! s {:jsonrpc "2.0" :id 6 :method "foo" :params {}} plugin) :rejected))
+    (is (= @(:shed s) {:dropped 1 :coalesced 1 :rejected 1}))
+    (is (= (#'plugin/queue-depth s :subscriptions) 3))
+    (is (= (#'plugin/queue-depth s :hooks) 1))
+    (is (= (#'plugin/queue-depth s :rpcmethods) 0))
+    ;; the coalesced notification replaced the queued one of the same topic
+    (is (= (loop [reqs []]
+             (if (= (count reqs) 4)
+               reqs
+               (let [entry (#'plugin/next-req! s)]
+                 (#'plugin/release! s entry)
+                 (recur (conj reqs (:req entry))))))
+           [{:jsonrpc "2.0" :id 5 :method "peer_connected" :params {}}
+            (notif "connect" 0)
+            (notif "forward_event" 3)
+            (notif "coin_movement" 4)]))
+    ;; rejected requests are replied to with a JSON RPC error
+    (#'plugin/drain! (:_writer @plugin))
+    (is (re-find #"\"id\":6,\"error\":\{\"code\":-32603,\"message\":\"Plugin overloaded, 'foo' request rejected because 4 requests are queued.\"\}"
+                 (str (:out (:_writer @plugin))))))
+  ;; requests are never shed by default
+  (let [plugin (atom {:rpcmethods {:foo {:fn (fn [params req plugin])}}})
+        s (#'plugin/scheduler 1 nil {:high-water-mark 1})]
+    (is (= (#'plugin/schedule! s {:id 0 :method "foo"} plugin) :queued))
+    (is (= (#'plugin/schedule! s {:id 1 :method "foo"} plugin) :queued))
+    (is (= (#'plugin/schedule! s {:method "connect"} plugin) :dropped)))
+  (is (thrown-with-msg?
+       clojure.lang.ExceptionInfo
+       #"Wrong :high-water-mark 'nil' in :shedding"
+       (#'plugin/scheduler 1 nil {:requests :reject})))
+  (is (thrown-with-msg?
+       clojure.lang.ExceptionInfo
+       #"Wrong :requests ':drop' in :shedding"
+       (#'plugin/scheduler 1 nil {:high-water-mark 10 :requests :drop}))))
+
+(deftest dispatch-timeout-test
+  (let [out (new java.io.StringWriter)
+        interrupted (promise)
+        plugin (atom {:rpcmethods
+                      {:slow {:timeout-ms 100
+                              :fn (fn [params req plugin]
+                                    (try
+                                      (Thread/sleep 5000)
+                                      (catch InterruptedException e
+                                        (deliver interrupted true)
+                                        (throw e)))
+                                    {:slow "done"})}
+                       :fast {:timeout-ms 1000
+                              :fn (fn [params req plugin] {:fast "done"})}}
+                      :_writer (#'plugin/writer out)})
+        scheduler (#'plugin/scheduler 4)
+        executors (#'plugin/executors 4)
+        start (System/currentTimeMillis)]
+    (doto (Thread. #(#'plugin/dispatch scheduler executors plugin))
+      (.setDaemon true)
+      (.start))
+    (#'plugin/schedule! scheduler {:jsonrpc "2.0" :id 0 :method "slow" :params {}} plugin)
+    (#'plugin/schedule! scheduler {:jsonrpc "2.0" :id 1 :method "fast" :params {}} plugin)
+    (is (deref interrupted 2000 false))
+    (is (< (- (System/currentTimeMillis) start) 1000))
+    (Thread/sleep 100)
+    (#'plugin/drain! (:_writer @plugin))
+    (let [resps (str out)]
+      (is (re-find #"\"id\":0,\"error\":\{\"code\":-32603,\"message\":\"Timeout of 100ms reached while processing" resps))
+      (is (re-find #"\"id\":1,\"result\":\{\"fast\":\"done\"\}" resps))
+      ;; one response per request
+      (is (= (count (re-seq #"\"id\":0," resps)) 1))
+      (is (not (re-find #"\"slow\":\"done\"" resps))))
+    (is (= (#'plugin/in-flight scheduler) 0))))
+
+(deftest dispatch-error-test
+  ;; requests are replied to even when their processing fails outside
+  ;; of :fn, and their permits are given back
+  (doseq [[broken expected] [;; looking up the method fails once queued
+                             [{:_dispatch-table :not-a-volatile}
+                              #"\"id\":1,\"error\":\{\"code\":-32603,\"message\":\"Error while processing.*:method.*foo.*ClassCastException"]
+                             ;; recording the metrics fails
+                             [{:_metrics :not-a-registry}
+                              #"\"id\":1,\"result\":\{\"foo\":\"bar\"\}"]]]
+    (let [out (new java.io.StringWriter)
+          plugin (atom {:rpcmethods {:foo {:fn (fn [params req plugin] {:foo "bar"})}}
+                        :_writer (#'plugin/writer out)})
+          scheduler (#'plugin/scheduler 1)
+          executors (#'plugin/executors 1)]
+      (#'plugin/schedule! scheduler {:jsonrpc "2.0" :id 1 :method "foo" :params {}} plugin)
+      (swap! plugin merge broken)
+      (doto (Thread. #(#'plugin/dispatch scheduler executors plugin))
+        (.setDaemon true)
+        (.start))
+      (loop [k 0]
+        (when (and (< k 100) (not (and (re-find expected (str out))
+                                       (zero? (#'plugin/in-flight scheduler)))))
+          (Thread/sleep 10)
+          (recur (inc k))))
+      (is (re-find expected (str out)))
+      (is (= (#'plugin/in-flight scheduler) 0)))))
+
+(deftest batch!-test
+  (let [batches (atom [])
+        plugin (atom {:subscriptions
+                      {:forward_event {:batch {:max-size 3 :max-wait-ms 50}
+                                       :fn (fn [notifs req plugin]
+                                             (swap! batches conj (mapv #(get-in % [:params :n]) notifs)))}
+                       :* {:batch {:max-size 100 :max-wait-ms 10000}
+                           :fn (fn [notifs req plugin]
+                                 (swap! batches conj (mapv :method notifs)))}}
+                      :_batches (java.util.concurrent.ConcurrentHashMap.)
+                      :_executors (#'plugin/executors 4)})
+        scheduler (#'plugin/scheduler 4)
+        notif (fn [method n] {:jsonrpc "2.0" :method method :params {:n n}})
+        batch! (fn [req]
+                 (#'plugin/batch! req (#'plugin/lookup-method req plugin) scheduler plugin))]
+    (is (= (#'plugin/batch-topic (notif "forward_event" 0) plugin) "forward_event"))
+    (is (= (#'plugin/batch-topic (notif "coin_movement" 0) plugin) "*"))
+    ;; flushed on size
+    (doseq [n (range 4)]
+      (batch! (notif "forward_event" n)))
+    (is (= (#'plugin/queue-depth scheduler) 1))
+    (let [{:keys [req]} (#'plugin/next-req! scheduler)]
+      (is (= req {:jsonrpc "2.0" :method "forward_event"
+                  :params [(notif "forward_event" 0) (notif "forward_event" 1) (notif "forward_event" 2)]}))
+      (#'plugin/process req plugin))
+    (is (= @batches [[0 1 2]]))
+    ;; flushed on time
+    (Thread/sleep 100)
+    (is (= (#'plugin/queue-depth scheduler) 1))
+    (let [{:keys [req]} (#'plugin/next-req! scheduler)]
+      (#'plugin/process req plugin))
+    (is (= @batches [[0 1 2] [3]]))
+    ;; flushed at shutdown
+    (batch! (notif "coin_movement" 0))
+    (batch! (notif "balance_snapshot" 0))
+    (batch! (notif "forward_event" 4))
+    (is (= (#'plugin/queue-depth scheduler) 0))
+    (#'plugin/flush-batches! plugin)
+    (is (= (set (drop 2 @batches)) #{[4] ["coin_movement" "balance_snapshot"]}))
+    (is (nil? (#'plugin/take-batch! "*" plugin)))
+    (Thread/sleep 100)
+    (is (= (#'plugin/queue-depth scheduler) 0))))
+
+(deftest run-batch-test
+  ;; notifications still batched when lightningd closes the connection
+  ;; are processed before we exit
+  (let [reqs (str "{\"jsonrpc\":\"2.0\",\"id\":\"gm\",\"method\":\"getmanifest\",\"params\":{}}\n\n"
+                  "{\"jsonrpc\":\"2.0\",\"id\":\"init\",\"method\":\"init\","
+                  "\"params\":{\"options\":{},\"configuration\":{\"lightning-dir\":\"/tmp\",\"rpc-file\":\"rpc\"}}}\n\n"
+                  (apply str (for [n (range 5)]
+                               (format "{\"jsonrpc\":\"2.0\",\"method\":\"forward_event\",\"params\":{\"n\":%s}}\n\n" n))))
+        exited (promise)
+        batches (atom [])
+        plugin (atom {:subscriptions
+                      {:forward_event {:batch {:max-size 100 :max-wait-ms 60000}
+                                       :fn (fn [notifs req plugin]
+                                             (swap! batches conj (mapv #(get-in % [:params :n]) notifs)))}}})]
+    (future
+      (binding [*in* (java.io.StringReader. reqs)
+                *out* (new java.io.StringWriter)
+                plugin/*exit* (fn [status] (deliver exited status))]
+        (plugin/run plugin)))
+    (is (= (deref exited 5000 :timeout) 0))
+    (is (= @batches [[0 1 2 3 4]])))
+  ;; so are the batches flushed by size and the requests still queued
+  ;; or being processed, and their responses are written before we exit
+  (let [reqs (str "{\"jsonrpc\":\"2.0\",\"id\":\"gm\",\"method\":\"getmanifest\",\"params\":{}}\n\n"
+                  "{\"jsonrpc\":\"2.0\",\"id\":\"init\",\"method\":\"init\","
+                  "\"params\":{\"options\":{},\"configuration\":{\"lightning-dir\":\"/tmp\",\"rpc-file\":\"rpc\"}}}\n\n"
+                  (apply str (for [n (range 5)]
+                               (format "{\"jsonrpc\":\"2.0\",\"method\":\"forward_event\",\"params\":{\"n\":%s}}\n\n" n)))
+                  (apply str (for [id (range 3)]
+                               (format "{\"jsonrpc\":\"2.0\",\"id\":%s,\"method\":\"slow\",\"params\":{}}\n\n" id))))
+        out (new java.io.StringWriter)
+        exited (promise)
+        batches (atom [])
+        plugin (atom {:max-parallel-reqs 1
+                      :rpcmethods {:slow {:fn (fn [params req plugin]
+                                                (Thread/sleep 100)
+                                                {:slow "done"})}}
+                      :subscriptions
+                      {:forward_event {:batch {:max-size 3 :max-wait-ms 60000}
+                                       :fn (fn [notifs req plugin]
+                                             (Thread/sleep 200)
+                                             (swap! batches conj (mapv #(get-in % [:params :n]) notifs)))}}})]
+    (future
+      (binding [*in* (java.io.StringReader. reqs)
+                *out* out
+                plugin/*exit* (fn [status] (deliver exited status))]
+        (plugin/run plugin)))
+    (is (= (deref exited 5000 :timeout) 0))
+    ;; [0 1 2] flushed by size just before EOF, [3 4] flushed at EOF
+    (is (= (set @batches) #{[0 1 2] [3 4]}))
+    (let [resps (map #(json/read-str % :key-fn keyword)
+                     (str/split (str/trim (str out)) #"\n\n"))]
+      (is (= (set (map :id (filter :result resps))) #{"gm" "init" 0 1 2})))))
+
+(deftest process-async-test
+  (let [cf (java.util.concurrent.CompletableFuture.)
+        ch (clojure.core.async/chan 1)
+        p (promise)
+        values (atom {})
+        plugin (atom {:rpcmethods {:cf {:fn (fn [params req plugin] (:value @values))}}})
+        req {:jsonrpc "2.0" :id 1 :method "cf" :params {}}
+        msg "Error while processing '{:jsonrpc \"2.0\", :id 1, :method \"cf\", :params {}}'"
+        process-async (fn [value]
+                        (swap! values assoc :value value)
+                        (let [r (promise)]
+                          (#'plugin/process-async req plugin #(deliver r %))
+                          r))]
+    (is (#'plugin/async-value? cf))
+    (is (#'plugin/async-value? ch))
+    (is (#'plugin/async-value? p))
+    (is (not (#'plugin/async-value? {:foo "bar"})))
+    (is (not (#'plugin/async-value? (atom nil))))
+    ;; CompletableFuture
+    (let [r (process-async cf)]
+      (is (not (realized? r)))
+      (.complete cf {:foo "bar"})
+      (is (= (deref r 1000 :timeout) [nil {:jsonrpc "2.0" :id 1 :result {:foo "bar"}}])))
+    (let [r (process-async (java.util.concurrent.CompletableFuture/failedFuture
+                            (ex-info "foo" {:error {:code -100 :message "foo"}})))]
+      (is (= (deref r 1000 :timeout)
+             [[msg "{:code -100, :message \"foo\"}"]
+              {:jsonrpc "2.0" :id 1 :error {:code -100 :message "foo"}}])))
+    (let [r (process-async (.thenApply (java.util.concurrent.CompletableFuture/supplyAsync
+                                        (reify java.util.function.Supplier (get [_] 1)))
+                                       (reify java.util.function.Function
+                                         (apply [_ x] (/ x 0)))))
+          [log-msgs resp] (deref r 1000 :timeout)]
+      ;; CompletionException is unwrapped
+      (is (re-find #"ArithmeticException" (second log-msgs)))
+      (is (= (get-in resp [:error :message]) msg)))
+    ;; core.async channel
+    (let [r (process-async ch)]
+      (is (not (realized? r)))
+      (clojure.core.async/>!! ch {:foo "baz"})
+      (is (= (deref r 1000 :timeout) [nil {:jsonrpc "2.0" :id 1 :result {:foo "baz"}}])))
+    (let [ch (clojure.core.async/chan 1)
+          r (process-async ch)]
+      (clojure.core.async/>!! ch (Exception. "boom"))
+      (is (= (get-in (deref r 1000 :timeout) [1 :error :message]) msg)))
+    (let [ch (clojure.core.async/chan)
+          r (process-async ch)]
+      (clojure.core.async/close! ch)
+      (is (= (deref r 1000 :timeout) [nil {:jsonrpc "2.0" :id 1 :result nil}])))
+    ;; promise, waited on a thread as plugin has no :_pending-derefs
+    (let [r (process-async p)]
+      (is (not (realized? r)))
+      (deliver p {:foo "qux"})
+      (is (= (deref r 1000 :timeout) [nil {:jsonrpc "2.0" :id 1 :result {:foo "qux"}}])))
+    ;; promise polled in :_pending-derefs
+    (let [pending (#'plugin/pending-derefs
+                   (java.util.concurrent.Executors/newSingleThreadScheduledExecutor))
+          queue ^java.util.concurrent.ConcurrentLinkedQueue (:queue pending)
+          _ (swap! plugin assoc :_pending-derefs pending)]
+      ;; not polling while no promise is pending
+      (is (nil? @(:task pending)))
+      (let [p (promise)
+            r (process-async p)]
+        (is (= (.size queue) 1))
+        (is (some? @(:task pending)))
+        (#'plugin/poll-pending-derefs! pending)
+        (is (not (realized? r)))
+        (is (= (.size queue) 1))
+        (is (some? @(:task pending)))
+        (deliver p {:foo "quux"})
+        (is (= (deref r 1000 :timeout) [nil {:jsonrpc "2.0" :id 1 :result {:foo "quux"}}]))
+        ;; polling stops once no promise is pending...
+        (Thread/sleep 50)
+        (is (= (.size queue) 0))
+        (is (nil? @(:task pending))))
+      ;; ...and starts again with the next one
+      (let [p (promise)
+            r (process-async p)]
+        (is (some? @(:task pending)))
+        (deliver p {:foo "corge"})
+        (is (= (deref r 1000 :timeout) [nil {:jsonrpc "2.0" :id 1 :result {:foo "corge"}}]))
+        (Thread/sleep 50)
+        (is (nil? @(:task pending))))
+      (.shutdown ^java.util.concurrent.ExecutorService (:timer pending)))
+    ;; process waits for async values
+    (swap! values assoc :value (java.util.concurrent.CompletableFuture/completedFuture {:foo "bar"}))
+    (is (= (#'plugin/process req plugin) [nil {:jsonrpc "2.0" :id 1 :result {:foo "bar"}}]))))
+
+(deftest dispatch-async-test
+  ;; 5000 requests waiting for their async value are all in flight
+  ;; while processed on a single thread
+  (let [n 5000
+        out (new java.io.StringWriter)
+        cfs (java.util.concurrent.ConcurrentHashMap.)
+        plugin (atom {:rpcmethods
+                      {:wait {:fn (fn [params req plugin]
+                                    (let [cf (java.util.concurrent.CompletableFuture.)]
+                                      (.put cfs (:id req) cf)
+                                      cf))}
+                       :wait-timeout {:timeout-ms 100
+                                      :fn (fn [params req plugin]
+                                            (java.util.concurrent.CompletableFuture.))}}
+                      :_writer (#'plugin/writer out)})
+        ;; no permit reserved for hooks, all go to :wait requests
+        scheduler (#'plugin/scheduler n {:hooks {:reserved 0}})
+        executors (assoc (#'plugin/executors n)
+                         :blocking (#'plugin/bounded-executor 1 "test-async"))]
+    (doto (Thread. #(#'plugin/dispatch scheduler executors plugin))
+      (.setDaemon true)
+      (.start))
+    (doseq [i (range n)]
+      (#'plugin/schedule! scheduler {:jsonrpc "2.0" :id i :method "wait" :params {:i i}} plugin))
+    (loop [k 0]
+      (when (and (< k 1000) (< (.size cfs) n))
+        (Thread/sleep 10)
+        (recur (inc k))))
+    (is (= (.size cfs) n))
+    ;; the permits are still held
+    (is (= (#'plugin/in-flight scheduler) n))
+    (doseq [[id ^java.util.concurrent.CompletableFuture cf] cfs]
+      (if (even? id)
+        (.complete cf {:id id})
+        (.completeExceptionally cf (ex-info "odd" {:error {:code -1 :message "odd"}}))))
+    (loop [k 0]
+      (when (and (< k 1000) (pos? (#'plugin/in-flight scheduler)))
+        (Thread/sleep 10)
+        (recur (inc k))))
+    (is (= (#'plugin/in-flight scheduler) 0))
+    (#'plugin/drain! (:_writer @plugin))
+    (let [resps (mapv #(json/read-str % :key-fn keyword)
+                      (str/split (str/trim (str out)) #"\n\n"))]
+      (is (= (count resps) n))
+      (is (every? #(if (even? (:id %))
+                     (= (:result %) {:id (:id %)})
+                     (= (:error %) {:code -1 :message "odd"}))
+                  resps)))
+    ;; async values that never complete time out and give back their permit
+    (#'plugin/schedule! scheduler {:jsonrpc "2.0" :id "t" :method "wait-timeout" :params {}} plugin)
+    (Thread/sleep 300)
+    (is (= (#'plugin/in-flight scheduler) 0))
+    (#'plugin/drain! (:_writer @plugin))
+    (is (re-find #"\"id\":\"t\",\"error\":\{\"code\":-32603,\"message\":\"Timeout of 100ms reached" (str out)))))
+
+(deftest process-inline!-test
+  (let [out (java.io.StringWriter.)
+        plugin (atom {:hooks {:peer_connected {:inline true
+                                               :fn (fn [params req plugin]
+                                                     {:result "continue"})}
+                              :htlc_accepted {:inline true
+                                              :inline-budget-ms 1
+                                              :fn (fn [params req plugin]
+                                                    (Thread/sleep 10)
+                                                    {:result "continue"})}}
+                      :_writer (#'plugin/writer out)
+                      :_metrics (#'plugin/metrics-registry)})
+        req-0 {:jsonrpc "2.0" :id 0 :method "peer_connected" :params {}}
+        req-1 {:jsonrpc "2.0" :id 1 :method "htlc_accepted" :params {}}
+        read-all (fn []
+                   (#'plugin/drain! (:_writer @plugin))
+                   (let [pbr (java.io.PushbackReader. (java.io.StringReader. (str out)) 64)]
+                     (vec (take-while some? (repeatedly #(json/read pbr :eof-error? false :key-fn keyword))))))]
+    (#'plugin/process-inline! req-0 (#'plugin/lookup-method req-0 plugin) plugin)
+    (is (= (read-all) [{:jsonrpc "2.0" :id 0 :result {:result "continue"}}]))
+    (is (= (get-in (plugin/metrics plugin) [:methods "peer_connected" :count]) 1))
+    ;; over budget
+    (#'plugin/process-inline! req-1 (#'plugin/lookup-method req-1 plugin) plugin)
+    (let [[_ resp warning] (read-all)]
+      (is (= resp {:jsonrpc "2.0" :id 1 :result {:result "continue"}}))
+      (is (= (get-in warning [:params :level]) "unusual"))
+      (is (re-find #"Inline method 'htlc_accepted' took .*ms, more than its :inline-budget-ms of 1ms"
+                   (get-in warning [:params :message]))))))
+
+(deftest run-inline-test
+  ;; the inline hook is processed on the reader thread while the
+  ;; only permit is held by the slow RPC method
+  (let [reqs (str "{\"jsonrpc\":\"2.0\",\"id\":\"gm\",\"method\":\"getmanifest\",\"params\":{}}\n\n"
+                  "{\"jsonrpc\":\"2.0\",\"id\":\"init\",\"method\":\"init\","
+                  "\"params\":{\"options\":{},\"configuration\":{\"lightning-dir\":\"/tmp\",\"rpc-file\":\"rpc\"}}}\n\n"
+                  "{\"jsonrpc\":\"2.0\",\"id\":1,\"method\":\"slow\",\"params\":{}}\n\n"
+                  "{\"jsonrpc\":\"2.0\",\"id\":2,\"method\":\"peer_connected\",\"params\":{}}\n\n")
+        out (new java.io.StringWriter)
+        exited (promise)
+        gate (promise)
+        plugin (atom {:max-parallel-reqs 1
+                      :rpcmethods {:slow {:fn (fn [params req plugin] @gate {})}}
+                      :hooks {:peer_connected {:inline true
+                                               :fn (fn [params req plugin]
+                                                     (deliver gate true)
+                                                     {:result "continue"})}}})]
+    (future
+      (binding [*in* (java.io.StringReader. reqs)
+                *out* out
+                plugin/*exit* (fn [status] (deliver exited status))]
+        (plugin/run plugin)))
+    (is (= (deref exited 5000 :timeout) 0))
+    ;; the response to "slow" may be written after we exited
+    (loop [i 0]
+      (when (and (< i 500) (not (str/includes? (str out) "\"id\":1,")))
+        (Thread/sleep 10)
+        (recur (inc i))))
+    (let [resps (mapv #(json/read-str % :key-fn keyword)
+                      (str/split (str/trim (str out)) #"\n\n"))]
+      (is (= (map :id resps) ["gm" "init" 2 1])))))
+
+(deftest tracer-test
+  (is (nil? (#'plugin/tracer {})))
+  (is (fn? (#'plugin/tracer {:trace-fn (fn [span])})))
+  (is (thrown-with-msg?
+       clojure.lang.ExceptionInfo
+       #"Wrong :trace-fn 'foo'.  It must be a function."
+       (#'plugin/tracer {:trace-fn "foo"})))
+  ;; requests are not traced without tracer
+  (let [req {:jsonrpc "2.0" :id 1 :method "foo" :params {}}]
+    (is (identical? (#'plugin/traced req 100 nil) req))
+    (is (nil? (#'plugin/span req)))
+    (is (nil? (#'plugin/end-span! req))))
+  ;; the span doesn't change the value of the request
+  (let [spans (atom [])
+        req {:jsonrpc "2.0" :id "cli:foo#1/cln:foo#2" :method "foo" :params {}}
+        traced (#'plugin/traced req 100 #(swap! spans conj %))]
+    (is (= traced req))
+    (vswap! (#'plugin/span traced) assoc :outcome :ok)
+    (#'plugin/end-span! traced)
+    (is (= @spans [{:id "cli:foo#1/cln:foo#2" :method "foo" :read-ns 100 :outcome :ok}])))
+  ;; read records the time to parse the request
+  (let [req-str "{\"jsonrpc\":\"2.0\",\"id\":0,\"method\":\"foo\",\"params\":{}}\n\n"]
+    (with-open [in (-> (java.io.StringReader. req-str) clojure.lang.LineNumberingPushbackReader.)]
+      (let [rdr (#'plugin/request-reader in)]
+        (#'plugin/read rdr)
+        (is (pos? (aget ^longs (:read-ns rdr) 0)))))))
+
+(deftest dispatch-trace-test
+  (let [spans (java.util.concurrent.LinkedBlockingQueue.)
+        tracer (#'plugin/tracer {:trace-fn #(.put spans %)})
+        out (new java.io.StringWriter)
+        plugin (atom {:rpcmethods {:foo {:fn (fn [params req plugin]
+                                               (Thread/sleep 50)
+                                               {:foo "bar"})}
+                                   :fail {:fn (fn [params req plugin]
+                                                (throw (Exception. "fail")))}
+                                   :inline-foo {:inline true
+                                                :fn (fn [params req plugin] {})}}
+                      :subscriptions {:topic {:fn (fn [params req plugin])}}
+                      :_writer (#'plugin/writer out)})
+        scheduler (#'plugin/scheduler 1)
+        executors (#'plugin/executors 1)
+        req (fn [id method] (#'plugin/traced {:jsonrpc "2.0" :id id :method method :params {}} 10 tracer))
+        take-span #(.poll spans 1000 java.util.concurrent.TimeUnit/MILLISECONDS)]
+    (doto (Thread. #(#'plugin/dispatch scheduler executors plugin))
+      (.setDaemon true)
+      (.start))
+    (#'plugin/schedule! scheduler (req "cli:foo#1/cln:foo#2" "foo") plugin)
+    (#'plugin/schedule! scheduler (req 2 "fail") plugin)
+    (#'plugin/schedule! scheduler (#'plugin/traced {:jsonrpc "2.0" :method "topic" :params {}} 10 tracer) plugin)
+    (let [spans (into {} (map (juxt :method identity)) (repeatedly 3 take-span))]
+      (let [span (get spans "foo")]
+        (is (= (select-keys span [:id :method :read-ns :outcome])
+               {:id "cli:foo#1/cln:foo#2" :method "foo" :read-ns 10 :outcome :ok}))
+        (is (>= (:handler-ns span) 50000000))
+        (is (every? #(nat-int? (get span %)) [:queue-ns :write-ns])))
+      (let [span (get spans "fail")]
+        (is (= (select-keys span [:id :method :outcome]) {:id 2 :method "fail" :outcome :error}))
+        ;; waited for "foo" to be processed as only one request
+        ;; is processed at a time
+        (is (>= (:queue-ns span) 40000000)))
+      (let [span (get spans "topic")]
+        (is (= (select-keys span [:id :method :outcome]) {:id nil :method "topic" :outcome :ok}))
+        (is (contains? span :handler-ns))
+        (is (not (contains? span :write-ns)))))
+    ;; inline methods
+    (#'plugin/process-inline! (req 3 "inline-foo") (get-in @plugin [:rpcmethods :inline-foo]) plugin)
+    (let [span (take-span)]
+      (is (= (select-keys span [:id :method :queue-ns :outcome])
+             {:id 3 :method "inline-foo" :queue-ns 0 :outcome :ok}))
+      (is (contains? span :write-ns)))
+    ;; a failing tracer doesn't stop the writer
+    (let [req (#'plugin/traced {:jsonrpc "2.0" :id 4 :method "foo" :params {}} 10
+                               (fn [span] (throw (Exception. "tracer"))))]
+      (#'plugin/schedule! scheduler req plugin)
+      (loop [k 0]
+        (when (and (< k 100) (not (re-find #"\"id\":4," (str out))))
+          (Thread/sleep 10)
+          (recur (inc k))))
+      (is (re-find #"\"id\":4,\"result\":\{\"foo\":\"bar\"\}" (str out))))
+    (is (nil? (.poll spans)))))
+
+(deftest jfr-tracer-test
+  (let [tracer (#'plugin/tracer {:jfr true})
+        f (java.io.File/createTempFile "clnplugin-clj" ".jfr")]
+    (with-open [r (jdk.jfr.Recording.)]
+      (.enable r "clnplugin.Request")
+      (.start r)
+      (tracer {:id "cli:foo#1/cln:foo#2" :method "foo" :outcome :ok
+               :read-ns 1000 :queue-ns 2000 :handler-ns 3000 :write-ns 4000})
+      (tracer {:id nil :method "topic" :outcome :error
+               :read-ns 1000 :queue-ns 2000 :handler-ns 3000})
+      (.stop r)
+      (.dump r (.toPath f)))
+    (let [events (filter #(= (.getName (.getEventType ^jdk.jfr.consumer.RecordedEvent %)) "clnplugin.Request")
+                         (jdk.jfr.consumer.RecordingFile/readAllEvents (.toPath f)))
+          fields (fn [^jdk.jfr.consumer.RecordedEvent e]
+                   {:id (.getString e "id")
+                    :method (.getString e "method")
+                    :outcome (.getString e "outcome")
+                    :handler-ns (.toNanos (.getDuration e "handlerTime"))
+                    :write-ns (.toNanos (.getDuration e "writeTime"))})]
+      (is (= (set (map fields events))
+             #{{:id "cli:foo#1/cln:foo#2" :method "foo" :outcome "ok" :handler-ns 3000 :write-ns 4000}
+               {:id nil :method "topic" :outcome "error" :handler-ns 3000 :write-ns 0}})))
+    (.delete f)))
+
+(deftest metrics-test
+  (is (= (map #'plugin/bucket [0 50 51 100 10000000 10000001]) [0 0 1 1 16 17]))
+  (let [registry (#'plugin/metrics-registry)
+        plugin (atom {:_metrics registry})]
+    (is (= (plugin/metrics plugin) {:methods {} :scheduler nil :writer nil :caches {}}))
+    (#'plugin/record! registry "foo" 40000 :ok)       ;; 40us
+    (#'plugin/record! registry "foo" 2000000 :ok)     ;; 2ms
+    (#'plugin/record! registry "foo" 3000000 :error)  ;; 3ms
+    (#'plugin/record! registry "bar" 20000000000 :timeout) ;; 20s
+    (let [{:keys [foo bar]} (update-keys (:methods (plugin/metrics plugin)) keyword)]
+      (is (= (select-keys foo [:count :errors :timeouts :mean-us :max-us :p50-us :p90-us :p99-us])
+             {:count 3 :errors 1 :timeouts 0 :mean-us 1680 :max-us 3000
+              :p50-us 2500 :p90-us 5000 :p99-us 5000}))
+      (is (= (take 7 (:histogram foo))
+             [{:le-us 50 :count 1} {:le-us 100 :count 0} {:le-us 250 :count 0}
+              {:le-us 500 :count 0} {:le-us 1000 :count 0} {:le-us 2500 :count 1}
+              {:le-us 5000 :count 1}]))
+      (is (= (select-keys bar [:count :timeouts :max-us :p99-us])
+             {:count 1 :timeouts 1 :max-us 20000000 :p99-us 20000000}))
+      (is (= (last (:histogram bar)) {:le-us "+Inf" :count 1}))
+      (is (= (:bytes-written foo) 0)))
+    ;; bytes of responses written are recorded by method, not those
+    ;; of notifications
+    (#'plugin/write [[{:id 1 :method "foo"} {:jsonrpc "2.0" :id 1 :result {}}]
+                     [nil (#'plugin/notif "log" {:level "info" :message "bar"})]
+                     [{:id 2 :method "foo"} {:jsonrpc "2.0" :id 2 :result {:a 1}}]]
+                    (new java.io.StringWriter) (#'plugin/codec nil) 100 registry)
+    (is (= (get-in (plugin/metrics plugin) [:methods "foo" :bytes-written])
+           (+ (count "{\"jsonrpc\":\"2.0\",\"id\":1,\"result\":{}}\n\n")
+              (count "{\"jsonrpc\":\"2.0\",\"id\":2,\"result\":{\"a\":1}}\n\n"))))
+    (is (= (get-in (plugin/metrics plugin) [:methods "bar" :bytes-written]) 0)))
+  ;; metrics recorded by dispatch, scheduler and writer
+  (let [out (new java.io.StringWriter)
+        scheduler (#'plugin/scheduler 4)
+        registry (#'plugin/metrics-registry)
+        plugin (atom {:rpcmethods {:foo {:fn (fn [params req plugin] {:foo "bar"})}
+                                   :err {:fn (fn [params req plugin] (/ 1 0))}}
+                      :_writer (#'plugin/writer out 5 (#'plugin/codec nil) 100 registry)
+                      :_scheduler scheduler
+                      :_metrics registry})
+        executors (#'plugin/executors 4)]
+    (doto (Thread. #(#'plugin/dispatch scheduler executors plugin))
+      (.setDaemon true)
+      (.start))
+    (dotimes [i 10]
+      (#'plugin/schedule! scheduler {:jsonrpc "2.0" :id i :method "foo" :params {}} plugin))
+    (#'plugin/schedule! scheduler {:jsonrpc "2.0" :id 10 :method "err" :params {}} plugin)
+    (loop [i 0]
+      (when (and (< i 200)
+                 (let [m (:methods (plugin/metrics plugin))]
+                   (or (< (get-in m ["foo" :count] 0) 10)
+                       (< (get-in m ["err" :count] 0) 1))))
+        (Thread/sleep 10)
+        (recur (inc i))))
+    (Thread/sleep 50)
+    (#'plugin/drain! (:_writer @plugin))
+    (let [m (plugin/metrics plugin)]
+      (is (= (get-in m [:methods "foo" :count]) 10))
+      (is (= (get-in m [:methods "err" :errors]) 1))
+      (is (= (:scheduler m)
+             {:queue-depth {:hooks 0 :rpcmethods 0 :subscriptions 0}
+              :in-flight {:hooks 0 :rpcmethods 0 :subscriptions 0}
+              :max-parallel-reqs 4
+              :shed {:dropped 0 :coalesced 0 :rejected 0}}))
+      (is (= (get-in m [:writer :bytes-written]) (count (str out))))
+      (is (= (get-in m [:methods "foo" :bytes-written])
+             (->> (str/split (str out) #"\n\n")
+                  (filter #(str/includes? % "\"result\":{\"foo\":\"bar\"}"))
+                  (map #(+ (count %) 2))
+                  (reduce +))))
+      (is (= (get-in m [:writer :queue-length]) 0))
+      ;; the snapshot is JSON writable
+      (is (string? (json/write-str m))))))
+
+(deftest run-test
+  ;; run over in-memory streams, exiting with *exit* instead of System/exit
+  (let [reqs (str "{\"jsonrpc\":\"2.0\",\"id\":\"gm\",\"method\":\"getmanifest\",\"params\":{}}\n\n"
+                  "{\"jsonrpc\":\"2.0\",\"id\":\"init\",\"method\":\"init\","
+                  "\"params\":{\"options\":{},\"configuration\":{\"lightning-dir\":\"/tmp\",\"rpc-file\":\"rpc\"}}}\n\n"
+                  "{\"jsonrpc\":\"2.0\",\"id\":1,\"method\":\"foo\",\"params\":{}}\n\n")
+        out (new java.io.StringWriter)
+        exited (promise)
+        plugin (atom {:rpcmethods {:foo {:fn (fn [params req plugin] {:bar "baz"})}}})]
+    (future
+      (binding [*in* (java.io.StringReader. reqs)
+                *out* out
+                plugin/*exit* (fn [status] (deliver exited status))]
+        (plugin/run plugin)))
+    (is (= (deref exited 5000 :timeout) 0))
+    (let [resps (mapv #(json/read-str % :key-fn keyword)
+                      (str/split (str/trim (str out)) #"\n\n"))]
+      (is (= (map :id resps) ["gm" "init" 1]))
+      (is (= (:result (last resps)) {:bar "baz"}))))
+  ;; run returns once *exit* has returned and its threads are stopped
+  (let [reqs (str "{\"jsonrpc\":\"2.0\",\"id\":\"gm\",\"method\":\"getmanifest\",\"params\":{}}\n\n"
+                  "{\"jsonrpc\":\"2.0\",\"id\":\"init\",\"method\":\"init\","
+                  "\"params\":{\"options\":{},\"configuration\":{\"lightning-dir\":\"/tmp\",\"rpc-file\":\"rpc\"}}}\n\n")
+        plugin (atom {:rpcmethods {:foo {:fn (fn [params req plugin] {:bar "baz"})}}})
+        ran (future
+              (binding [*in* (java.io.StringReader. reqs)
+                        *out* (new java.io.StringWriter)
+                        plugin/*exit* (fn [status])]
+                (plugin/run plugin)
+                :returned))]
+    (is (= (deref ran 5000 :timeout) :returned))
+    (is (every? #(.isShutdown ^java.util.concurrent.ExecutorService %)
+                (vals (:_executors @plugin))))
+    (is (= (#'plugin/next-req! (:_scheduler @plugin)) nil)))
+  ;; run only calls *run* if bound
+  (is (= (binding [plugin/*run* (fn [plugin] [:run @plugin])]
+           (plugin/run (atom {:foo "bar"})))
+         [:run {:foo "bar"}])))
+
+(defn lightningd-rpc
+  "Start a stand-in of lightningd's RPC interface listening on a unix socket.
+
+  HANDLER is a function of [method params] returning the response
+  to the request (without :jsonrpc and :id).  Requests received on
+  the same connection are answered in parallel, so responses can
+  come out of order.
+
+  Return a map with the :socket-file to connect to, the number of
+  :connections accepted so far (an atom) and the :server channel
+  to close to stop the stand-in."
+  [handler]
+  (let [dir (java.nio.file.Files/createTempDirectory
+             "clnplugin-clj" (make-array java.nio.file.attribute.FileAttribute 0))
+        socket-file (str (.resolve dir "lightning-rpc"))
+        ^java.nio.channels.ServerSocketChannel server (#'host/unix-server-channel socket-file)
+        connections (atom 0)]
+    (future
+      (while (.isOpen server)
+        (let [ch (.accept server)
+              in (java.io.PushbackReader. (java.nio.channels.Channels/newReader ch "UTF-8") 64)]
+          (swap! connections inc)
+          (future
+            (loop [req (json/read in :key-fn keyword :eof-error? false)]
+              (when req
+                (future
+                  (let [resp (merge {:jsonrpc "2.0" :id (:id req)}
+                                    (handler (:method req) (:params req)))
+                        buf (java.nio.ByteBuffer/wrap
+                             (.getBytes (str (json/write-str resp) "\n\n") "UTF-8"))]
+                    (locking ch
+                      (while (.hasRemaining buf) (.write ch buf)))))
+                (recur (json/read in :key-fn keyword :eof-error? false))))))))
+    {:socket-file socket-file :connections connections :server server}))
+
+(deftest rpc-call-test
+  (is (thrown-with-msg?
+       clojure.lang.ExceptionInfo
+       #"Wrong :rpc-pool-size '0'.  It must be a positive integer."
+       (#'plugin/rpc-pool 0 (#'plugin/codec nil))))
+  (is (thrown-with-msg?
+       clojure.lang.ExceptionInfo
+       #"No connection to lightningd before the init round"
+       (plugin/rpc-call (atom {}) "getinfo")))
+  (is (thrown?
+       java.io.IOException
+       (#'plugin/unix-socket-channel "/nonexistent/lightning-rpc")))
+  ;; lightningd unreachable fails as a closed connection
+  (let [e (is (thrown-with-msg?
+               clojure.lang.ExceptionInfo
+               #"Connection to lightningd '/nonexistent/lightning-rpc' closed"
+               (plugin/rpc-call (atom {:socket-file "/nonexistent/lightning-rpc"
+                                       :_rpc (#'plugin/rpc-pool 1 (#'plugin/codec nil))})
+                                "getinfo")))]
+    (is (instance? java.io.IOException (ex-cause e))))
+  (let [{:keys [socket-file connections server]}
+        (lightningd-rpc
+         (fn [method params]
+           (case method
+             "getinfo" {:result {:id "node-id"}}
+             "echo" {:result params}
+             "slow" (do (Thread/sleep 300) {:result {:slow true}})
+             "fail" {:error {:code -32601 :message "Unknown command 'fail'"}})))
+        plugin (atom {:socket-file socket-file
+                      :_rpc (#'plugin/rpc-pool 1 (#'plugin/codec nil))})]
+    (try
+      (is (= (plugin/rpc-call plugin "getinfo") {:id "node-id"}))
+      (is (= (plugin/rpc-call plugin "echo" {:foo "bar" :baz [1 2]}) {:foo "bar" :baz [1 2]}))
+      (let [e (is (thrown-with-msg?
+                   clojure.lang.ExceptionInfo
+                   #"Error calling 'fail': Unknown command 'fail'"
+                   (plugin/rpc-call plugin "fail")))]
+        (is (= (ex-data e) {:code -32601 :message "Unknown command 'fail'"})))
+      ;; requests are pipelined on the same connection and responses
+      ;; matched by id, so a fast call doesn't wait for a slow one
+      (let [slow (future (plugin/rpc-call plugin "slow"))]
+        (Thread/sleep 50)
+        (is (= (plugin/rpc-call plugin "getinfo") {:id "node-id"}))
+        (is (not (realized? slow)))
+        (is (= @slow {:slow true})))
+      (is (thrown-with-msg?
+           clojure.lang.ExceptionInfo
+           #"Timeout of 50ms reached while calling 'slow'"
+           (plugin/rpc-call plugin "slow" {} 50)))
+      (is (= @connections 1))
+      ;; a closed connection is reopened
+      (#'plugin/close-rpc-pool! (:_rpc @plugin))
+      (is (= (plugin/rpc-call plugin "getinfo") {:id "node-id"}))
+      (is (= @connections 2))
+      ;; pool of 2 connections
+      (let [plugin (atom {:socket-file socket-file
+                          :_rpc (#'plugin/rpc-pool 2 (#'plugin/codec nil))})
+            calls (doall (for [i (range 50)]
+                           (future (plugin/rpc-call plugin "echo" {:i i}))))]
+        (is (= (map deref calls) (map #(hash-map :i %) (range 50))))
+        (is (= @connections 4)))
+      (finally
+        (.close server)))))
+
+(defn- host-connect
+  "Return a connection to the plugin listening on SOCKET-FILE in a host."
+  [socket-file]
+  (let [^java.nio.channels.SocketChannel ch (#'plugin/unix-socket-channel socket-file)]
+    {:ch ch
+     :rdr (#'plugin/request-reader (java.nio.channels.Channels/newReader ch "UTF-8"))}))
+
+(defn- host-call
+  "Send the request ID for METHOD with PARAMS through CONN and return its response."
+  [conn id method params]
+  (let [^java.nio.channels.SocketChannel ch (:ch conn)
+        buf (java.nio.ByteBuffer/wrap
+             (.getBytes (str (json/write-str {:jsonrpc "2.0" :id id :method method :params params})
+                             "\n\n")
+                        "UTF-8"))]
+    (while (.hasRemaining buf) (.write ch buf))
+    (loop [msg (#'plugin/read (:rdr conn))]
+      (if (or (nil? msg) (= (:id msg) id))
+        msg
+        (recur (#'plugin/read (:rdr conn)))))))
+
+
+(deftest node-log-level-test
+  (let [configs (atom nil)
+        {:keys [socket-file server]}
+        (lightningd-rpc
+         (fn [method params]
+           (if (and (= method "listconfigs") (= params {:config "log-level"}))
+             @configs
+             {:error {:code -32602 :message "Unknown config option"}})))
+        node-log-level (fn [p]
+                         (let [plugin (atom (merge {:socket-file socket-file
+                                                    :_rpc (#'plugin/rpc-pool 1 (#'plugin/codec nil))}
+                                                   p))]
+                           (try
+                             (#'plugin/node-log-level! plugin)
+                             (:_log-level @plugin)
+                             (finally (#'plugin/close-rpc-pool! (:_rpc @plugin))))))]
+    (try
+      ;; lightningd v23.08 and above
+      (reset! configs {:result {:configs {:log-level {:value_str "info" :source "cmdline"}}}})
+      (is (= (node-log-level {}) "info"))
+      ;; the least severe level of a multi-value log-level
+      (reset! configs {:result {:configs {:log-level {:values_str ["unusual" "debug:plugin-foo" "info"]}}}})
+      (is (= (node-log-level {}) "debug:plugin-foo"))
+      ;; older lightningd
+      (reset! configs {:result {:log-level "unusual"}})
+      (is (= (node-log-level {}) "unusual"))
+      ;; :log-level of the plugin wins, lightningd is not asked
+      (is (nil? (node-log-level {:log-level "broken"})))
+      ;; errors: we keep sending everything
+      (reset! configs {:error {:code -32602 :message "Unknown config option"}})
+      (is (nil? (node-log-level {})))
+      (is (nil? (node-log-level {:socket-file "/nonexistent/lightning-rpc"})))
+      ;; messages below lightningd's log-level are dropped
+      (reset! configs {:result {:configs {:log-level {:value_str "info"}}}})
+      (let [plugin (atom {:socket-file socket-file
+                          :_rpc (#'plugin/rpc-pool 1 (#'plugin/codec nil))
+                          :_writer (#'plugin/writer (new java.io.StringWriter))})]
+        (plugin/log "kept" "debug" plugin)
+        (#'plugin/node-log-level! plugin)
+        (plugin/log "dropped" "debug" plugin)
+        (plugin/log "kept" "info" plugin)
+        (#'plugin/drain! (:_writer @plugin))
+        (#'plugin/close-rpc-pool! (:_rpc @plugin))
+        (let [pbr (java.io.PushbackReader. (java.io.StringReader. (str (:out (:_writer @plugin)))) 64)]
+          (is (= (map (comp :message :params)
+                      (take-while some? (repeatedly #(json/read pbr :eof-error? false :key-fn keyword))))
+                 ["kept" "kept"]))))
+      (finally
+        (.close ^java.nio.channels.ServerSocketChannel server)))))
+(deftest host-test
+  (let [dir (java.nio.file.Files/createTempDirectory
+             "clnplugin-clj" (make-array java.nio.file.attribute.FileAttribute 0))
+        plugin-file (str (.resolve dir "host_plugin.clj"))
+        no-run-file (str (.resolve dir "host_no_run.clj"))
+        init-params {:options {} :configuration {:lightning-dir "/tmp" :rpc-file "rpc"}}
+        start-session (fn [socket-file]
+                        (let [conn (host-connect socket-file)]
+                          (host-call conn "gm" "getmanifest" {})
+                          (host-call conn "init" "init" init-params)
+                          conn))]
+    (spit plugin-file
+          (str "(ns host-plugin (:require [clnplugin-clj :as plugin]))\n"
+               "(def plugin (atom {:rpcmethods {:set-value {:fn (fn [params req plugin] (swap! plugin assoc :value (:value params)) {})}\n"
+               "                                :get-value {:fn (fn [params req plugin] {:value (:value @plugin)})}}}))\n"
+               "(plugin/run plugin)\n"))
+    (spit no-run-file "(ns host-no-run)\n")
+    (is (thrown-with-msg?
+         clojure.lang.ExceptionInfo
+         #"Plugin '.*host_no_run.clj' doesn't call clnplugin-clj/run"
+         (host/start! (str dir) [no-run-file])))
+    (let [h (host/start! (str dir) [plugin-file])
+          socket-file (str (.resolve dir "host_plugin.sock"))]
+      (try
+        (is (= (keys h) ["host_plugin"]))
+        ;; two sessions of the same plugin don't share their plugin atom
+        (let [s1 (start-session socket-file)
+              s2 (start-session socket-file)]
+          (is (= (:result (host-call s1 1 "set-value" {:value "foo"})) {}))
+          (is (= (:result (host-call s1 2 "get-value" {})) {:value "foo"}))
+          (is (= (:result (host-call s2 3 "get-value" {})) {:value nil}))
+          ;; lightningd closes the connection: the session stops
+          ;; and the host closes the connection
+          (.shutdownOutput ^java.nio.channels.SocketChannel (:ch s1))
+          (is (nil? (#'plugin/read (:rdr s1))))
+          (.close ^java.nio.channels.SocketChannel (:ch s1))
+          ;; the other session goes on
+          (is (= (:result (host-call s2 4 "get-value" {})) {:value nil}))
+          (.close ^java.nio.channels.SocketChannel (:ch s2)))
+        ;; the plugin can be started again
+        (let [s3 (start-session socket-file)]
+          (is (= (:result (host-call s3 5 "get-value" {})) {:value nil}))
+          (.close ^java.nio.channels.SocketChannel (:ch s3)))
+        (finally (host/stop! h))))))
+
+(deftest codec-test
+  (is (= (:name (#'plugin/codec nil)) :data-json))
+  (is (= (:name (#'plugin/codec :data-json)) :data-json))
+  (is (= (:name (#'plugin/codec :jackson)) :jackson))
+  (let [c {:name :custom :read (fn [buf offset len]) :write (fn [x out]) :write-lenient (fn [x out])}]
+    (is (= (#'plugin/codec c) c)))
+  (is (thrown-with-msg?
+       clojure.lang.ExceptionInfo
+       #"Wrong :codec ':foo'.  Authorized codecs are: :data-json, :jackson"
+       (#'plugin/codec :foo))))
+
+(def codecs
+  "Codecs run through `codec-conformance-test`."
+  [(#'plugin/codec :data-json) (#'plugin/codec :jackson)])
+
+(deftest codec-conformance-test
+  (doseq [codec codecs]
+    (testing (:name codec)
+      (let [read-str (fn [^String s]
+                       (let [cs (.toCharArray s)]
+                         ((:read codec) cs 0 (alength cs))))
+            write-str (fn [x]
+                        (let [w (new java.io.StringWriter)]
+                          ((:write codec) x w)
+                          (str w)))]
+        ;; read
+        (is (= (read-str "{\"a\":1,\"b\":[1,2.5,\"c\",true,false,null],\"c\":{\"d\":{}}}")
+               {:a 1 :b [1 2.5 "c" true false nil] :c {:d {}}}))
+        (is (= (class (:a (read-str "{\"a\":1}"))) Long))
+        (is (= (class (:a (read-str "{\"a\":1.5e3}"))) Double))
+        (is (= (read-str "{\"a\":123456789012345678901234567890}")
+               {:a 123456789012345678901234567890N}))
+        (is (= (read-str "{\"a\":\"\\u00e9\\n\\/\"}") {:a "\u00e9\n/"}))
+        (is (= (read-str "  [{\"a\" : 1}, {}]  ") [{:a 1} {}]))
+        (is (= ((:read codec) (.toCharArray "xx{\"a\":1}yy") 2 7) {:a 1}))
+        (is (thrown? Exception (read-str "{\"a\":")))
+        (is (thrown? Exception (read-str "{\"a\":foo}")))
+        ;; write: same JSON values as clojure.data.json
+        (doseq [x [{:jsonrpc "2.0" :id 1 :result {:foo "bar"}}
+                   {:jsonrpc "2.0" :method "log" :params {:level "debug" :message "\u00e9 \"quoted\"\n/"}}
+                   {:a nil :b [1 2.5 -3 "s" :kw 'sym true false] "c" #{1} :d (list 1 2)}
+                   {:big 123456789012345678901234567890N :dec 1.5M :ratio 1/2}
+                   {:uuid #uuid "5a3b1c2d-0000-4000-8000-000000000000"
+                    :java-map (java.util.HashMap. {"a" 1})
+                    :array (object-array [1 "a"])}
+                   [] {} "s" 1 nil]]
+          (is (= (json/read-str (write-str x))
+                 (json/read-str (json/write-str x :escape-slash false)))))
+        ;; only ASCII chars and slashes not escaped
+        (let [s (write-str {:a "\u00e9\u2028/"})]
+          (is (every? #(< (int %) 128) s))
+          (is (not (str/includes? s "\\/")))
+          (is (= (json/read-str s) {"a" "\u00e9\u2028/"})))
+        ;; non JSON writable objects
+        (is (thrown? Exception (write-str {:a (atom 1)})))
+        (is (thrown? Exception (write-str {:a Double/NaN})))
+        (is (thrown? Exception (write-str {nil 1})))
+        (let [w (new java.io.StringWriter)]
+          ((:write-lenient codec) {:a (atom 1) :b 1} w)
+          (is (re-find #"\"a\":\"#object\[clojure.lang.Atom" (str w)))
+          (is (re-find #"\"b\":1" (str w))))
+        ;; write doesn't close nor flush OUT
+        (let [flushed (atom false)
+              closed (atom false)
+              w (proxy [java.io.StringWriter] []
+                  (flush [] (reset! flushed true))
+                  (close [] (reset! closed true)))]
+          ((:write codec) {:a 1} w)
+          (is (= (json/read-str (str w)) {"a" 1}))
+          (is (not @flushed))
+          (is (not @closed)))
+        ;; requests read with request-reader
+        (let [in (java.io.StringReader. "{\"jsonrpc\":\"2.0\",\"id\":1,\"method\":\"foo\",\"params\":{\"a\":[1]}}\n\n{\"foo\n\n")
+              rdr (#'plugin/request-reader in 8 codec)]
+          (is (= (#'plugin/read rdr) {:jsonrpc "2.0" :id 1 :method "foo" :params {:a [1]}}))
+          (is (= (try (#'plugin/read rdr) (catch clojure.lang.ExceptionInfo e (:code (:error (ex-data e)))))
+                 -32700)))
+        ;; responses written with write, including non JSON writable ones
+        (let [out (new java.io.StringWriter)]
+          (#'plugin/write [[{:id 1} {:jsonrpc "2.0" :id 1 :result {:a 1}}]
+                           [{:id 2} {:jsonrpc "2.0" :id 2 :result {:a (atom 1)}}]
+                           [nil {:jsonrpc "2.0" :method "foo" :params {:a (atom 1)}}]
+                           [nil {:jsonrpc "2.0" :method "bar" :params {}}]]
+                          out codec)
+          (let [msgs (mapv json/read-str (str/split (str/trim (str out)) #"\n\n"))]
+            (is (= (first msgs) {"jsonrpc" "2.0" "id" 1 "result" {"a" 1}}))
+            (is (= (get-in (first (filter #(= (get % "id") 2) msgs)) ["error" "code"]) -32603))
+            (is (not (some #(= (get % "method") "foo") msgs)))
+            (is (= (last msgs) {"jsonrpc" "2.0" "method" "bar" "params" {}}))))))))
+
 (deftest params->map-test
   ;; params is {}
   (let [params {}]